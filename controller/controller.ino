@@ -102,8 +102,108 @@ int currentDestination = 0;
 */
 int currentState = 0;
 
-// Boolean to keep track of whether the arm was notified of the move
-bool engineNotified = false;
+// Frames exchanged with the computer. See docs/protocol.md for the format.
+const uint8_t START_BYTE = 0xA5;
+const uint8_t PROTOCOL_VERSION = 1;
+const int HEADER_SIZE = 5;
+const int CRC_SIZE = 2;
+// The longest payload the controller accepts. The protocol allows up to 255
+// bytes, but no message sent to the arm needs more than this.
+const int MAX_PAYLOAD = 16;
+
+// Message types
+const uint8_t MSG_MOVE = 0x01;
+const uint8_t MSG_CAPTURE = 0x02;
+const uint8_t MSG_RESET = 0x03;
+const uint8_t MSG_BOARD = 0x04;
+const uint8_t MSG_STATUS = 0x05;
+const uint8_t MSG_ACK = 0x06;
+const uint8_t MSG_SETPOINT = 0x07;
+
+// Flags of setpoints
+const uint8_t SETPOINT_GRIPPER_CLOSED = 0x01;
+const uint8_t SETPOINT_LAST = 0x02;
+
+// Status codes
+const uint8_t STATUS_OK = 0x00;
+const uint8_t STATUS_DONE = 0x01;
+const uint8_t STATUS_QUEUE_FULL = 0x02;
+const uint8_t STATUS_BAD_FRAME = 0x03;
+const uint8_t STATUS_ILLEGAL = 0x04;
+
+// Milliseconds to wait for the computer to acknowledge a frame before sending it again
+const unsigned long ACK_TIMEOUT = 500;
+
+// The frame being received, and the number of bytes of it received so far
+uint8_t rxFrame[HEADER_SIZE + MAX_PAYLOAD + CRC_SIZE];
+int rxLength = 0;
+
+// The sequence numbers of the commands received recently, one bit each,
+// so that a command sent again because its ACK was lost is not made twice
+uint8_t seenSequences[32];
+
+// The sequence number of the last Reset and when it arrived, so that a Reset
+// sent again because its ACK was lost doesn't drop the moves queued after it.
+// The computer numbers its frames from 0 again when it restarts, so a Reset
+// with the same number is only taken as sent again within RESET_RESEND_WINDOW.
+int lastResetSequence = -1;
+unsigned long lastResetAt = 0;
+// Longer than the computer keeps sending a frame again
+const unsigned long RESET_RESEND_WINDOW = 3000;
+
+// A move the arm was asked to make
+struct Command {
+  uint8_t sequence;
+  int startIdx;
+  int endIdx;
+  bool capture;
+};
+
+// Moves that were received while the arm was busy, in the order they were received
+const int QUEUE_SIZE = 4;
+Command commandQueue[QUEUE_SIZE];
+int queueLength = 0;
+
+// True while the arm is making a move, and the sequence number of that move
+bool armBusy = false;
+uint8_t currentSequence = 0;
+
+// Setpoints streamed by the computer (see engine/trajectory.py), which the
+// arm moves to one every SETPOINT_PERIOD milliseconds
+struct Setpoint {
+  uint8_t sequence;
+  float angles[4];
+  uint8_t flags;
+  // The setpoint's index in its trajectory, counted from 0
+  uint16_t index;
+};
+
+const int SETPOINT_BUFFER_SIZE = 16;
+const unsigned long SETPOINT_PERIOD = 20;
+Setpoint setpoints[SETPOINT_BUFFER_SIZE];
+int setpointHead = 0;
+int setpointCount = 0;
+unsigned long setpointPlayedAt = 0;
+// True from the first setpoint of a trajectory until the last one
+bool streaming = false;
+// The number of the trajectory being played (or played last), and the
+// highest index of its setpoints received, so that a setpoint that was sent
+// again after later ones is dropped instead of moving the arm back
+int streamTrajectory = -1;
+long lastSetpointIndex = -1;
+unsigned long setpointReceivedAt = 0;
+// Milliseconds without setpoints after which a trajectory whose last
+// setpoint was lost is abandoned. Longer than the computer keeps sending a
+// setpoint again.
+const unsigned long STREAM_TIMEOUT = 3000;
+
+// Frames sent to the computer that it has not acknowledged yet
+const int OUTBOX_SIZE = 4;
+const int MAX_OUTGOING = HEADER_SIZE + 8 + CRC_SIZE;
+uint8_t outbox[OUTBOX_SIZE][MAX_OUTGOING];
+int outboxLength[OUTBOX_SIZE];
+unsigned long outboxSentAt[OUTBOX_SIZE];
+uint8_t txSequence = 0;
 
 
 void setup() {
@@ -130,53 +230,26 @@ void setup() {
 }
 
 void loop() {
-  if (Serial.available()) {
-    engineNotified = false;
-
-    String move = Serial.readString();
-    move.trim();
-
-    baseServoAngleCached = baseServoAngle;
-    baseArmServoAngleCached = baseArmServoAngle;
-    armArmServoAngleCached = armArmServoAngle;
-    gripperPitchServoAngleCached = gripperPitchServoAngle;
-
-    if (move == "q") {
-      // Reset the arm's position
-      baseServoAngle = resetAngles[0];
-      baseArmServoAngle = resetAngles[1];
-      armArmServoAngle = resetAngles[2];
-      gripperPitchServoAngle = resetAngles[3];
-
-      openGripper();
-    }
-    else {
-      bool capture = move.substring(2, 3) == "x";
-      String start = move.substring(0, 2);
-      String end = move.substring(3);
-      int startIdx = getSquareIndex(start);
-      int endIdx = getSquareIndex(end);
-
-      if (capture) {
-        destinations[0] = endIdx;
-        destinations[1] = -1;
-        destinations[2] = startIdx;
-        destinations[3] = endIdx;
-      }
-      else {
-        destinations[0] = startIdx;
-        destinations[1] = endIdx;
-        destinations[2] = -1;
-        destinations[3] = -1;
-      }
-
-      currentDestination = 0;
-      currentState = 0;
+  // Decode the frames received from the computer since the last time step
+  while (Serial.available()) {
+    receiveByte(Serial.read());
+  }
+  resendFrames();
+
+  // Streamed trajectories replace the smoothing below until they end
+  if (streaming || (!armBusy && queueLength == 0 && setpointCount > 0 && setpoints[setpointHead].index == 0)) {
+    playSetpoint();
+    writeServos();
+    delay(5);
+    return;
+  }
 
-      baseServoAngle = hoverAngles[destinations[0]][0];
-      baseArmServoAngle = hoverAngles[destinations[0]][1];
-      armArmServoAngle = hoverAngles[destinations[0]][2];
-      gripperPitchServoAngle = hoverAngles[destinations[0]][3];
+  // Start the next queued move as soon as the previous one is done
+  if (!armBusy && queueLength > 0) {
+    startCommand(commandQueue[0]);
+    queueLength -= 1;
+    for (int i = 0; i < queueLength; i++) {
+      commandQueue[i] = commandQueue[i + 1];
     }
   }
 
@@ -204,9 +277,9 @@ void loop() {
       armArmServoAngle = resetAngles[2];
       gripperPitchServoAngle = resetAngles[3];
 
-      if (!engineNotified) {
-        Serial.println("move done");
-        engineNotified = true;
+      if (armBusy) {
+        armBusy = false;
+        sendStatus(currentSequence, STATUS_DONE);
       }
     }
 
@@ -278,21 +351,7 @@ void loop() {
   gripperPitchServoAnglePrev = gripperPitchServoAngleSmoothed;
 
   // Calculate PWM pulse width from smoothened angles
-  float pulseWidth = map(baseServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
-  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
-  pwm.setPWM(BASE_SERVO_PIN, 0, pulseWidth);
-
-  pulseWidth = map(baseArmServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
-  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
-  pwm.setPWM(BASE_ARM_SERVO_PIN, 0, pulseWidth);
-
-  pulseWidth = map(armArmServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
-  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
-  pwm.setPWM(ARM_ARM_SERVO_PIN, 0, pulseWidth);
-
-  pulseWidth = map(gripperPitchServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
-  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
-  pwm.setPWM(GRIPPER_PITCH_SERVO_PIN, 0, pulseWidth);
+  writeServos();
 
   Serial.print(baseServoAngleSmoothed);
   // Serial.print(",");
@@ -330,36 +389,338 @@ void loop() {
 }
 
 /**
- * Returns the index into the square array for a 
- * particular square as a string
+ * CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF)
 */
-int getSquareIndex(String square) {
-  switch (square[0]) {
-    case 'A':
-    case 'a':
-      return (int) square[1] - 49;
-    case 'B':
-    case 'b':
-      return 8 + (int) square[1] - 49;
-    case 'C':
-    case 'c':
-      return 16 + (int) square[1] - 49;
-    case 'D': 
-    case 'd':
-      return 24 + (int) square[1] - 49;
-    case 'E':
-    case 'e':
-      return 32 + (int) square[1] - 49;
-    case 'F':
-    case 'f':
-      return 40 + (int) square[1] - 49;
-    case 'G':
-    case 'g':
-      return 48 + (int) square[1] - 49;
-    case 'H':
-    case 'h':
-      return 56 + (int) square[1] - 49;
+uint16_t crc16(const uint8_t *data, int length) {
+  uint16_t crc = 0xFFFF;
+  for (int i = 0; i < length; i++) {
+    crc ^= (uint16_t) data[i] << 8;
+    for (int bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : crc << 1;
+    }
   }
+  return crc;
+}
+
+/**
+ * Adds one received byte to the frame being received, and handles
+ * the frame once it is complete. Bytes outside of a frame, and frames
+ * with a wrong version, length, or CRC are dropped. The computer sends
+ * commands again if they are not acknowledged.
+*/
+void receiveByte(uint8_t b) {
+  if (rxLength == 0 && b != START_BYTE) return;
+  rxFrame[rxLength++] = b;
+
+  if (rxLength == 2 && b != PROTOCOL_VERSION) {
+    rxLength = 0;
+    return;
+  }
+  if (rxLength == 3 && b > MAX_PAYLOAD) {
+    rxLength = 0;
+    return;
+  }
+  if (rxLength < HEADER_SIZE || rxLength < HEADER_SIZE + rxFrame[2] + CRC_SIZE) return;
+
+  int payloadLength = rxFrame[2];
+  rxLength = 0;
+  uint16_t crc = (uint16_t) rxFrame[HEADER_SIZE + payloadLength] << 8 | rxFrame[HEADER_SIZE + payloadLength + 1];
+  if (crc != crc16(rxFrame + 1, HEADER_SIZE - 1 + payloadLength)) return;
+  handleFrame(rxFrame[4], rxFrame[3], rxFrame + HEADER_SIZE, payloadLength);
+}
+
+void handleFrame(uint8_t type, uint8_t sequence, const uint8_t *payload, int payloadLength) {
+  if (type == MSG_ACK) {
+    // The computer received one of our frames
+    for (int i = 0; i < OUTBOX_SIZE; i++) {
+      if (outboxLength[i] > 0 && outbox[i][3] == payload[0]) outboxLength[i] = 0;
+    }
+    return;
+  }
+
+  if (type == MSG_RESET) {
+    if (sequence == lastResetSequence && isSeen(sequence) && millis() - lastResetAt < RESET_RESEND_WINDOW) {
+      // Already carried out, and moves may have been queued since
+      sendAck(sequence, STATUS_OK);
+      sendStatus(sequence, STATUS_DONE);
+      return;
+    }
+    lastResetSequence = sequence;
+    lastResetAt = millis();
+
+    // Abandon the current and queued moves and reset the arm's position
+    queueLength = 0;
+    armBusy = false;
+    setpointCount = 0;
+    streaming = false;
+    streamTrajectory = -1;
+    lastSetpointIndex = -1;
+    memset(seenSequences, 0, sizeof(seenSequences));
+    markSeen(sequence);
+
+    baseServoAngleCached = baseServoAngle;
+    baseArmServoAngleCached = baseArmServoAngle;
+    armArmServoAngleCached = armArmServoAngle;
+    gripperPitchServoAngleCached = gripperPitchServoAngle;
+
+    currentDestination = 4;
+    currentState = 3;
+    baseServoAngle = resetAngles[0];
+    baseArmServoAngle = resetAngles[1];
+    armArmServoAngle = resetAngles[2];
+    gripperPitchServoAngle = resetAngles[3];
+
+    openGripper();
+    sendAck(sequence, STATUS_OK);
+    sendStatus(sequence, STATUS_DONE);
+    return;
+  }
+
+  if (type != MSG_MOVE && type != MSG_CAPTURE && type != MSG_SETPOINT) {
+    sendAck(sequence, STATUS_BAD_FRAME);
+    return;
+  }
+  if (isSeen(sequence)) {
+    // A command we already have, sent again because our ACK was lost
+    sendAck(sequence, STATUS_OK);
+    return;
+  }
+  if (type == MSG_SETPOINT) {
+    addSetpoint(sequence, payload, payloadLength);
+    return;
+  }
+  if (payloadLength != 2 || payload[0] > 63 || payload[1] > 63) {
+    sendAck(sequence, STATUS_ILLEGAL);
+    return;
+  }
+  if (queueLength >= QUEUE_SIZE) {
+    sendAck(sequence, STATUS_QUEUE_FULL);
+    return;
+  }
+
+  markSeen(sequence);
+  commandQueue[queueLength].sequence = sequence;
+  commandQueue[queueLength].startIdx = payload[0];
+  commandQueue[queueLength].endIdx = payload[1];
+  commandQueue[queueLength].capture = type == MSG_CAPTURE;
+  queueLength += 1;
+  sendAck(sequence, STATUS_OK);
+}
+
+bool isSeen(uint8_t sequence) {
+  return seenSequences[sequence / 8] & (1 << (sequence % 8));
+}
+
+void markSeen(uint8_t sequence) {
+  seenSequences[sequence / 8] |= 1 << (sequence % 8);
+  // Forget the sequence numbers from half a cycle ago, so they can be used again
+  uint8_t old = sequence + 128;
+  seenSequences[old / 8] &= ~(1 << (old % 8));
+}
+
+/**
+ * Starts making a move
+*/
+void startCommand(Command command) {
+  baseServoAngleCached = baseServoAngle;
+  baseArmServoAngleCached = baseArmServoAngle;
+  armArmServoAngleCached = armArmServoAngle;
+  gripperPitchServoAngleCached = gripperPitchServoAngle;
+
+  if (command.capture) {
+    destinations[0] = command.endIdx;
+    destinations[1] = -1;
+    destinations[2] = command.startIdx;
+    destinations[3] = command.endIdx;
+  }
+  else {
+    destinations[0] = command.startIdx;
+    destinations[1] = command.endIdx;
+    destinations[2] = -1;
+    destinations[3] = -1;
+  }
+
+  currentDestination = 0;
+  currentState = 0;
+  armBusy = true;
+  currentSequence = command.sequence;
+
+  baseServoAngle = hoverAngles[destinations[0]][0];
+  baseArmServoAngle = hoverAngles[destinations[0]][1];
+  armArmServoAngle = hoverAngles[destinations[0]][2];
+  gripperPitchServoAngle = hoverAngles[destinations[0]][3];
+}
+
+/**
+ * Adds a setpoint received from the computer to the setpoint buffer. The
+ * payload holds the 4 angles in hundredths of a degree, the flags, the
+ * number of the trajectory, and the setpoint's index in the trajectory.
+ *
+ * A trajectory only starts from its first setpoint, and setpoints of
+ * another trajectory, or that are not newer than the setpoints already
+ * received, are dropped, so the buffer always holds the rest of the
+ * trajectory in order.
+*/
+void addSetpoint(uint8_t sequence, const uint8_t *payload, int payloadLength) {
+  if (payloadLength != 12) {
+    sendAck(sequence, STATUS_ILLEGAL);
+    return;
+  }
+  uint8_t trajectory = payload[9];
+  uint16_t index = (uint16_t) payload[10] << 8 | payload[11];
+
+  if (index == 0 && !streaming) {
+    // The first setpoint of a new trajectory
+    streamTrajectory = trajectory;
+    lastSetpointIndex = -1;
+    setpointCount = 0;
+  }
+  else if (trajectory != streamTrajectory && !streaming) {
+    // The first setpoint of this trajectory was lost. Have this one sent
+    // again, once the first one had time to arrive.
+    sendAck(sequence, STATUS_QUEUE_FULL);
+    return;
+  }
+  else if (trajectory != streamTrajectory || (long) index <= lastSetpointIndex) {
+    // A setpoint that was sent again after later ones, which is stale by now
+    markSeen(sequence);
+    sendAck(sequence, STATUS_OK);
+    return;
+  }
+  if (setpointCount >= SETPOINT_BUFFER_SIZE) {
+    sendAck(sequence, STATUS_QUEUE_FULL);
+    return;
+  }
+
+  markSeen(sequence);
+  Setpoint &setpoint = setpoints[(setpointHead + setpointCount) % SETPOINT_BUFFER_SIZE];
+  setpoint.sequence = sequence;
+  for (int i = 0; i < 4; i++) {
+    setpoint.angles[i] = ((uint16_t) payload[2 * i] << 8 | payload[2 * i + 1]) / 100.0;
+  }
+  setpoint.flags = payload[8];
+  setpoint.index = index;
+  setpointCount += 1;
+  lastSetpointIndex = index;
+  setpointReceivedAt = millis();
+  sendAck(sequence, STATUS_OK);
+}
+
+/**
+ * Moves the servos straight to the next setpoint once SETPOINT_PERIOD has
+ * passed since the last one. If the computer falls behind, the arm holds
+ * the last setpoint until the next one arrives.
+*/
+void playSetpoint() {
+  if (streaming && setpointCount == 0 && millis() - setpointReceivedAt > STREAM_TIMEOUT) {
+    // The rest of the trajectory never arrived. Hold the pose, and go on with the queued moves.
+    streaming = false;
+    return;
+  }
+  if (!streaming || setpointCount == 0) {
+    // Play the next setpoint as soon as it arrives
+    streaming = true;
+    setpointPlayedAt = millis() - SETPOINT_PERIOD;
+  }
+  if (setpointCount == 0 || millis() - setpointPlayedAt < SETPOINT_PERIOD) return;
+
+  Setpoint setpoint = setpoints[setpointHead];
+  setpointHead = (setpointHead + 1) % SETPOINT_BUFFER_SIZE;
+  setpointCount -= 1;
+  // Keep to the computer's schedule, however long each loop takes
+  setpointPlayedAt += SETPOINT_PERIOD;
+
+  // The trajectory is already smooth, so skip the smoothing and the state machine
+  baseServoAngle = baseServoAngleCached = baseServoAnglePrev = baseServoAngleSmoothed = setpoint.angles[0];
+  baseArmServoAngle = baseArmServoAngleCached = baseArmServoAnglePrev = baseArmServoAngleSmoothed = setpoint.angles[1];
+  armArmServoAngle = armArmServoAngleCached = armArmServoAnglePrev = armArmServoAngleSmoothed = setpoint.angles[2];
+  gripperPitchServoAngle = gripperPitchServoAngleCached = gripperPitchServoAnglePrev = gripperPitchServoAngleSmoothed = setpoint.angles[3];
+
+  // The trajectory holds still while the gripper moves, so don't wait for it here
+  bool closed = setpoint.flags & SETPOINT_GRIPPER_CLOSED;
+  if (closed != gripperClosed) setGripper(closed);
+
+  if (setpoint.flags & SETPOINT_LAST) {
+    streaming = false;
+    sendStatus(setpoint.sequence, STATUS_DONE);
+  }
+}
+
+/**
+ * Writes the smoothened angles of the servos to the motor driver
+*/
+void writeServos() {
+  float pulseWidth = map(baseServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
+  pwm.setPWM(BASE_SERVO_PIN, 0, pulseWidth);
+
+  pulseWidth = map(baseArmServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
+  pwm.setPWM(BASE_ARM_SERVO_PIN, 0, pulseWidth);
+
+  pulseWidth = map(armArmServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
+  pwm.setPWM(ARM_ARM_SERVO_PIN, 0, pulseWidth);
+
+  pulseWidth = map(gripperPitchServoAngleSmoothed, 0.0, 180.0, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
+  pwm.setPWM(GRIPPER_PITCH_SERVO_PIN, 0, pulseWidth);
+}
+
+/**
+ * Writes a frame to the serial port. Returns the number of bytes written to frame.
+*/
+int writeFrame(uint8_t *frame, uint8_t type, uint8_t sequence, const uint8_t *payload, int payloadLength) {
+  frame[0] = START_BYTE;
+  frame[1] = PROTOCOL_VERSION;
+  frame[2] = payloadLength;
+  frame[3] = sequence;
+  frame[4] = type;
+  memcpy(frame + HEADER_SIZE, payload, payloadLength);
+  uint16_t crc = crc16(frame + 1, HEADER_SIZE - 1 + payloadLength);
+  frame[HEADER_SIZE + payloadLength] = crc >> 8;
+  frame[HEADER_SIZE + payloadLength + 1] = crc & 0xFF;
+  int length = HEADER_SIZE + payloadLength + CRC_SIZE;
+  Serial.write(frame, length);
+  return length;
+}
+
+void sendAck(uint8_t sequence, uint8_t status) {
+  uint8_t frame[HEADER_SIZE + 2 + CRC_SIZE];
+  uint8_t payload[2] = {sequence, status};
+  writeFrame(frame, MSG_ACK, sequence, payload, 2);
+}
+
+/**
+ * Sends a frame that the computer has to acknowledge, and keeps it to
+ * send it again until it does.
+*/
+void sendReliable(uint8_t type, const uint8_t *payload, int payloadLength) {
+  int slot = 0;
+  for (int i = 0; i < OUTBOX_SIZE; i++) {
+    if (outboxLength[i] == 0) {
+      slot = i;
+      break;
+    }
+    // If every slot is taken, replace the frame that was waiting the longest
+    if (outboxSentAt[i] < outboxSentAt[slot]) slot = i;
+  }
+  outboxLength[slot] = writeFrame(outbox[slot], type, txSequence++, payload, payloadLength);
+  outboxSentAt[slot] = millis();
+}
+
+void resendFrames() {
+  for (int i = 0; i < OUTBOX_SIZE; i++) {
+    if (outboxLength[i] > 0 && millis() - outboxSentAt[i] >= ACK_TIMEOUT) {
+      Serial.write(outbox[i], outboxLength[i]);
+      outboxSentAt[i] = millis();
+    }
+  }
+}
+
+void sendStatus(uint8_t sequence, uint8_t status) {
+  uint8_t payload[2] = {sequence, status};
+  sendReliable(MSG_STATUS, payload, 2);
 }
 
 /**
@@ -497,19 +858,19 @@ bool transitionComplete() {
 
 
 void openGripper() {
-  float pulseWidth;
-  pulseWidth = map(gripperOpenAngle, 0, 180, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
-  pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
-  pwm.setPWM(GRIPPER_GRAB_SERVO_PIN, 0, pulseWidth);
-  gripperClosed = false;
+  setGripper(false);
   delay(MOVE_SETTLE_DELAY);
 }
 
 void closeGripper() {
+  setGripper(true);
+  delay(MOVE_SETTLE_DELAY);
+}
+
+void setGripper(bool closed) {
   float pulseWidth;
-  pulseWidth = map(gripperClosedAngle, 0, 180, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
+  pulseWidth = map(closed ? gripperClosedAngle : gripperOpenAngle, 0, 180, MIN_PULSE_WIDTH, MAX_PULSE_WIDTH);
   pulseWidth = int(float(pulseWidth) / 1000000 * FREQUENCY * 4096);
   pwm.setPWM(GRIPPER_GRAB_SERVO_PIN, 0, pulseWidth);
-  gripperClosed = true;
-  delay(MOVE_SETTLE_DELAY);
+  gripperClosed = closed;
 }
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""
+An opening book consulted before searching.
+
+The book is a binary file in the layout of a Polyglot book: a sorted array
+of 16 byte entries, each holding a position hash, a move, and a weight. The
+file is memory-mapped and binary searched, so looking up a position costs
+a few reads no matter how large the book is.
+
+Position hashes are computed with utils.zobrist_hash, which uses different
+random keys than Polyglot, so books have to be built from PGN files with
+this module rather than downloaded.
+
+Build a book from a PGN file by running -
+
+    python engine/book.py games.pgn book.bin
+"""
+import argparse
+from collections import Counter
+import mmap
+import random
+import struct
+
+from chessengine import Board
+from chessengine.exceptions import MoveError, PGNParsingError, PositionError
+from chessengine.lookup_tables import pos_to_coords
+from chessengine.pgn.parser import PGNParser, MOVE_TEXT_MOVE_REGEX
+
+from utils import positions_from_uci, uci_move, zobrist_hash
+
+
+# key (uint64), move (uint16), weight (uint16), learn (uint32), big-endian
+ENTRY = struct.Struct('>QHHI')
+KEY = struct.Struct('>Q')
+
+
+def encode_move(move: str) -> int:
+    """
+    Encodes a UCI move as the 16 bit move of a book entry:
+    the end square in bits 0-5, and the start square in bits 6-11.
+    """
+    start, end = positions_from_uci(move)
+    return (start.bit_length() - 1) << 6 | (end.bit_length() - 1)
+
+
+def decode_move(move: int) -> str:
+    """
+    Decodes the 16 bit move of a book entry into a UCI move.
+    """
+    return (pos_to_coords[(move >> 6) & 63] + pos_to_coords[move & 63]).lower()
+
+
+class OpeningBook:
+    """
+    A memory-mapped opening book.
+
+    :param path: The path to a book file built by build_book
+    """
+    def __init__(self, path: str):
+        self.file = open(path, 'rb')
+        self.file.seek(0, 2)
+        self.size = self.file.tell() // ENTRY.size
+        # An empty file can't be memory-mapped
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def _key_at(self, index: int) -> int:
+        return KEY.unpack_from(self.map, index * ENTRY.size)[0]
+
+    def moves(self, key: int) -> list[tuple[str, int]]:
+        """
+        Returns all book moves for the position with the given hash as
+        (move, weight) tuples, where move is in UCI format.
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        moves = []
+        for index in range(low, self.size):
+            entry_key, move, weight, _ = ENTRY.unpack_from(self.map, index * ENTRY.size)
+            if entry_key != key:
+                break
+            moves.append((decode_move(move), weight))
+        return moves
+
+    def choose(self, key: int) -> str | None:
+        """
+        Picks one of the book moves for the position with the given hash at
+        random, in proportion to their weights. Returns None if the position
+        is not in the book.
+        """
+        moves = [(move, weight) for move, weight in self.moves(key) if weight > 0]
+        if not moves:
+            return None
+        return random.choices([move for move, _ in moves], weights=[weight for _, weight in moves])[0]
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+def count_book_moves(pgn_paths: list[str], max_plies: int) -> Counter:
+    """
+    Replays the first max_plies plies of every game in the PGN files and
+    counts how often each move was played in each position.
+    Games with moves that can't be replayed are skipped from that move on.
+    """
+    parser = PGNParser(pgn_paths)
+    parser.parse()
+
+    counts = Counter()
+    for game in parser.games:
+        board = Board('white')
+        side = 'white'
+        plies = []
+        for _, white_move, black_move, _ in MOVE_TEXT_MOVE_REGEX.findall(game.move_text):
+            plies.extend([white_move, black_move])
+
+        for san in plies[:max_plies]:
+            if san in {'1-0', '0-1', '1/2-1/2', '*'}:
+                break
+            key = zobrist_hash(board, side)
+            made = len(board.moves)
+            try:
+                board.move_san(san, side)
+            except (MoveError, PGNParsingError, PositionError, ValueError):
+                break
+            # A castle also appends the rook's move, after the king's
+            start, end = board.moves[made][0], board.moves[made][1]
+            counts[(key, uci_move(start, end))] += 1
+            side = 'black' if side == 'white' else 'white'
+    return counts
+
+
+def build_book(pgn_paths: list[str], output: str, max_plies: int = 20, min_count: int = 1) -> int:
+    """
+    Builds a book file from PGN files. Moves played fewer than min_count
+    times in a position are left out. Returns the number of entries written.
+    """
+    counts = count_book_moves(pgn_paths, max_plies)
+    entries = sorted(
+        (key, encode_move(move), min(count, 0xFFFF))
+        for (key, move), count in counts.items()
+        if count >= min_count
+    )
+    with open(output, 'wb') as f:
+        for key, move, weight in entries:
+            f.write(ENTRY.pack(key, move, weight, 0))
+    return len(entries)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an opening book from PGN files')
+    parser.add_argument('pgn', nargs='+', help='The PGN files to build the book from')
+    parser.add_argument('output', help='The path to write the book to')
+    parser.add_argument(
+        '--plies',
+        default=20,
+        type=int,
+        help='The number of plies of each game to add to the book',
+    )
+    parser.add_argument(
+        '--min-count',
+        default=1,
+        type=int,
+        help='Leave out moves that were played fewer times than this in a position',
+    )
+    args = parser.parse_args()
+    written = build_book(args.pgn, args.output, args.plies, args.min_count)
+    print(f'Wrote {written} entries to {args.output}')
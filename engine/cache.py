@@ -0,0 +1,93 @@
+"""
+A persistent cache of the best moves found in positions, shared across games.
+
+The cache is an SQLite database, so several processes (e.g. several play.py
+instances or the orchestrator's games) can read and write it at the same time.
+Entries are keyed by the Zobrist hash of the position and the engine that
+searched it, and the least recently used entries are evicted once the cache
+grows past its maximum size.
+"""
+import sqlite3
+import time
+
+
+def _signed(key: int) -> int:
+    # SQLite integers are signed 64-bit
+    return key - 2**64 if key >= 2**63 else key
+
+
+class MoveCache:
+    """
+    :param path: The path to the cache database. Created if it doesn't exist.
+    :param max_entries: The number of entries to keep before evicting the least recently used ones
+    """
+    # How many new entries are stored between checks of the cache size
+    EVICT_INTERVAL = 100
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        # Used from the threads play.py runs blocking calls in, one at a time
+        self.connection = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        # Write-ahead logging lets readers and a writer in other processes work concurrently
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS moves ('
+            'key INTEGER NOT NULL, '
+            'engine TEXT NOT NULL, '
+            'depth INTEGER NOT NULL, '
+            'move TEXT NOT NULL, '
+            'last_used REAL NOT NULL, '
+            'PRIMARY KEY (key, engine))'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS moves_last_used ON moves (last_used)')
+        self.puts = 0
+
+    def get(self, key: int, engine: str, depth: int) -> tuple[str, int] | None:
+        """
+        Returns the cached best move in UCI format and the depth it was found at,
+        if the position was searched by engine to at least depth. Returns None otherwise.
+        """
+        row = self.connection.execute(
+            'SELECT move, depth FROM moves WHERE key = ? AND engine = ? AND depth >= ?',
+            (_signed(key), engine, depth)
+        ).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            'UPDATE moves SET last_used = ? WHERE key = ? AND engine = ?',
+            (time.time(), _signed(key), engine)
+        )
+        return row[0], row[1]
+
+    def put(self, key: int, engine: str, depth: int, move: str) -> None:
+        """
+        Stores the best move found by engine at depth. An entry that was
+        searched deeper is not replaced.
+        """
+        self.connection.execute(
+            'INSERT INTO moves (key, engine, depth, move, last_used) VALUES (?, ?, ?, ?, ?) '
+            'ON CONFLICT (key, engine) DO UPDATE SET '
+            'depth = excluded.depth, move = excluded.move, last_used = excluded.last_used '
+            'WHERE excluded.depth >= moves.depth',
+            (_signed(key), engine, depth, move, time.time())
+        )
+        self.puts += 1
+        if self.puts % self.EVICT_INTERVAL == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the cache holds at most max_entries.
+        """
+        count, = self.connection.execute('SELECT COUNT(*) FROM moves').fetchone()
+        if count > self.max_entries:
+            self.connection.execute(
+                'DELETE FROM moves WHERE rowid IN '
+                '(SELECT rowid FROM moves ORDER BY last_used LIMIT ?)',
+                (count - self.max_entries,)
+            )
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,267 @@
+"""
+Fits the angle tables of controller/controller.ino to the angles measured
+on a few squares, so that the rest of the squares don't have to be
+measured by hand.
+
+Two models can be fitted by least squares -
+
+- "surface" fits a polynomial in the file and rank of the square to each
+  servo's angle. It needs no measurements of the arm, only at least as many
+  measured squares as the polynomial has terms (6 for the default degree 2).
+- "kinematic" corrects the geometry of kinematics.py - the position and
+  angle of the board, the heights of the gripper, and the servo offsets -
+  until the angles it solves for match the measured ones. It needs the link
+  lengths and the servo directions to be measured, but extrapolates better
+  to squares far from the measured ones.
+
+Fit the tables to the angles captured with tests/measure_square_coordinates.py by running -
+
+    python engine/calibration.py hover_angles.txt lower_angles.txt -o angles.h
+"""
+import argparse
+from itertools import combinations_with_replacement
+import re
+import sys
+
+import numpy as np
+
+from kinematics import Geometry, angle_tables, c_array, load_geometry, save_geometry, solve, square_name, square_points
+
+
+SAMPLE_REGEX = re.compile(r'^\s*([a-hA-H][1-8])\s*-\s*\[([^\]]*)\]')
+TABLE_ROW_REGEX = re.compile(r'^\s*\{([^}]*)\}')
+
+
+def read_samples(path: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reads measured angles from a file written by tests/measure_square_coordinates.py.
+    Lines are either "A1 - [84.00, 58.00, 19.00, 137.00]", or "{84.00,58.00,19.00,137.00}"
+    with the n-th line holding the angles of the n-th square (a1, a2, ..., h8).
+    Squares without angles are skipped.
+
+    :return: A 2-tuple of the indices of the measured squares, and their (n, 4) angles
+    """
+    indices, angles = [], []
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            match = SAMPLE_REGEX.match(line)
+            if match:
+                square, values = match.group(1).lower(), match.group(2)
+                index = (ord(square[0]) - ord('a')) * 8 + int(square[1]) - 1
+            else:
+                match = TABLE_ROW_REGEX.match(line)
+                if not match:
+                    continue
+                index, values = line_number, match.group(1)
+            values = [float(value) for value in values.split(',') if value.strip()]
+            if len(values) == 4:
+                indices.append(index)
+                angles.append(values)
+    return np.array(indices, dtype=int), np.array(angles, dtype=float).reshape(-1, 4)
+
+
+class SurfaceModel:
+    """
+    A polynomial of the file and rank of a square for each servo's angle.
+
+    :param degree: The highest total power of the terms of the polynomial
+    """
+    def __init__(self, degree: int = 2):
+        self.degree = degree
+        # All products of up to degree of (file, rank), i.e. 1, f, r, f^2, fr, r^2, ...
+        self.terms = [
+            powers for order in range(degree + 1)
+            for powers in combinations_with_replacement(range(2), order)
+        ]
+        self.coefficients = None
+
+    def features(self, indices: np.ndarray) -> np.ndarray:
+        # Files and ranks are scaled to [-1, 1] to keep the least squares problem well conditioned
+        coordinates = np.stack([indices // 8, indices % 8], axis=-1) / 3.5 - 1
+        return np.stack([np.prod(coordinates[:, list(powers)], axis=1) for powers in self.terms], axis=1)
+
+    def fit(self, indices: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        """
+        Fits the model to the measured angles of the squares with the given
+        indices. Returns the residuals of the measurements, i.e. the fitted
+        minus the measured angles.
+
+        :raises ValueError: If fewer squares were measured than the model has terms
+        """
+        if len(indices) < len(self.terms):
+            raise ValueError(f'A surface of degree {self.degree} needs at least {len(self.terms)} measured squares, got {len(indices)}')
+        self.coefficients, *_ = np.linalg.lstsq(self.features(indices), angles, rcond=None)
+        return self.predict(indices) - angles
+
+    def predict(self, indices: np.ndarray) -> np.ndarray:
+        return self.features(indices) @ self.coefficients
+
+    def cross_validate(self, indices: np.ndarray, angles: np.ndarray) -> np.ndarray:
+        """
+        Returns the leave-one-out residuals, i.e. for every measured square the
+        error of a model fitted to all the other squares. These estimate the
+        error on the squares that were not measured better than the residuals
+        of the fit do.
+        """
+        features = self.features(indices)
+        # The leave-one-out residual of a linear least squares fit is its residual / (1 - leverage)
+        hat = features @ np.linalg.pinv(features)
+        residuals = hat @ angles - angles
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return residuals / (1 - np.diag(hat))[:, None]
+
+
+# The fields of Geometry corrected by fit_geometry
+FITTED_FIELDS = ['origin', 'board_angle', 'hover_height', 'grab_height', 'servo_offsets']
+
+
+def _to_vector(geometry: Geometry) -> np.ndarray:
+    return np.hstack([np.ravel(getattr(geometry, name)) for name in FITTED_FIELDS]).astype(float)
+
+
+def _from_vector(geometry: Geometry, vector: np.ndarray) -> Geometry:
+    vector = vector.tolist()
+    return geometry._replace(
+        origin=tuple(vector[0:2]),
+        board_angle=vector[2],
+        hover_height=vector[3],
+        grab_height=vector[4],
+        servo_offsets=tuple(vector[5:9]),
+    )
+
+
+def kinematic_residuals(geometry: Geometry, samples: list[tuple[np.ndarray, np.ndarray]]) -> list[np.ndarray]:
+    """
+    Returns the angles solved for with geometry minus the measured angles,
+    for samples given as (indices, angles) of the hover and the grab points.
+    """
+    points = square_points(geometry)
+    return [
+        solve(geometry, points[kind, indices])[0] - angles
+        for kind, (indices, angles) in enumerate(samples)
+    ]
+
+
+def fit_geometry(
+    geometry: Geometry,
+    samples: list[tuple[np.ndarray, np.ndarray]],
+    iterations: int = 100
+) -> Geometry:
+    """
+    Corrects the position and angle of the board, the hover and grab heights,
+    and the servo offsets of geometry with the Levenberg-Marquardt method,
+    so that the angles solved for match the measured ones.
+
+    :param geometry: The measured geometry to start from
+    :param samples: The (indices, angles) of the measured hover points and grab points
+    :raises ValueError: If a measured point can't be reached from the starting geometry
+    """
+    def residuals(vector):
+        return np.concatenate([r.ravel() for r in kinematic_residuals(_from_vector(geometry, vector), samples)])
+
+    vector = _to_vector(geometry)
+    current = residuals(vector)
+    if not np.isfinite(current).all():
+        raise ValueError('Some measured squares can\'t be reached with the starting geometry')
+    damping = 1e-3
+    for _ in range(iterations):
+        # Forward differences, with steps of about 0.01 mm or 0.01 degrees
+        jacobian = np.empty((len(current), len(vector)))
+        for column in range(len(vector)):
+            step = np.zeros_like(vector)
+            step[column] = 1e-2
+            jacobian[:, column] = (residuals(vector + step) - current) / 1e-2
+        jacobian = np.nan_to_num(jacobian)
+
+        normal = jacobian.T @ jacobian
+        gradient = jacobian.T @ current
+        while damping < 1e10:
+            change = np.linalg.solve(normal + damping * np.diag(np.diag(normal) + 1e-9), -gradient)
+            candidate = residuals(vector + change)
+            if np.isfinite(candidate).all() and candidate @ candidate < current @ current:
+                break
+            damping *= 10
+        else:
+            break
+        improvement = current @ current - candidate @ candidate
+        vector, current = vector + change, candidate
+        damping = max(damping / 10, 1e-9)
+        if improvement < 1e-10 * max(current @ current, 1e-12):
+            break
+    return _from_vector(geometry, vector)
+
+
+def report(name: str, indices: np.ndarray, residuals: np.ndarray) -> None:
+    """
+    Prints the residuals of every measured square, and their RMS for every servo.
+    """
+    print(f'{name} residuals (fitted - measured, degrees)')
+    for index, residual in zip(indices, residuals):
+        print(f'  {square_name(index)}  ' + '  '.join(f'{value:7.2f}' for value in residual))
+    rms = np.sqrt(np.mean(residuals ** 2, axis=0))
+    print('  RMS ' + '  '.join(f'{value:7.2f}' for value in rms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fit the angle tables of controller.ino to the angles measured on a few squares')
+    parser.add_argument('hover', help='The measured hover angles')
+    parser.add_argument('grab', help='The measured grabbing (lower) angles')
+    parser.add_argument(
+        '-m',
+        '--model',
+        choices=['surface', 'kinematic'],
+        default='surface',
+        help='The model to fit. "kinematic" needs --geometry.',
+        dest='model'
+    )
+    parser.add_argument(
+        '--degree',
+        default=2,
+        type=int,
+        help='The degree of the polynomial of the surface model',
+        dest='degree'
+    )
+    parser.add_argument(
+        '-g',
+        '--geometry',
+        help='A geometry file (see kinematics.py) to start the kinematic model from',
+        dest='geometry'
+    )
+    parser.add_argument(
+        '--save-geometry',
+        help='The file to write the fitted geometry of the kinematic model to',
+        dest='save_geometry'
+    )
+    parser.add_argument('-o', '--output', help='The file to write the tables to. Printed if not given.', dest='output')
+    args = parser.parse_args()
+
+    samples = [read_samples(args.hover), read_samples(args.grab)]
+    tables = []
+    try:
+        if args.model == 'surface':
+            for (indices, angles), name in zip(samples, ['Hover', 'Grab']):
+                model = SurfaceModel(args.degree)
+                report(name, indices, model.fit(indices, angles))
+                report(f'{name} leave-one-out', indices, model.cross_validate(indices, angles))
+                tables.append(model.predict(np.arange(64)))
+        else:
+            geometry = fit_geometry(load_geometry(args.geometry) if args.geometry else Geometry(), samples)
+            for (indices, _), residuals, name in zip(samples, kinematic_residuals(geometry, samples), ['Hover', 'Grab']):
+                report(name, indices, residuals)
+            hover, grab, reachable = angle_tables(geometry)
+            if not reachable.all():
+                print('The fitted geometry can\'t reach every square', file=sys.stderr)
+                sys.exit(1)
+            tables = [hover, grab]
+            if args.save_geometry is not None:
+                save_geometry(geometry, args.save_geometry)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    output = c_array('hoverAngles', tables[0]) + '\n' + c_array('grabbingAngles', tables[1])
+    if args.output is None:
+        print(output, end='')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
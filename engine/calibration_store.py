@@ -0,0 +1,276 @@
+"""
+A binary file holding the hover and grabbing angles of every square, which
+is updated in place one square at a time while capturing angles with
+tests/measure_square_coordinates.py.
+
+The file starts with a 16 byte header - the magic bytes b'CHRMCAL\\0', and
+the format version and a reserved field as little-endian 32 bit integers -
+followed by a little-endian float32 array of shape (2, 64, 4), i.e. the
+hover and the grabbing angles of a1, a2, ..., h8, 4 servos each. Squares
+that have not been captured are NaN. Capturing a square rewrites only its
+16 bytes in the memory-mapped file, so a crash can't lose the rest of the
+table.
+
+Snapshots of the store are kept next to it, in <store>.snapshots/0001.cal,
+0002.cal, ..., and can be compared with each other and with the store -
+
+    python engine/calibration_store.py calibration.cal snapshot
+    python engine/calibration_store.py calibration.cal diff 1
+    python engine/calibration_store.py calibration.cal export -o angles.h
+"""
+import argparse
+import os
+import shutil
+import struct
+import sys
+
+import numpy as np
+
+from calibration import read_samples
+from kinematics import c_array, square_name
+
+
+MAGIC = b'CHRMCAL\0'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sII')
+SHAPE = (2, 64, 4)
+DTYPE = np.dtype('<f4')
+# The kinds of angles, in the order of the first axis of the table
+KINDS = ('hover', 'grab')
+
+
+def empty_table() -> np.ndarray:
+    return np.full(SHAPE, np.nan, dtype=DTYPE)
+
+
+def write_table(path: str, table: np.ndarray) -> None:
+    """
+    Writes a complete calibration file. The file is written next to path
+    and moved over it, so path always holds either the old or the new table.
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, 0))
+        f.write(np.asarray(table, dtype=DTYPE).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def check_header(path: str) -> None:
+    """
+    :raises ValueError: If path is not a calibration file of this version
+    """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+    size = os.path.getsize(path)
+    if len(header) < HEADER.size or HEADER.unpack(header)[0] != MAGIC:
+        raise ValueError(f'{path} is not a calibration file')
+    version = HEADER.unpack(header)[1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f'{path} has format version {version}, expected {FORMAT_VERSION}')
+    if size != HEADER.size + DTYPE.itemsize * np.prod(SHAPE):
+        raise ValueError(f'{path} has a size of {size} bytes, the table is damaged')
+
+
+def read_table(path: str) -> np.ndarray:
+    """
+    Reads the (2, 64, 4) table of a calibration file into memory.
+    """
+    check_header(path)
+    return np.fromfile(path, dtype=DTYPE, offset=HEADER.size).reshape(SHAPE)
+
+
+class CalibrationStore:
+    """
+    The angles of every square in a memory-mapped calibration file. The file is created if it doesn't exist.
+
+    :param path: The path of the calibration file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.snapshot_dir = path + '.snapshots'
+        if not os.path.exists(path):
+            write_table(path, empty_table())
+        check_header(path)
+        self.angles = np.memmap(path, dtype=DTYPE, mode='r+', offset=HEADER.size, shape=SHAPE)
+
+    def get(self, kind: str, index: int) -> np.ndarray | None:
+        """
+        Returns the 4 angles of a kind ("hover" or "grab") for the square with the given index, or None if it wasn't captured.
+        """
+        angles = self.angles[KINDS.index(kind), index]
+        return None if np.isnan(angles).any() else np.array(angles)
+
+    def set(self, kind: str, index: int, angles) -> None:
+        """
+        Stores the 4 angles of a kind for the square with the given index, and writes them to the file.
+        """
+        self.angles[KINDS.index(kind), index] = angles
+        self.angles.flush()
+
+    def clear(self, kind: str, index: int) -> None:
+        self.set(kind, index, np.nan)
+
+    def samples(self, kind: str) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the indices of the captured squares of a kind, and their (n, 4)
+        angles, in the form calibration.py fits the angle tables to.
+        """
+        table = np.array(self.angles[KINDS.index(kind)], dtype=float)
+        indices = np.flatnonzero(~np.isnan(table).any(axis=1))
+        return indices, table[indices]
+
+    def table(self) -> np.ndarray:
+        return np.array(self.angles)
+
+    def snapshot(self) -> int:
+        """
+        Copies the store to the next numbered snapshot, and returns its number.
+        """
+        self.angles.flush()
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        version = max(self.snapshots(), default=0) + 1
+        path = self.snapshot_path(version)
+        shutil.copyfile(self.path, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        return version
+
+    def snapshots(self) -> list[int]:
+        """
+        Returns the numbers of the snapshots of the store, oldest first.
+        """
+        if not os.path.isdir(self.snapshot_dir):
+            return []
+        return sorted(
+            int(name[:-4]) for name in os.listdir(self.snapshot_dir)
+            if name.endswith('.cal') and name[:-4].isdigit()
+        )
+
+    def snapshot_path(self, version: int) -> str:
+        return os.path.join(self.snapshot_dir, f'{version:04d}.cal')
+
+    def load_snapshot(self, version: int) -> np.ndarray:
+        """
+        :raises FileNotFoundError: If there is no snapshot with the given number
+        """
+        return read_table(self.snapshot_path(version))
+
+    def restore(self, version: int) -> None:
+        """
+        Replaces the angles in the store with those of a snapshot.
+        """
+        self.angles[:] = self.load_snapshot(version)
+        self.angles.flush()
+
+    def close(self) -> None:
+        self.angles.flush()
+        del self.angles
+
+
+def diff(old: np.ndarray, new: np.ndarray, threshold: float = 0.0) -> list[tuple[str, int, np.ndarray, np.ndarray]]:
+    """
+    Compares two tables of angles.
+
+    :param threshold: The largest change of any servo's angle, in degrees, that is not reported
+    :return: A list of (kind, square index, old angles, new angles) for the
+        squares that were captured in only one of the tables, or whose angles
+        changed by more than threshold
+    """
+    changes = []
+    old_missing = np.isnan(old).any(axis=2)
+    new_missing = np.isnan(new).any(axis=2)
+    changed = np.nan_to_num(np.abs(new - old)).max(axis=2) > threshold
+    for kind, index in zip(*np.nonzero((old_missing != new_missing) | (~old_missing & ~new_missing & changed))):
+        changes.append((KINDS[kind], int(index), old[kind, index], new[kind, index]))
+    return changes
+
+
+def export(table: np.ndarray) -> str:
+    """
+    Formats a complete table as the hoverAngles and grabbingAngles arrays of controller.ino.
+
+    :raises ValueError: If some squares were not captured
+    """
+    missing = [
+        f'{kind} {square_name(index)}' for kind, row in zip(KINDS, np.isnan(table).any(axis=2))
+        for index in np.flatnonzero(row)
+    ]
+    if missing:
+        raise ValueError(f'No angles for {", ".join(missing)}')
+    return (
+        '// Stores the servo angles for hovering above each square of the board\n'
+        '// in the format - {base angle, base-arm angle, arm-arm angle, gripper pitch}\n'
+        + c_array('hoverAngles', table[0])
+        + '\n// Stores the servo angles for grabbing the piece on each square of the\n'
+        '// board in the format - {base angle, base-arm angle, arm-arm angle, gripper pitch}\n'
+        + c_array('grabbingAngles', table[1])
+    )
+
+
+def format_angles(angles: np.ndarray) -> str:
+    if np.isnan(angles).any():
+        return '-'
+    return '{' + ','.join(f'{angle:.2f}' for angle in angles) + '}'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage a calibration store written by tests/measure_square_coordinates.py')
+    parser.add_argument('store', help='The calibration file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help='Fill the store from text files of captured angles')
+    import_parser.add_argument('hover', help='The captured hover angles')
+    import_parser.add_argument('grab', help='The captured grabbing (lower) angles')
+
+    commands.add_parser('snapshot', help='Save a numbered snapshot of the store')
+    commands.add_parser('list', help='List the snapshots of the store')
+
+    diff_parser = commands.add_parser('diff', help='Compare two snapshots, or a snapshot and the store')
+    diff_parser.add_argument('old', type=int, help='The number of the older snapshot')
+    diff_parser.add_argument('new', type=int, nargs='?', help='The number of the newer snapshot. The store if not given.')
+    diff_parser.add_argument(
+        '-t',
+        '--threshold',
+        default=0.0,
+        type=float,
+        help='Only show squares whose angles changed by more than this many degrees',
+        dest='threshold'
+    )
+
+    restore_parser = commands.add_parser('restore', help='Replace the angles in the store with those of a snapshot')
+    restore_parser.add_argument('version', type=int, help='The number of the snapshot')
+
+    export_parser = commands.add_parser('export', help='Write the angle tables of controller.ino')
+    export_parser.add_argument('-o', '--output', help='The file to write the tables to. Printed if not given.', dest='output')
+    args = parser.parse_args()
+
+    try:
+        store = CalibrationStore(args.store)
+        if args.command == 'import':
+            for kind, path in zip(KINDS, [args.hover, args.grab]):
+                for index, angles in zip(*read_samples(path)):
+                    store.angles[KINDS.index(kind), index] = angles
+            store.angles.flush()
+        elif args.command == 'snapshot':
+            print(f'Saved snapshot {store.snapshot()}')
+        elif args.command == 'list':
+            for version in store.snapshots():
+                captured = (~np.isnan(store.load_snapshot(version)).any(axis=2)).sum(axis=1)
+                print(f'{version:>4}  {captured[0]:>2} hover, {captured[1]:>2} grab')
+        elif args.command == 'diff':
+            new = store.table() if args.new is None else store.load_snapshot(args.new)
+            for kind, index, before, after in diff(store.load_snapshot(args.old), new, args.threshold):
+                print(f'{kind:<5} {square_name(index)}  {format_angles(before)} -> {format_angles(after)}')
+        elif args.command == 'restore':
+            store.restore(args.version)
+        elif args.command == 'export':
+            tables = export(store.table())
+            if args.output is None:
+                print(tables, end='')
+            else:
+                with open(args.output, 'w') as f:
+                    f.write(tables)
+    except (ValueError, FileNotFoundError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
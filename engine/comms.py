@@ -1,59 +1,522 @@
 """
 Communication module for communicating between the Arduino
 controller of the arm connected to a Serial port and the engine.
+
+The computer and the arm exchange binary frames, described in
+docs/protocol.md. Every frame carries a sequence number and a CRC, so
+frames damaged on the link are dropped and sent again, and every command
+sent to the arm is acknowledged as soon as it is received. The arm queues
+the commands it receives, so several commands can be outstanding at once.
 """
+from binascii import crc_hqx
+from collections import deque
 from math import log2
+import struct
+import threading
+import time
+from typing import NamedTuple
 
 import serial
 from chessengine.lookup_tables import pos_to_coords
 
 
-def get_socket(port: str, baud_rate: int, timeout: int = 120):
+PROTOCOL_VERSION = 1
+START_BYTE = 0xA5
+# start byte, version, payload length, sequence number, message type
+HEADER = struct.Struct('>BBBBB')
+CRC = struct.Struct('>H')
+MAX_PAYLOAD = 255
+
+# Message types
+MOVE = 0x01
+CAPTURE = 0x02
+RESET = 0x03
+BOARD = 0x04
+STATUS = 0x05
+ACK = 0x06
+SETPOINT = 0x07
+
+# Flags of SETPOINT frames
+SETPOINT_GRIPPER_CLOSED = 0x01
+SETPOINT_LAST = 0x02
+
+# Status codes, sent by the arm in STATUS and ACK frames
+STATUS_OK = 0x00
+STATUS_DONE = 0x01
+STATUS_QUEUE_FULL = 0x02
+STATUS_BAD_FRAME = 0x03
+STATUS_ILLEGAL = 0x04
+
+# Seconds to wait for an acknowledgement before sending a frame again
+ACK_TIMEOUT = 0.5
+MAX_ATTEMPTS = 5
+
+
+class ProtocolError(Exception):
+    """
+    Raised when the arm does not acknowledge a frame or rejects it.
+    """
+
+
+class Frame(NamedTuple):
+    type: int
+    sequence: int
+    payload: bytes = b''
+
+
+def crc16(data: bytes) -> int:
+    """
+    CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF).
+    """
+    return crc_hqx(data, 0xFFFF)
+
+
+def encode_frame(frame: Frame) -> bytes:
+    """
+    Encodes a frame as bytes. The CRC covers everything after the start byte.
+    """
+    if len(frame.payload) > MAX_PAYLOAD:
+        raise ValueError(f'Frame payload of {len(frame.payload)} bytes is too long')
+    data = HEADER.pack(START_BYTE, PROTOCOL_VERSION, len(frame.payload), frame.sequence, frame.type) + frame.payload
+    return data + CRC.pack(crc16(data[1:]))
+
+
+class FrameDecoder:
+    """
+    Decodes frames from a stream of bytes that may also contain lines of
+    text, such as the debugging output printed by the arm. Bytes that are
+    not part of a valid frame are returned as lines of text.
+    """
+    # Text without a line break is returned as a line once it is this long
+    MAX_LINE = 256
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.text = bytearray()
+
+    def feed(self, data: bytes) -> list[Frame | str]:
+        """
+        Adds data to the stream and returns the frames and lines of text completed by it.
+        """
+        self.buffer += data
+        decoded = []
+        while True:
+            start = self.buffer.find(START_BYTE)
+            if start < 0:
+                decoded.extend(self._add_text(self.buffer))
+                self.buffer.clear()
+                break
+            decoded.extend(self._add_text(self.buffer[:start]))
+            del self.buffer[:start]
+            if len(self.buffer) < HEADER.size:
+                break
+            _, version, length, sequence, message_type = HEADER.unpack_from(self.buffer)
+            if version != PROTOCOL_VERSION:
+                # Not a frame, e.g. a stray start byte. Resynchronize on the next one.
+                del self.buffer[0]
+                continue
+            end = HEADER.size + length + CRC.size
+            if len(self.buffer) < end:
+                break
+            crc, = CRC.unpack_from(self.buffer, end - CRC.size)
+            if crc != crc16(bytes(self.buffer[1:end - CRC.size])):
+                del self.buffer[0]
+                continue
+            decoded.append(Frame(message_type, sequence, bytes(self.buffer[HEADER.size:end - CRC.size])))
+            del self.buffer[:end]
+        return decoded
+
+    def _add_text(self, data: bytes) -> list[str]:
+        self.text += data
+        lines = []
+        while True:
+            end = self.text.find(b'\n')
+            if end < 0 and len(self.text) >= self.MAX_LINE:
+                end = self.MAX_LINE
+            if end < 0:
+                break
+            line = self.text[:end].decode('ascii', errors='replace').strip()
+            del self.text[:end + 1]
+            if line:
+                lines.append(line)
+        return lines
+
+
+class Ack(NamedTuple):
+    sequence: int
+    status: int
+
+
+class Done(NamedTuple):
+    sequence: int
+
+
+class Move(NamedTuple):
+    start: str
+    end: str
+
+
+class Occupancy(NamedTuple):
+    # One bit per square, numbered as in square_index
+    bits: int
+
+
+class Telemetry(NamedTuple):
+    line: str
+
+
+class Error(NamedTuple):
+    message: str
+
+
+def to_event(frame: Frame) -> Ack | Done | Move | Occupancy | Error | None:
+    """
+    Converts a frame received from the arm into an event. Returns None for
+    frames that are not valid.
+    """
+    if frame.type in (ACK, STATUS) and len(frame.payload) == 2:
+        sequence, status = frame.payload
+        if frame.type == ACK:
+            return Ack(sequence, status)
+        if status == STATUS_DONE:
+            return Done(sequence)
+        return Error(f'The arm reported status {status} for command {sequence}')
+    if frame.type == MOVE and len(frame.payload) == 2 and max(frame.payload) <= 63:
+        return Move(index_square(frame.payload[0]), index_square(frame.payload[1]))
+    if frame.type == BOARD and len(frame.payload) == 8:
+        return Occupancy(int.from_bytes(frame.payload, 'big'))
+    return None
+
+
+class ArmLink:
+    """
+    A connection to the arm over a serial port that sends and receives frames.
+
+    A background thread reads everything the arm sends as soon as it
+    arrives, and turns it into events - Ack and Done events for the commands
+    sent to the arm, Move, Occupancy and Error events for what the arm reports on
+    its own, and Telemetry events for any other line of text it prints.
+    Callers wait only for the events they need, with their own timeout,
+    and telemetry never blocks them.
+
+    Commands are numbered with sequence numbers and kept until the arm
+    acknowledges them, and sent again if it doesn't. Frames the arm sends on
+    its own are acknowledged in the same way.
+
+    :param socket: An open serial port
+    """
+    # Seconds a read blocks before checking for frames to send again
+    READ_TIMEOUT = 0.05
+    # The number of telemetry lines to keep
+    TELEMETRY_SIZE = 1000
+
+    def __init__(self, socket: serial.Serial):
+        self.socket = socket
+        self.port = socket.port
+        self.decoder = FrameDecoder()
+        self.sequence = 0
+        # Frames that were not acknowledged yet, as sequence -> [frame bytes, time sent, attempts]
+        self.unacknowledged: dict[int, list] = {}
+        # Commands that were acknowledged but not finished yet
+        self.in_progress: set[int] = set()
+        # Commands the arm rejected or never acknowledged, as sequence -> reason
+        self.failed: dict[int, str] = {}
+        # Events reported by the arm on its own, e.g. the opponent's moves
+        self.events: list[Move | Occupancy | Error] = []
+        # The latest lines of telemetry, oldest first. Old lines are dropped.
+        self.telemetry: deque[Telemetry] = deque(maxlen=self.TELEMETRY_SIZE)
+        # The sequence numbers of the last frames the arm sent on its own, to
+        # skip the ones it sends again because their acknowledgement was lost
+        self.seen = deque(maxlen=64)
+        # Set if reading from the port failed, and raised to every caller after that
+        self.error: Exception | None = None
+        self.closed = False
+        # Counters for timing the game, see timing.py
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.resends = 0
+        self.changed = threading.Condition()
+        self.reader = threading.Thread(target=self._read, name=f'arm-reader-{self.port}', daemon=True)
+        self.reader.start()
+
+    def send(self, message_type: int, payload: bytes = b'', done: bool = True) -> int:
+        """
+        Sends a command to the arm without waiting for it to be acknowledged.
+        Returns the sequence number of the command.
+
+        :param done: False for commands the arm does not report as done, which
+            are finished as soon as they are acknowledged
+        """
+        with self.changed:
+            if message_type == RESET:
+                # The arm drops its queued commands, so they will never finish
+                self.unacknowledged.clear()
+                self.in_progress.clear()
+            sequence = self.sequence
+            self.sequence = (self.sequence + 1) % 256
+            data = encode_frame(Frame(message_type, sequence, payload))
+            self.unacknowledged[sequence] = [data, time.monotonic(), 1]
+            if done:
+                self.in_progress.add(sequence)
+            self.failed.pop(sequence, None)
+            self._write(data)
+        return sequence
+
+    def wait_ack(self, sequence: int, timeout: float = None) -> None:
+        """
+        Blocks until the arm acknowledges the command with the given sequence number.
+
+        :raises ProtocolError: If the arm rejected the command or never acknowledged it
+        :raises TimeoutError: If timeout seconds passed first
+        """
+        self._wait(lambda: self._check(sequence) and sequence not in self.unacknowledged, timeout)
+
+    def wait_done(self, sequence: int = None, timeout: float = None) -> None:
+        """
+        Blocks until the arm finishes the command with the given sequence
+        number, or all outstanding commands if sequence is None.
+
+        :raises ProtocolError: If the arm rejected the command or never acknowledged it
+        :raises TimeoutError: If timeout seconds passed first
+        """
+        if sequence is None:
+            self._wait(lambda: not self.in_progress, timeout)
+        else:
+            self._wait(lambda: self._check(sequence) and sequence not in self.in_progress, timeout)
+
+    def next_event(self, *event_types: type, timeout: float = None) -> Move | Occupancy | Error:
+        """
+        Blocks until the arm reports an event of one of the given types
+        (Move, Occupancy or Error), and returns the oldest one.
+
+        :raises TimeoutError: If timeout seconds passed first
+        """
+        found = []
+
+        def find():
+            for index, event in enumerate(self.events):
+                if isinstance(event, event_types):
+                    found.append(self.events.pop(index))
+                    return True
+            return False
+
+        self._wait(find, timeout)
+        return found[0]
+
+    def discard_events(self, *event_types: type) -> int:
+        """
+        Drops the events of the given types that were reported so far, e.g.
+        the snapshots taken while the arm was making its own move. Returns
+        the number of events dropped.
+        """
+        with self.changed:
+            kept = [event for event in self.events if not isinstance(event, event_types)]
+            dropped = len(self.events) - len(kept)
+            self.events[:] = kept
+        return dropped
+
+    def wait_error(self) -> Exception:
+        """
+        Blocks until reading from the port fails, and returns the error.
+        """
+        with self.changed:
+            while self.error is None:
+                self.changed.wait()
+            return self.error
+
+    def _check(self, sequence: int) -> bool:
+        if sequence in self.failed:
+            raise ProtocolError(self.failed.pop(sequence))
+        return True
+
+    def _wait(self, condition, timeout: float = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.changed:
+            while not condition():
+                if self.error is not None:
+                    raise self.error
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(f'Timed out waiting for the arm on {self.port}')
+                self.changed.wait(remaining)
+
+    def _read(self) -> None:
+        """
+        Reads from the port until the link is closed. Runs on the reader thread.
+        """
+        while not self.closed:
+            try:
+                data = self.socket.read(max(self.socket.in_waiting, 1))
+                decoded = self.decoder.feed(data)
+                with self.changed:
+                    self.bytes_received += len(data)
+                    for item in decoded:
+                        if isinstance(item, str):
+                            self.telemetry.append(Telemetry(item))
+                        else:
+                            self._handle(item)
+                    self._resend()
+                    self.changed.notify_all()
+            except (serial.SerialException, OSError, TypeError) as e:
+                # TypeError is raised by pyserial when the port is closed during a read
+                if self.closed:
+                    break
+                with self.changed:
+                    self.error = e
+                    self.changed.notify_all()
+                break
+
+    def _handle(self, frame: Frame) -> None:
+        event = to_event(frame)
+        if event is None:
+            return
+        if isinstance(event, Ack):
+            if event.sequence not in self.unacknowledged:
+                # A duplicate acknowledgement of a frame that was sent again
+                return
+            if event.status == STATUS_QUEUE_FULL:
+                # Send the command again once the arm had time to make room
+                self.unacknowledged[event.sequence][1:] = [time.monotonic(), 1]
+                return
+            del self.unacknowledged[event.sequence]
+            if event.status != STATUS_OK:
+                self.in_progress.discard(event.sequence)
+                self.failed[event.sequence] = f'The arm rejected command {event.sequence} with status {event.status}'
+            return
+
+        self._write(encode_frame(Frame(ACK, frame.sequence, bytes([frame.sequence, STATUS_OK]))))
+        if frame.sequence in self.seen:
+            return
+        self.seen.append(frame.sequence)
+        if isinstance(event, Done):
+            # A finished command is also acknowledged, in case its ACK was lost
+            self.unacknowledged.pop(event.sequence, None)
+            self.in_progress.discard(event.sequence)
+        else:
+            self.events.append(event)
+
+    def _resend(self) -> None:
+        now = time.monotonic()
+        for sequence, pending in list(self.unacknowledged.items()):
+            data, sent, attempts = pending
+            if now - sent < ACK_TIMEOUT:
+                continue
+            if attempts >= MAX_ATTEMPTS:
+                del self.unacknowledged[sequence]
+                self.in_progress.discard(sequence)
+                self.failed[sequence] = f'The arm did not acknowledge command {sequence} after {attempts} attempts'
+                continue
+            self._write(data)
+            self.resends += 1
+            pending[1:] = [now, attempts + 1]
+
+    def _write(self, data: bytes) -> None:
+        # Called with self.changed held
+        self.socket.write(data)
+        self.bytes_sent += len(data)
+
+    def close(self) -> None:
+        self.closed = True
+        self.reader.join(timeout=1)
+        self.socket.close()
+
+
+def get_socket(port: str, baud_rate: int, recorder=None) -> ArmLink:
     """
     Creates a socket connection at the given port at the given baud rate,
-    opens the socket, and returns the socket.
+    opens the socket, and returns a link to the arm through the socket.
+
+    :param recorder: A recording.Recorder to record everything sent and received on the port
     """
     try:
-        socket = serial.Serial(port=port, baudrate=baud_rate, timeout=timeout)
+        socket = serial.Serial(port=port, baudrate=baud_rate, timeout=ArmLink.READ_TIMEOUT)
     except serial.SerialException as e:
         print(f'Could not connect to {port}. Check the port name and baud rate and try again.')
         raise
-    return socket
+    if recorder is not None:
+        socket = recorder.tap_serial(socket)
+    return ArmLink(socket)
 
 
-def send_move_to_arm(socket: serial.Serial, move: tuple[str, str] | tuple[int, int], capture: bool) -> None:
+def square_index(square: str) -> int:
     """
-    Encodes the move to bytes and sends move to arm.
-    The move is encoded in the format "<start_square>,<end_square>"
-    or "<start_square>x<end_square>" in case the end square was captured.
+    Returns the index of a square (e.g. "e2") in the arm's angle tables,
+    i.e. 8 * file + rank, counted from 0 for the a file and the first rank.
+    """
+    return (ord(square[0].lower()) - ord('a')) * 8 + int(square[1]) - 1
+
+
+def index_square(index: int) -> str:
+    """
+    Returns the name of the square with the given index in the arm's angle tables.
+    """
+    return chr(ord('a') + index // 8) + str(index % 8 + 1)
+
+
+def move_indices(move: tuple[str, str] | tuple[int, int]) -> tuple[int, int]:
+    """
+    Returns the indices of the start and end squares of a move, given as
+    square names or as chessengine's bitboard positions.
     """
     if isinstance(move[0], int) and isinstance(move[1], int):
-        _ = (pos_to_coords[int(log2(move[0]))].lower(), pos_to_coords[int(log2(move[1]))].lower())
-    else:
-        _ = (move[0], move[1])
+        move = (pos_to_coords[int(log2(move[0]))], pos_to_coords[int(log2(move[1]))])
+    return square_index(move[0]), square_index(move[1])
+
+
+def send_move_to_arm(
+    socket: ArmLink,
+    move: tuple[str, str] | tuple[int, int],
+    capture: bool,
+    wait: bool = True,
+    timeout: float = None
+) -> int:
+    """
+    Sends move to the arm in a MOVE frame, or a CAPTURE frame in case the
+    end square was captured, and waits for the arm to acknowledge it.
+    Returns the sequence number of the frame.
+
+    If wait is True, blocks until the arm made the move, for at most
+    timeout seconds. Otherwise wait_for_arm can be called to wait for it.
+    """
+    sequence = socket.send(CAPTURE if capture else MOVE, bytes(move_indices(move)))
+    socket.wait_ack(sequence)
+    if wait:
+        wait_for_arm(socket, sequence, timeout)
+    return sequence
+
+
+def wait_for_arm(socket: ArmLink, sequence: int = None, timeout: float = None) -> None:
+    """
+    Blocks until the arm reports that it finished the command with the given
+    sequence number, or all the commands it was sent if sequence is None.
+
+    :raises TimeoutError: If the arm did not finish within timeout seconds
+    """
+    socket.wait_done(sequence, timeout)
 
-    if capture:
-        move_str = f'{_[0]}x{_[1]}'
-    else:
-        move_str = f'{_[0]},{_[1]}'
-    socket.write(move_str.encode())
-    # Wait for acknowledgement from the arm that the move was made
-    response = socket.read(9).decode()
+
+def reset_arm(socket: ArmLink) -> None:
+    """
+    Asks the arm to abandon its current and queued moves and return to its
+    reset position. Does not wait for the arm to acknowledge it.
+    """
+    socket.send(RESET)
 
 
-def get_move_from_arm(socket: serial.Serial) -> tuple[str, str]:
+def get_move_from_arm(socket: ArmLink, timeout: float = None) -> tuple[str, str]:
     """
     Blocks for the arm to send a move to the computer and
     returns the move converted to the appropriate format
     depending on the engine.
 
-    Expects the arm to send the move by sending the start
-    square first, then the end square.
+    Expects the arm to send the move in a MOVE frame.
+
+    :raises ProtocolError: If the arm reports an error instead, e.g. because
+        it could not detect the move
+    :raises TimeoutError: If no move was received within timeout seconds
     """
-    try:
-        start = socket.read(2).decode()
-        end = socket.read(2).decode()
-    except ValueError:
-        print('\n\nReceived invalid data from the arm')
-        raise
-    return start, end
+    event = socket.next_event(Move, Error, timeout=timeout)
+    if isinstance(event, Error):
+        print(f'\n\nThe arm reported an error - {event.message}')
+        raise ProtocolError(event.message)
+    return event.start, event.end
@@ -0,0 +1,449 @@
+"""
+Emulates the arm's controller on a pseudo-terminal, so that play.py and
+orchestrator.py can be run without the arm, e.g. to load test them or to
+play long games unattended.
+
+The emulator speaks the frame protocol of docs/protocol.md like
+controller/controller.ino - it acknowledges and queues MOVE and CAPTURE
+commands, plays SETPOINT trajectories, and reports each command as done
+after the time the arm would take to make it, worked out by running the
+controller's smoothing on its angle tables. It can also play the opponent,
+reporting a random legal reply after every move of the arm like the reed
+switch board does.
+
+Start it, and pass the port it prints to play.py -
+
+    python engine/emulator.py --opponent white --speed 0
+    python engine/play.py -c /dev/pts/3 -f auto
+
+The emulator keeps running across games. A RESET ends the current game,
+and the next game starts from the initial position. Pseudo-terminals are
+not available on Windows.
+"""
+import argparse
+from functools import lru_cache
+from math import log2
+import os
+import random
+import re
+import select
+import sys
+import time
+import tty
+
+import numpy as np
+from chessengine import Board
+from chessengine.lookup_tables import coords_to_pos, pos_to_coords
+
+import comms
+from comms import Frame, FrameDecoder, encode_frame
+from occupancy import from_bitboard
+from trajectory import CAPTURE_BIN, CAPTURE_HOVER_ANGLES, CAPTURE_LOWER_ANGLES, RESET_ANGLES, SETPOINT_PAYLOAD
+
+
+# Constants of controller.ino
+INTERPOLATION_FACTOR = 0.07
+# The base-arm servo moves at half the interpolation factor of the others
+JOINT_FACTORS = np.array([1, 0.5, 1, 1]) * INTERPOLATION_FACTOR
+LOOP_TIME = 0.005
+MOVE_SETTLE_DELAY = 0.3
+QUEUE_SIZE = 4
+SETPOINT_BUFFER_SIZE = 16
+SETPOINT_PERIOD = 0.02
+STREAM_TIMEOUT = 3.0
+RESET_RESEND_WINDOW = 3.0
+# The row of the reset pose in Emulator.hover
+RESET = CAPTURE_BIN + 1
+
+
+def read_controller_tables(path: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reads the hoverAngles and grabbingAngles tables from controller.ino.
+
+    :return: A 2-tuple of the (64, 4) hover and grabbing angles
+    """
+    with open(path) as f:
+        source = f.read()
+    tables = []
+    for name in ['hoverAngles', 'grabbingAngles']:
+        body = re.search(name + r'\[64\]\[4\]\s*=\s*\{(.*?)\};', source, re.S).group(1)
+        rows = re.findall(r'\{([^{}]*)\}', body)
+        tables.append(np.array([[float(angle) for angle in row.split(',')] for row in rows]))
+    return tables[0], tables[1]
+
+
+def smoothing_time(start: tuple, end: tuple) -> float:
+    """
+    Returns the number of seconds controller.ino's smoothing takes to move the servos from start to end.
+    """
+    return _smoothing_steps(tuple(map(float, start)), tuple(map(float, end))) * LOOP_TIME
+
+
+@lru_cache(maxsize=None)
+def _smoothing_steps(start: tuple, end: tuple) -> int:
+    # A port of updateSmoothedAngles and transitionComplete, for all 4 servos at once
+    cached, target = np.array(start), np.array(end)
+    previous = cached.copy()
+    direction = np.sign(target - cached)
+    halfway = (target + cached) / 2
+    steps = 0
+    while np.any(np.abs(target - previous) >= 0.1):
+        first_half = np.where(direction > 0, previous < halfway, previous > halfway)
+        speed = np.where(first_half, np.abs(previous - cached), np.abs(target - previous)) * JOINT_FACTORS
+        speed = np.where(first_half & (speed == 0), JOINT_FACTORS, speed)
+        previous = previous + direction * speed
+        steps += 1
+    return steps
+
+
+class Emulator:
+    """
+    An emulated controller on the master side of a pseudo-terminal.
+
+    :param hover: The (64, 4) hover angles of the arm
+    :param grab: The (64, 4) grabbing angles of the arm
+    :param speed: How fast to run compared to the real arm, e.g. 2 for twice
+        as fast. 0 reports every command as done as soon as it arrives.
+    :param opponent: The side the emulated opponent plays, or None to not reply to the arm's moves
+    :param think_time: Seconds the opponent takes to reply, before dividing by speed
+    :param occupancy: If True, report the opponent's moves as the occupied squares in BOARD frames
+        instead of MOVE frames, like a board that only reports its reed switches, and the occupied
+        squares after every move of the arm
+    :param seed: Seeds the opponent's choice of moves
+    """
+    def __init__(
+        self,
+        hover: np.ndarray,
+        grab: np.ndarray,
+        speed: float = 1.0,
+        opponent: str | None = None,
+        think_time: float = 1.0,
+        occupancy: bool = False,
+        seed: int = None
+    ):
+        self.hover = np.vstack([hover, CAPTURE_HOVER_ANGLES, RESET_ANGLES])
+        self.grab = np.vstack([grab, CAPTURE_LOWER_ANGLES])
+        self.speed = speed
+        self.opponent = opponent
+        self.think_time = think_time
+        self.occupancy = occupancy
+        self.random = random.Random(seed)
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.decoder = FrameDecoder()
+
+        # Frames sent and not acknowledged yet, as sequence -> [frame bytes, time sent]
+        self.outbox: dict[int, list] = {}
+        self.sequence = 0
+        self.seen: set[int] = set()
+        # The sequence number of the last RESET and when it arrived, to tell a RESET sent again from a new one
+        self.last_reset = None
+        self.last_reset_at = 0.0
+        # MOVE and CAPTURE commands waiting for the arm, as (sequence, capture, start, end)
+        self.queue: list[tuple[int, bool, int, int]] = []
+        self.setpoints: list[tuple[int, bytes]] = []
+        # Whether a trajectory is being played, its number, the highest index of its setpoints received, and when
+        self.streaming = False
+        self.stream_trajectory = None
+        self.last_index = -1
+        self.setpoint_received_at = 0.0
+        # The command the arm is making, and when it will be done
+        self.current = None
+        self.done_at = None
+        # The piece the arm holds while playing setpoints, and the pieces it moved
+        self.holding = None
+        self.transfers: list[tuple[int, int]] = []
+        self.reply_at = None
+        self.commands = 0
+        self.new_game()
+
+    def new_game(self) -> None:
+        self.board = Board('white')
+        self.queue.clear()
+        self.setpoints.clear()
+        self.streaming = False
+        self.stream_trajectory = None
+        self.last_index = -1
+        self.current = None
+        self.holding = None
+        self.transfers.clear()
+        self.reply_at = None
+        if self.opponent == 'white':
+            self.reply_at = self.later(self.think_time)
+
+    def later(self, seconds: float) -> float:
+        return time.monotonic() + (seconds / self.speed if self.speed > 0 else 0)
+
+    def run(self) -> None:
+        """
+        Runs the emulator until it is interrupted.
+        """
+        while True:
+            readable, _, _ = select.select([self.master], [], [], LOOP_TIME)
+            if readable:
+                for item in self.decoder.feed(os.read(self.master, 1024)):
+                    if isinstance(item, Frame):
+                        self.handle(item)
+            self.step()
+
+    def write(self, data: bytes) -> None:
+        os.write(self.master, data)
+
+    def send(self, message_type: int, payload: bytes) -> None:
+        data = encode_frame(Frame(message_type, self.sequence, payload))
+        self.outbox[self.sequence] = [data, time.monotonic()]
+        self.sequence = (self.sequence + 1) % 256
+        self.write(data)
+
+    def ack(self, sequence: int, status: int) -> None:
+        self.write(encode_frame(Frame(comms.ACK, sequence, bytes([sequence, status]))))
+
+    def mark_seen(self, sequence: int) -> None:
+        self.seen.add(sequence)
+        # Forget the sequence numbers from half a cycle ago, as controller.ino does
+        self.seen.discard((sequence + 128) % 256)
+
+    def handle(self, frame: Frame) -> None:
+        if frame.type == comms.ACK:
+            if frame.payload:
+                self.outbox.pop(frame.payload[0], None)
+            return
+        if frame.type == comms.RESET:
+            now = time.monotonic()
+            if frame.sequence == self.last_reset and frame.sequence in self.seen and now - self.last_reset_at < RESET_RESEND_WINDOW:
+                # Already carried out, and moves may have been queued since
+                self.ack(frame.sequence, comms.STATUS_OK)
+                self.send(comms.STATUS, bytes([frame.sequence, comms.STATUS_DONE]))
+                return
+            self.last_reset, self.last_reset_at = frame.sequence, now
+            self.seen.clear()
+            self.mark_seen(frame.sequence)
+            self.ack(frame.sequence, comms.STATUS_OK)
+            self.send(comms.STATUS, bytes([frame.sequence, comms.STATUS_DONE]))
+            self.new_game()
+            return
+        if frame.type not in (comms.MOVE, comms.CAPTURE, comms.SETPOINT, comms.BOARD):
+            self.ack(frame.sequence, comms.STATUS_BAD_FRAME)
+            return
+        if frame.sequence in self.seen:
+            self.ack(frame.sequence, comms.STATUS_OK)
+            return
+
+        if frame.type == comms.BOARD:
+            # A request for a fresh snapshot of the occupied squares
+            self.mark_seen(frame.sequence)
+            self.ack(frame.sequence, comms.STATUS_OK)
+            self.report_occupancy()
+            return
+
+        if frame.type == comms.SETPOINT:
+            if len(frame.payload) != SETPOINT_PAYLOAD.size:
+                self.ack(frame.sequence, comms.STATUS_ILLEGAL)
+                return
+            *_, trajectory, index = SETPOINT_PAYLOAD.unpack(frame.payload)
+            if index == 0 and not self.streaming:
+                # The first setpoint of a new trajectory
+                self.stream_trajectory, self.last_index = trajectory, -1
+                self.setpoints.clear()
+            elif trajectory != self.stream_trajectory and not self.streaming:
+                # The first setpoint of this trajectory was lost, so have this one sent again later
+                self.ack(frame.sequence, comms.STATUS_QUEUE_FULL)
+                return
+            elif trajectory != self.stream_trajectory or index <= self.last_index:
+                # Sent again after later setpoints, so it is stale
+                self.mark_seen(frame.sequence)
+                self.ack(frame.sequence, comms.STATUS_OK)
+                return
+            if len(self.setpoints) >= SETPOINT_BUFFER_SIZE:
+                self.ack(frame.sequence, comms.STATUS_QUEUE_FULL)
+                return
+            self.setpoints.append((frame.sequence, frame.payload))
+            self.last_index = index
+            self.setpoint_received_at = time.monotonic()
+        else:
+            if len(frame.payload) != 2 or max(frame.payload) > 63:
+                self.ack(frame.sequence, comms.STATUS_ILLEGAL)
+                return
+            if len(self.queue) >= QUEUE_SIZE:
+                self.ack(frame.sequence, comms.STATUS_QUEUE_FULL)
+                return
+            self.queue.append((frame.sequence, frame.type == comms.CAPTURE, frame.payload[0], frame.payload[1]))
+        self.mark_seen(frame.sequence)
+        self.ack(frame.sequence, comms.STATUS_OK)
+
+    def step(self) -> None:
+        """
+        Advances the emulated arm and opponent to the current time.
+        """
+        now = time.monotonic()
+        for pending in self.outbox.values():
+            if now - pending[1] >= comms.ACK_TIMEOUT:
+                self.write(pending[0])
+                pending[1] = now
+
+        if self.streaming and not self.setpoints and now - self.setpoint_received_at > STREAM_TIMEOUT:
+            # The rest of the trajectory never arrived
+            self.streaming = False
+        if self.current is None and self.setpoints and (self.speed == 0 or now >= (self.done_at or 0)):
+            self.play_setpoint()
+        elif self.current is None and self.queue:
+            self.current = self.queue.pop(0)
+            self.done_at = self.later(self.command_time(*self.current[1:]))
+        elif self.current is not None and now >= self.done_at:
+            sequence, capture, start, end = self.current
+            self.current = None
+            self.send(comms.STATUS, bytes([sequence, comms.STATUS_DONE]))
+            self.apply_command(start, end)
+
+        if self.reply_at is not None and now >= self.reply_at and self.current is None and not self.queue:
+            self.reply_at = None
+            self.reply()
+
+    def command_time(self, capture: bool, start: int, end: int) -> float:
+        """
+        Returns the seconds the arm takes to make a MOVE or CAPTURE command,
+        visiting its squares in the order controller.ino does.
+        """
+        destinations = [end, CAPTURE_BIN, start, end] if capture else [start, end]
+        pose = self.hover[RESET]
+        total = 0.0
+        for index in destinations:
+            for target in [self.hover[index], self.grab[index], self.hover[index]]:
+                total += smoothing_time(pose, target)
+                pose = target
+            total += MOVE_SETTLE_DELAY
+        return total + smoothing_time(pose, self.hover[RESET])
+
+    def play_setpoint(self) -> None:
+        sequence, payload = self.setpoints.pop(0)
+        *centidegrees, flags, _, _ = SETPOINT_PAYLOAD.unpack(payload)
+        self.streaming = True
+        self.done_at = self.later(SETPOINT_PERIOD)
+        closed = bool(flags & comms.SETPOINT_GRIPPER_CLOSED)
+        if closed != (self.holding is not None):
+            # The gripper closed on or let go of a piece, at the nearest grabbing pose
+            place = int(np.argmin(np.abs(self.grab - np.array(centidegrees) / 100).sum(axis=1)))
+            if closed:
+                self.holding = place
+            else:
+                self.transfers.append((self.holding, place))
+                self.holding = None
+        if flags & comms.SETPOINT_LAST:
+            self.streaming = False
+            self.send(comms.STATUS, bytes([sequence, comms.STATUS_DONE]))
+            self.apply_transfers()
+
+    def position(self, index: int) -> int:
+        return 2 ** coords_to_pos[comms.index_square(index).upper()]
+
+    def apply_command(self, start: int, end: int) -> None:
+        # The rook of a castle is sent as its own command, after the king already moved it
+        if self.board.identify_piece_at(self.position(start))[0] is not None:
+            self.board.move(self.position(start), self.position(end))
+        self.after_arm_move()
+
+    def apply_transfers(self) -> None:
+        """
+        Makes the move that the pieces carried along a streamed trajectory add up to.
+        """
+        on_board = [(source, target) for source, target in self.transfers if source < CAPTURE_BIN and target < CAPTURE_BIN]
+        self.transfers.clear()
+        if on_board:
+            # The king's transfer is the move of a castle, and moves the rook with it
+            kings = [transfer for transfer in on_board if self.board.identify_piece_at(self.position(transfer[0]))[1] == 'kings']
+            start, end = (kings or on_board)[0]
+            self.board.move(self.position(start), self.position(end))
+        self.after_arm_move()
+
+    def after_arm_move(self) -> None:
+        if self.occupancy:
+            self.report_occupancy()
+        if self.opponent is not None and not self.queue and self.reply_at is None:
+            self.reply_at = self.later(self.think_time)
+
+    def reply(self) -> None:
+        """
+        Makes a random move for the opponent and reports it. The moves are
+        chosen from chessengine's moves, which don't check for check.
+        """
+        moves = self.board.get_moves(self.opponent)
+        if not moves:
+            print('The opponent has no moves left', file=sys.stderr)
+            return
+        start, end, _ = self.random.choice(moves)
+        if self.occupancy:
+            if self.board.all_pieces & end:
+                # The captured piece is lifted off the board first
+                self.report_occupancy(self.board.all_pieces & ~end)
+            self.board.move(start, end)
+            self.report_occupancy()
+            return
+        self.board.move(start, end)
+        start_square = pos_to_coords[int(log2(start))]
+        end_square = pos_to_coords[int(log2(end))]
+        self.send(comms.MOVE, bytes([comms.square_index(start_square), comms.square_index(end_square)]))
+
+    def report_occupancy(self, bitboard: int = None) -> None:
+        """
+        Sends the occupied squares, by default of the current position, in a BOARD frame.
+        """
+        bitboard = self.board.all_pieces if bitboard is None else bitboard
+        self.send(comms.BOARD, from_bitboard(bitboard).to_bytes(8, 'big'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulate the arm\'s controller on a pseudo-terminal')
+    parser.add_argument(
+        '--calibration',
+        help='A calibration store to take the angle tables from (see calibration_store.py). The tables in controller.ino if not given.',
+        dest='calibration'
+    )
+    parser.add_argument(
+        '--controller',
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'controller', 'controller.ino'),
+        help='The controller sketch to read the angle tables from',
+        dest='controller'
+    )
+    parser.add_argument(
+        '--speed',
+        default=1.0,
+        type=float,
+        help='How many times faster than the real arm to run. 0 makes every move at once.',
+        dest='speed'
+    )
+    parser.add_argument(
+        '--opponent',
+        choices=['white', 'black'],
+        help='The side to play random legal moves for, like an opponent on the reed switch board',
+        dest='opponent'
+    )
+    parser.add_argument(
+        '--think-time',
+        default=1.0,
+        type=float,
+        help='The number of seconds the opponent takes to reply, divided by --speed',
+        dest='think_time'
+    )
+    parser.add_argument(
+        '--occupancy',
+        action='store_true',
+        help='Report the opponent\'s moves as the occupied squares in BOARD frames instead of MOVE frames, for play.py -f board',
+        dest='occupancy'
+    )
+    parser.add_argument('--seed', type=int, help='Seed the opponent\'s moves to replay a game', dest='seed')
+    args = parser.parse_args()
+
+    if args.calibration is not None:
+        from calibration_store import CalibrationStore
+        table = CalibrationStore(args.calibration).table().astype(float)
+        hover, grab = table[0], table[1]
+    else:
+        hover, grab = read_controller_tables(args.controller)
+    emulator = Emulator(hover, grab, args.speed, args.opponent, args.think_time, args.occupancy, args.seed)
+    print(emulator.port, flush=True)
+    try:
+        emulator.run()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+"""
+A journal of the game, so that a game can be resumed after play.py crashes
+or the arm's USB link drops.
+
+One record is appended to the journal for every ply, as one line of JSON,
+e.g. -
+
+    {"time": 1715340000.1, "ply": 3, "engine_side": "white", "side": "white", "move": "g1f3", "capture": false, "fen": "rnbqkbnr/pp1ppppp/8/2p5/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 0 2", "hash": "5e0c8a1f9b2d4e67", "duration": 2.314}
+
+and a record of ply 0 with the start position when a game starts. Every
+record holds the whole position after its ply as a FEN, so a game is
+resumed from the last record alone, which is read from the end of the
+file. Resuming takes as long after 200 plies as after 2.
+
+The journal is synced to the disk after every record, with fdatasync
+where the platform has it, as it is only written to once per ply. A
+record that was cut short by a crash is removed when the game is resumed.
+"""
+import json
+import os
+import time
+
+
+# The number of bytes read at a time when looking for the last record from the end of the journal
+BLOCK_SIZE = 4096
+
+
+def sync(fd: int) -> None:
+    """
+    Flushes the data written to a file to the disk.
+    """
+    if hasattr(os, 'fdatasync'):
+        # Skips flushing metadata, e.g. the modification time, that isn't needed to read the journal back
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class Journal:
+    """
+    Appends records to a journal. The file is created if it doesn't exist.
+
+    :param path: The path of the journal
+    """
+    def __init__(self, path: str):
+        self.file = open(path, 'ab')
+
+    def append(self, ply: int, **fields) -> None:
+        """
+        Appends the record of a ply and syncs it to the disk. Fields that are None are left out.
+        """
+        record = {'time': round(time.time(), 3), 'ply': ply}
+        record.update((name, value) for name, value in fields.items() if value is not None)
+        self.file.write(json.dumps(record, separators=(', ', ': ')).encode() + b'\n')
+        self.file.flush()
+        sync(self.file.fileno())
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def recover(path: str) -> dict | None:
+    """
+    Returns the last complete record of a journal, or None if the journal
+    is empty or doesn't exist. Removes a record that was cut short after
+    it, so that records appended afterwards start on a new line.
+    """
+    try:
+        f = open(path, 'rb+')
+    except FileNotFoundError:
+        return None
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        tail = b''
+        while position > 0:
+            size = min(BLOCK_SIZE, position)
+            position -= size
+            f.seek(position)
+            tail = f.read(size) + tail
+            lines = tail.split(b'\n')
+            # The first line may be the end of an earlier line, unless the start of the file was reached.
+            # The last line is empty, or a record that was cut short.
+            first = 0 if position == 0 else 1
+            for number in range(len(lines) - 2, first - 1, -1):
+                try:
+                    record = json.loads(lines[number])
+                except ValueError:
+                    continue
+                if not isinstance(record, dict):
+                    continue
+                record_end = position + sum(len(line) + 1 for line in lines[:number + 1])
+                if record_end < end:
+                    f.truncate(record_end)
+                return record
+    return None
@@ -0,0 +1,234 @@
+"""
+Inverse kinematics of the arm, for generating the angle tables in
+controller/controller.ino from the geometry of the arm and the board
+instead of capturing every square by hand.
+
+The arm is modelled as a base that turns about a vertical axis, an upper
+arm and a forearm that move in a vertical plane, and a gripper that is
+kept pointing straight down. Positions are in millimeters, in the frame of
+the arm's base: x to the right, y away from the arm, and z up from the
+surface of the board, with the base's axis at x = y = 0.
+
+Every function works on arrays of any shape, so all 64 squares are solved
+for at once. Generate the tables for the controller by running -
+
+    python engine/kinematics.py geometry.json
+
+where geometry.json holds the fields of Geometry to change from their
+defaults, e.g. {"upper_arm": 210, "origin": [-180, 110]}.
+"""
+import argparse
+import json
+import sys
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Geometry(NamedTuple):
+    # Lengths of the links, in mm
+    upper_arm: float = 260.0
+    forearm: float = 240.0
+    # From the wrist joint to the tips of the gripper
+    gripper: float = 90.0
+    # Height of the shoulder joint above the board
+    shoulder_height: float = 90.0
+    # The center of a1 in the base frame
+    origin: tuple[float, float] = (-175.0, 90.0)
+    square_size: float = 50.0
+    # The direction of the files (from a to h) in the base frame, in degrees from the x axis
+    board_angle: float = 0.0
+    # Heights of the tips of the gripper above the board when hovering over and grabbing a piece
+    hover_height: float = 60.0
+    grab_height: float = 15.0
+    # The servo angle at a joint angle of 0, and the direction the servo turns
+    # in (1 or -1), for the base, base-arm, arm-arm and gripper pitch servos
+    servo_offsets: tuple[float, float, float, float] = (0.0, 0.0, 0.0, 90.0)
+    servo_directions: tuple[float, float, float, float] = (1.0, 1.0, 1.0, 1.0)
+    # The range of angles every servo can turn to
+    servo_min: float = 0.0
+    servo_max: float = 180.0
+
+
+def load_geometry(path: str) -> Geometry:
+    """
+    Reads a geometry from a JSON file. Fields that are not in the file keep their defaults.
+    """
+    with open(path) as f:
+        fields = json.load(f)
+    return Geometry(**{name: tuple(value) if isinstance(value, list) else value for name, value in fields.items()})
+
+
+def save_geometry(geometry: Geometry, path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump(geometry._asdict(), f, indent=4)
+
+
+def square_centers(geometry: Geometry) -> np.ndarray:
+    """
+    Returns the (x, y) center of every square as a (64, 2) array, in the
+    order of the controller's tables, i.e. a1, a2, ..., a8, b1, ..., h8.
+    """
+    index = np.arange(64)
+    files, ranks = index // 8, index % 8
+    angle = np.radians(geometry.board_angle)
+    along_files = np.array([np.cos(angle), np.sin(angle)])
+    along_ranks = np.array([-np.sin(angle), np.cos(angle)])
+    return (
+        np.asarray(geometry.origin)
+        + geometry.square_size * (files[:, None] * along_files + ranks[:, None] * along_ranks)
+    )
+
+
+def square_points(geometry: Geometry) -> np.ndarray:
+    """
+    Returns the points above every square the tips of the gripper should
+    move to, as a (2, 64, 3) array of the hover points and the grab points.
+    """
+    centers = square_centers(geometry)
+    heights = np.array([geometry.hover_height, geometry.grab_height])
+    points = np.empty((2, 64, 3))
+    points[:, :, :2] = centers
+    points[:, :, 2] = heights[:, None]
+    return points
+
+
+def joint_to_servo(geometry: Geometry, joints: np.ndarray) -> np.ndarray:
+    """
+    Converts joint angles in radians to servo angles in degrees. The last axis holds the 4 joints.
+    """
+    return np.asarray(geometry.servo_offsets) + np.asarray(geometry.servo_directions) * np.degrees(joints)
+
+
+def servo_to_joint(geometry: Geometry, servos: np.ndarray) -> np.ndarray:
+    """
+    Converts servo angles in degrees to joint angles in radians. The last axis holds the 4 servos.
+    """
+    return np.radians((np.asarray(servos) - np.asarray(geometry.servo_offsets)) / np.asarray(geometry.servo_directions))
+
+
+def solve(geometry: Geometry, points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Solves for the servo angles that move the tips of the gripper to points,
+    with the elbow up and the gripper pointing down. The last axis of points
+    holds (x, y, z).
+
+    :return: A 2-tuple of the servo angles in degrees, with a last axis of the
+        base, base-arm, arm-arm and gripper pitch servos, and a boolean array
+        that is False for the points the arm can't reach. The angles of points
+        that can't be reached are NaN or outside of the servos' range.
+    """
+    points = np.asarray(points, dtype=float)
+    x, y, z = points[..., 0], points[..., 1], points[..., 2]
+    l1, l2 = geometry.upper_arm, geometry.forearm
+
+    base = np.arctan2(y, x)
+    # The wrist is straight above the tips of the gripper
+    reach = np.hypot(x, y)
+    height = z + geometry.gripper - geometry.shoulder_height
+    distance_squared = reach ** 2 + height ** 2
+    distance = np.sqrt(distance_squared)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # The interior angle between the upper arm and the forearm
+        cos_elbow = (l1 ** 2 + l2 ** 2 - distance_squared) / (2 * l1 * l2)
+        elbow = np.arccos(cos_elbow)
+        # The elevation of the upper arm above horizontal
+        cos_shoulder = (l1 ** 2 + distance_squared - l2 ** 2) / (2 * l1 * distance)
+        shoulder = np.arctan2(height, reach) + np.arccos(cos_shoulder)
+    # Turn the gripper so that it points down, whatever the angle of the forearm
+    pitch = np.pi / 2 - shoulder - elbow
+
+    servos = joint_to_servo(geometry, np.stack([base, shoulder, elbow, pitch], axis=-1))
+    reachable = (
+        (np.abs(cos_elbow) <= 1)
+        & (np.abs(cos_shoulder) <= 1)
+        & np.all((servos >= geometry.servo_min) & (servos <= geometry.servo_max), axis=-1)
+    )
+    return servos, reachable
+
+
+def forward(geometry: Geometry, servos: np.ndarray) -> np.ndarray:
+    """
+    Returns the position of the tips of the gripper for the given servo
+    angles in degrees, i.e. the inverse of solve. The last axis of servos
+    holds the 4 servos, and the last axis of the result holds (x, y, z).
+    """
+    base, shoulder, elbow, pitch = np.moveaxis(servo_to_joint(geometry, servos), -1, 0)
+    # The angle of the forearm and of the gripper above horizontal
+    forearm = shoulder + elbow - np.pi
+    gripper = forearm + pitch
+    reach = (
+        geometry.upper_arm * np.cos(shoulder)
+        + geometry.forearm * np.cos(forearm)
+        + geometry.gripper * np.cos(gripper)
+    )
+    z = (
+        geometry.shoulder_height
+        + geometry.upper_arm * np.sin(shoulder)
+        + geometry.forearm * np.sin(forearm)
+        + geometry.gripper * np.sin(gripper)
+    )
+    return np.stack([reach * np.cos(base), reach * np.sin(base), z], axis=-1)
+
+
+def angle_tables(geometry: Geometry) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Solves for the hover angles and the grabbing angles of every square in one call.
+
+    :return: A 3-tuple of the (64, 4) hover angles, the (64, 4) grabbing
+        angles, and a (2, 64) boolean array of the points that can be reached
+    """
+    servos, reachable = solve(geometry, square_points(geometry))
+    return servos[0], servos[1], reachable
+
+
+def c_array(name: str, angles: np.ndarray) -> str:
+    """
+    Formats a (64, 4) table of angles as a C array in the layout of the
+    tables in controller.ino, with one rank of the board per line.
+
+    :raises ValueError: If any angle is not a number
+    """
+    if np.isnan(angles).any():
+        raise ValueError(f'{name} has angles that are not numbers')
+    rows = []
+    for start in range(0, 64, 8):
+        rows.append('  ' + ','.join(
+            '{' + ','.join(f'{angle:.2f}' for angle in square) + '}'
+            for square in angles[start:start + 8]
+        ))
+    return f'const int {name}[64][4] = {{\n' + ',\n'.join(rows) + '\n};\n'
+
+
+def square_name(index: int) -> str:
+    return chr(ord('a') + index // 8) + str(index % 8 + 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the angle tables of controller.ino from the geometry of the arm')
+    parser.add_argument('geometry', help='A JSON file with the fields of Geometry to change from their defaults')
+    parser.add_argument('-o', '--output', help='The file to write the tables to. Printed if not given.', dest='output')
+    args = parser.parse_args()
+
+    hover, grab, reachable = angle_tables(load_geometry(args.geometry))
+    if not reachable.all():
+        for kind, row in zip(['hover', 'grab'], reachable):
+            unreachable = [square_name(index) for index in np.flatnonzero(~row)]
+            if unreachable:
+                print(f'Can\'t reach the {kind} point of {", ".join(unreachable)}', file=sys.stderr)
+        sys.exit(1)
+
+    tables = (
+        '// Stores the servo angles for hovering above each square of the board\n'
+        '// in the format - {base angle, base-arm angle, arm-arm angle, gripper pitch}\n'
+        + c_array('hoverAngles', hover)
+        + '\n// Stores the servo angles for grabbing the piece on each square of the\n'
+        '// board in the format - {base angle, base-arm angle, arm-arm angle, gripper pitch}\n'
+        + c_array('grabbingAngles', grab)
+    )
+    if args.output is None:
+        print(tables, end='')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(tables)
@@ -0,0 +1,275 @@
+"""
+Plays engines against each other without the arm, to choose the engine and
+depth to play with.
+
+Players are given as engine:depth, or stockfish:depth:skill to also set
+stockfish's skill level, e.g. -
+
+    python engine/match.py default:3 default:4 stockfish:8:5 -p path/to/stockfish -g 10 -o results
+
+Every pair of players plays --games games, taking turns with the white
+pieces, and the games are played in parallel on a process pool. The moves
+are written to results.csv, one row per move with the time it took and the
+nodes searched, and the games and a summary of every player to
+results.json. The summary of every player, with its score and the
+distribution of its move times, is also printed.
+
+chessengine does not check for check, and cannot promote pawns. A player
+whose move leaves its own king in check loses, which is how a player
+that is checkmated loses against chessengine. Games in which a pawn is
+promoted are stopped without a result.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import csv
+from itertools import combinations
+import json
+import os
+import random
+import time
+from typing import NamedTuple
+
+from chessengine import Board
+
+import stockfishpy
+from timing import percentile
+from utils import MoveHistory, positions_from_uci, uci_move, zobrist_hash
+
+
+class Player(NamedTuple):
+    # "default" for chessengine, or "stockfish"
+    engine: str
+    depth: int
+    # Stockfish's skill level from 0 to 20, or None for stockfish's default
+    skill: int | None = None
+
+    @property
+    def name(self) -> str:
+        return ':'.join(str(field) for field in self if field is not None)
+
+
+def parse_player(text: str) -> Player:
+    """
+    Parses a player given as engine:depth or stockfish:depth:skill.
+    """
+    fields = text.split(':')
+    if fields[0] not in ('default', 'stockfish') or not 2 <= len(fields) <= (3 if fields[0] == 'stockfish' else 2):
+        raise argparse.ArgumentTypeError(f'{text} is not a player, e.g. default:4 or stockfish:12:5')
+    try:
+        return Player(fields[0], *(int(field) for field in fields[1:]))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'The depth and skill of {text} have to be integers')
+
+
+class CountingBoard(Board):
+    """
+    A Board that counts the moves made on it, i.e. the nodes its searches visit.
+    """
+    nodes = 0
+
+    def move(self, *args, **kwargs):
+        self.nodes += 1
+        return super().move(*args, **kwargs)
+
+
+class ChessengineSide:
+    """
+    A side played by chessengine, which keeps its own board like play.py does.
+    """
+    def __init__(self, player: Player, side: str):
+        self.depth = player.depth
+        self.board = CountingBoard(side)
+
+    def find_move(self, history: MoveHistory) -> tuple[str, dict]:
+        nodes = self.board.nodes
+        _, (start, end, _) = self.board.search_forward(self.depth)
+        return uci_move(start, end), {'depth': self.depth, 'nodes': self.board.nodes - nodes}
+
+    def made(self, move: str) -> None:
+        self.board.move(*positions_from_uci(move))
+
+    def close(self) -> None:
+        pass
+
+
+class StockfishSide:
+    """
+    A side played by its own stockfish process.
+    """
+    def __init__(self, player: Player, path: str):
+        param = {} if player.skill is None else {'Skill Level': player.skill}
+        self.engine = stockfishpy.Engine(path, player.depth, param)
+        self.engine.ucinewgame()
+
+    def find_move(self, history: MoveHistory) -> tuple[str, dict]:
+        self.engine.setposition(history.command)
+        result = self.engine.bestmove()
+        return result['bestmove'], {'depth': result['depth'], 'nodes': result['nodes']}
+
+    def made(self, move: str) -> None:
+        pass
+
+    def close(self) -> None:
+        self.engine.quit()
+
+
+def in_check(board: Board, side: str) -> bool:
+    opponent = 'black' if side == 'white' else 'white'
+    king = board.get_bitboard(side, 'kings')
+    return any(end == king for _, end, _ in board.get_moves(opponent))
+
+
+def play_game(white: Player, black: Player, path: str, max_plies: int = 200, random_plies: int = 0, seed: int = 0) -> dict:
+    """
+    Plays one game. Runs in a worker process.
+
+    :param path: The path to the stockfish executable
+    :param max_plies: The number of plies after which the game is a draw
+    :param random_plies: The number of random moves to start the game with, so that games between the same players differ
+    :param seed: Seeds the random moves
+    :return: The players, the result ("1-0", "0-1", "1/2-1/2", or "*" if the
+        game was stopped), the reason the game ended, and every move with
+        the time it took, the depth searched and the nodes visited
+    """
+    board = Board('white')
+    history = MoveHistory()
+    sides = {}
+    for side, player in [('white', white), ('black', black)]:
+        sides[side] = ChessengineSide(player, side) if player.engine == 'default' else StockfishSide(player, path)
+    repetitions = {}
+    moves = []
+    result, reason = '1/2-1/2', 'move limit'
+    side = 'white'
+    try:
+        for ply in range(1, max_plies + 1):
+            opponent = 'black' if side == 'white' else 'white'
+            started = time.perf_counter()
+            if ply <= random_plies:
+                start, end, _ = random.Random(seed * 1000 + ply).choice(board.get_moves(side))
+                move, fields = uci_move(start, end), {}
+            else:
+                move, fields = sides[side].find_move(history)
+            elapsed = time.perf_counter() - started
+            if move == '(none)':
+                # Stockfish has no legal move
+                result, reason = ('1/2-1/2', 'stalemate') if not in_check(board, side) else ('0-1' if side == 'white' else '1-0', 'checkmate')
+                break
+
+            start, end = positions_from_uci(move)
+            _, piece, _ = board.identify_piece_at(start)
+            moves.append({
+                'ply': ply,
+                'player': (white if side == 'white' else black).name,
+                'side': side,
+                'move': move,
+                'time': round(elapsed, 6),
+                **fields,
+                'nps': round(fields['nodes'] / elapsed) if fields.get('nodes') and elapsed > 0 else None,
+            })
+            board.move(start, end)
+            history.append(move)
+            for player_side in sides.values():
+                player_side.made(move)
+
+            if in_check(board, side):
+                result, reason = '0-1' if side == 'white' else '1-0', 'king left in check'
+                break
+            if piece == 'pawns' and move[3] in '18':
+                result, reason = '*', 'promotion'
+                break
+            key = zobrist_hash(board, opponent)
+            repetitions[key] = repetitions.get(key, 0) + 1
+            if repetitions[key] == 3:
+                result, reason = '1/2-1/2', 'repetition'
+                break
+            side = opponent
+    except Exception as e:
+        # e.g. chessengine failing to undo a move during its search
+        result, reason = '*', f'error: {e!r}'
+    finally:
+        for player_side in sides.values():
+            player_side.close()
+    return {'white': white.name, 'black': black.name, 'result': result, 'reason': reason, 'plies': len(moves), 'moves': moves}
+
+
+def summarize(players: list[Player], games: list[dict]) -> dict[str, dict]:
+    """
+    Returns every player's number of games, wins, draws and losses, its
+    score, the 50th, 95th and 99th percentile and the maximum of its move
+    times, and its mean nodes per second. Games without a result are not scored.
+    """
+    summary = {}
+    for player in players:
+        scored = [game for game in games if player.name in (game['white'], game['black']) and game['result'] != '*']
+        points = [
+            0.5 if game['result'] == '1/2-1/2' else float((game['result'] == '1-0') == (game['white'] == player.name))
+            for game in scored
+        ]
+        times = [move['time'] for game in games for move in game['moves'] if move['player'] == player.name and 'depth' in move]
+        speeds = [move['nps'] for game in games for move in game['moves'] if move['player'] == player.name and move.get('nps')]
+        summary[player.name] = {
+            'games': len(scored),
+            'wins': points.count(1.0),
+            'draws': points.count(0.5),
+            'losses': points.count(0.0),
+            'score': sum(points) / len(points) if points else None,
+            'moves': len(times),
+            'p50': percentile(times, 0.5) if times else None,
+            'p95': percentile(times, 0.95) if times else None,
+            'p99': percentile(times, 0.99) if times else None,
+            'max': max(times) if times else None,
+            'nps': round(sum(speeds) / len(speeds)) if speeds else None,
+        }
+    return summary
+
+
+def write_results(path: str, players: list[Player], games: list[dict], summary: dict[str, dict]) -> None:
+    """
+    Writes the moves to path.csv, and the games and the summary to path.json.
+    """
+    with open(path + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, ['game', 'white', 'black', 'ply', 'player', 'side', 'move', 'time', 'depth', 'nodes', 'nps'])
+        writer.writeheader()
+        for number, game in enumerate(games):
+            for move in game['moves']:
+                writer.writerow({'game': number, 'white': game['white'], 'black': game['black'], **move})
+    with open(path + '.json', 'w') as f:
+        json.dump({'players': [player.name for player in players], 'summary': summary, 'games': games}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Play engines against each other without the arm')
+    parser.add_argument('players', nargs='+', type=parse_player, help='The players, e.g. default:4, stockfish:12 or stockfish:12:5 (depth 12, skill level 5)')
+    parser.add_argument('-p', '--path', default='stockfish/stockfish.exe', help='The path to the stockfish executable', dest='path')
+    parser.add_argument('-g', '--games', default=2, type=int, help='The number of games every pair of players plays', dest='games')
+    parser.add_argument('-w', '--workers', default=os.cpu_count(), type=int, help='The number of games played at the same time', dest='workers')
+    parser.add_argument('--max-plies', default=200, type=int, help='The number of plies after which a game is a draw', dest='max_plies')
+    parser.add_argument('--random-plies', default=0, type=int, help='Start every game with this many random moves, so that games between the same players differ', dest='random_plies')
+    parser.add_argument('-o', '--output', default='match', help='Write the results to this path with .csv and .json added', dest='output')
+    args = parser.parse_args()
+
+    if len(args.players) < 2:
+        parser.error('at least 2 players are needed')
+    pairings = [
+        (first, second) if number % 2 == 0 else (second, first)
+        for first, second in combinations(args.players, 2)
+        for number in range(args.games)
+    ]
+    games = [None] * len(pairings)
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = {
+            pool.submit(play_game, white, black, args.path, args.max_plies, args.random_plies, seed): seed
+            for seed, (white, black) in enumerate(pairings)
+        }
+        for future in as_completed(futures):
+            game = future.result()
+            games[futures[future]] = game
+            print(f'{game["white"]} - {game["black"]} {game["result"]} ({game["reason"]}, {game["plies"]} plies)')
+
+    summary = summarize(args.players, games)
+    write_results(args.output, args.players, games, summary)
+    print(f'\n{"player":<18}{"games":>6}{"score":>8}{"p50 (s)":>10}{"p95 (s)":>10}{"max (s)":>10}{"nodes/s":>10}')
+    for name, stats in summary.items():
+        score = f'{stats["score"]:.2f}' if stats['score'] is not None else '-'
+        times = [f'{stats[field]:.3f}' if stats[field] is not None else '-' for field in ('p50', 'p95', 'max')]
+        print(f'{name:<18}{stats["games"]:>6}{score:>8}{times[0]:>10}{times[1]:>10}{times[2]:>10}{stats["nps"] or "-":>10}')
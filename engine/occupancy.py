@@ -0,0 +1,153 @@
+"""
+Finds the opponent's move from snapshots of the occupied squares of the
+board, which the reed switches report in Board frames (see docs/protocol.md).
+
+A snapshot is compared to the board with bit operations. Every legal move
+of the opponent is turned into the occupancy it leaves behind, and the
+move whose occupancy equals the snapshot is the move that was made. Moves
+that change 3 or 4 squares, i.e. en passant and castling, are found in the
+same way as any other move.
+
+Captures by the same piece leave the same occupancy behind, e.g. Nxe5 and
+Nxd4 both only empty the knight's square, as does lifting the knight before
+it is put down. So a move is only accepted once every square it lifts a
+piece from was seen empty in a snapshot of the turn, since the captured
+piece is lifted off its square. If a snapshot still matches more than one
+move, a fresh snapshot is asked for, and the move is reported as an error
+if it is still ambiguous.
+"""
+from math import log2
+from typing import NamedTuple
+
+from chessengine import Board
+from chessengine.lookup_tables import coords_to_pos, pos_to_coords
+
+import comms
+from comms import ArmLink, Error, Occupancy, ProtocolError
+
+
+# The rook's move of each castle, by the king's move
+CASTLES = {
+    ('E1', 'G1'): ('H1', 'F1'),
+    ('E1', 'C1'): ('A1', 'D1'),
+    ('E8', 'G8'): ('H8', 'F8'),
+    ('E8', 'C8'): ('A8', 'D8'),
+}
+MASK = (1 << 64) - 1
+
+
+def to_bitboard(bits: int) -> int:
+    """
+    Converts the bits of a Board frame, numbered as in comms.square_index
+    (8 * file + rank), into a chessengine bitboard (8 * rank + file), by
+    flipping the bits about the a1-h8 diagonal.
+    """
+    for shift, mask in [(28, 0x0F0F0F0F00000000), (14, 0x3333000033330000), (7, 0x5500550055005500)]:
+        swap = mask & (bits ^ (bits << shift))
+        bits = (bits ^ swap ^ (swap >> shift)) & MASK
+    return bits
+
+
+def from_bitboard(bitboard: int) -> int:
+    """
+    Converts a chessengine bitboard into the bits of a Board frame.
+    """
+    # Flipping about the diagonal is its own inverse
+    return to_bitboard(bitboard)
+
+
+class Candidate(NamedTuple):
+    # chessengine positions of the move
+    start: int
+    end: int
+    # The occupied squares after the move, as a bitboard
+    occupied: int
+    # The squares a piece has to be lifted from to make the move
+    lifted: int
+
+
+def candidates(board: Board, side: str) -> list[Candidate]:
+    """
+    Returns every move side can make on board, with the occupancy it leaves behind.
+    """
+    occupied = board.all_pieces
+    result = []
+    for start, end, _ in board.get_moves(side):
+        _, piece, _ = board.identify_piece_at(start)
+        after = occupied & ~start | end
+        lifted = start | end & occupied
+        start_square = pos_to_coords[int(log2(start))]
+        end_square = pos_to_coords[int(log2(end))]
+        if piece == 'pawns' and start_square[0] != end_square[0] and not end & occupied:
+            # En passant - the captured pawn is next to the start square, on the end square's file
+            victim = 2 ** coords_to_pos[end_square[0] + start_square[1]]
+            after &= ~victim
+            lifted |= victim
+        if piece == 'kings' and (start_square, end_square) in CASTLES:
+            rook_start, rook_end = CASTLES[(start_square, end_square)]
+            after = after & ~2 ** coords_to_pos[rook_start] | 2 ** coords_to_pos[rook_end]
+            lifted |= 2 ** coords_to_pos[rook_start]
+        result.append(Candidate(start, end, after, lifted))
+    return result
+
+
+class MoveDetector:
+    """
+    Finds one move of side from the snapshots taken while it is made.
+
+    :param board: The position before the move
+    :param side: The side making the move
+    """
+    def __init__(self, board: Board, side: str):
+        self.occupied = board.all_pieces
+        self.candidates = candidates(board, side)
+        # The squares that were empty in any snapshot, and occupied before the move
+        self.lifted = 0
+
+    def feed(self, bits: int) -> list[Candidate]:
+        """
+        Adds a snapshot, given as the bits of a Board frame. Returns the moves
+        that could have led to it - none if the move is not finished yet,
+        and more than one if the snapshot is ambiguous.
+        """
+        snapshot = to_bitboard(bits)
+        self.lifted |= self.occupied & ~snapshot
+        # A capture whose captured piece wasn't lifted yet is only the moving piece in the hand
+        matches = [
+            candidate for candidate in self.candidates
+            if candidate.occupied == snapshot and not candidate.lifted & ~self.lifted
+        ]
+        if len(matches) > 1:
+            # Keep the moves that lift every piece that was seen lifted
+            narrowed = [candidate for candidate in matches if not self.lifted & ~candidate.lifted]
+            matches = narrowed or matches
+        return matches
+
+
+def get_move_from_board(socket: ArmLink, board: Board, side: str, timeout: float = None) -> tuple[str, str]:
+    """
+    Blocks until the snapshots of the board's occupancy show a move of side,
+    and returns its start and end squares, e.g. ("e2", "e4"). Asks for a
+    fresh snapshot once if a snapshot matches more than one move.
+
+    :raises ProtocolError: If the arm reports an error, or the move is ambiguous
+    :raises TimeoutError: If no move was seen within timeout seconds
+    """
+    detector = MoveDetector(board, side)
+    requested = False
+    while True:
+        event = socket.next_event(Occupancy, Error, timeout=timeout)
+        if isinstance(event, Error):
+            print(f'\n\nThe arm reported an error - {event.message}')
+            raise ProtocolError(event.message)
+        matches = detector.feed(event.bits)
+        if len(matches) == 1:
+            move = matches[0]
+            return pos_to_coords[int(log2(move.start))].lower(), pos_to_coords[int(log2(move.end))].lower()
+        if len(matches) > 1:
+            if requested:
+                moves = ', '.join(f'{pos_to_coords[int(log2(move.start))]}{pos_to_coords[int(log2(move.end))]}' for move in matches)
+                raise ProtocolError(f'The board could be showing any of the moves {moves}')
+            # The board may not have settled yet
+            socket.send(comms.BOARD, done=False)
+            requested = True
@@ -0,0 +1,312 @@
+"""
+Plays several games at once, one per arm, from a single process.
+
+Instead of every arm running its own play.py with its own stockfish, all
+games share a bounded pool of long-lived engine processes. A game borrows
+an idle engine for the length of one search, and games waiting for an
+engine are served in the order they asked, so every board gets its turn.
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+from chessengine import Board
+import comms
+from play import Game, handle_exit, run_blocking
+from search import timed_search
+import stockfishpy
+
+
+def _search(board: Board, depth: int, movetime: float = None) -> tuple[int, tuple[int, int, int], int]:
+    if movetime is None:
+        return *board.search_forward(depth), depth
+    return timed_search(board, movetime)
+
+
+class EnginePool:
+    """
+    A fixed number of stockfish processes shared between games.
+
+    :param size: The number of engine processes
+    :param path: The path to the stockfish executable
+    :param depth: The search depth of every engine
+    :param param: Options passed to every engine, see stockfishpy.Engine
+    """
+    def __init__(self, size: int, path: str, depth: int, param: dict = None):
+        self.size = size
+        self.path = path
+        self.depth = depth
+        self.param = param or {}
+        self.engines: list[stockfishpy.Engine] = []
+        self.idle: asyncio.Queue = asyncio.Queue()
+
+    async def start(self) -> None:
+        """
+        Starts all engine processes concurrently.
+        """
+        self.engines = await asyncio.gather(*(
+            run_blocking(stockfishpy.Engine, self.path, self.depth, self.param)
+            for _ in range(self.size)
+        ))
+        for engine in self.engines:
+            self.idle.put_nowait(engine)
+
+    async def bestmove(self, position: str, **limits) -> dict:
+        """
+        Searches the position, given as a 'position ...' command, on the next
+        idle engine and returns the result of Engine.bestmove. Takes the same
+        stop policy and limits as Engine.bestmove.
+        """
+        # Waiters on an asyncio.Queue are woken in the order they started waiting
+        engine = await self.idle.get()
+        try:
+            engine.setposition(position)
+            return await run_blocking(engine.bestmove, **limits)
+        finally:
+            self.idle.put_nowait(engine)
+
+    def close(self) -> None:
+        for engine in self.engines:
+            try:
+                engine.quit()
+            except OSError:
+                pass
+
+
+class PooledGame(Game):
+    """
+    A game that searches on a shared EnginePool (for stockfish) or process
+    pool (for chessengine) instead of owning its engine, and that logs
+    with the name of its port instead of redrawing the board.
+    """
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        socket,
+        board_side: str,
+        engine_pool: EnginePool | None,
+        search_pool: ProcessPoolExecutor | None
+    ):
+        super().__init__(args, socket, None, board_side)
+        self.engine_pool = engine_pool
+        self.search_pool = search_pool
+
+    def log(self, message: str) -> None:
+        print(f'[{self.socket.port}] {message}')
+
+    def show_board(self) -> None:
+        pass
+
+    async def search_chessengine(self) -> tuple[int, tuple[int, int, int], int]:
+        board = self.board.copy()
+        # The search only needs the current position, not the game's moves
+        board.moves = []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.search_pool, _search, board, self.args.depth, self.time_budget())
+
+    async def search_stockfish(self) -> dict:
+        return await self.engine_pool.bestmove(self.history.command, policy=self.stop_policy(), **self.search_limits())
+
+    async def engine_turn(self) -> None:
+        await super().engine_turn()
+        self.log(f'Played {self.history.moves[-1]}')
+
+
+async def run_game(game: PooledGame) -> None:
+    """
+    Runs a game, so that an error on one board doesn't stop the other games.
+    """
+    try:
+        await game.run()
+    except Exception as e:
+        game.log(f'Game stopped - {e.__class__.__name__}: {e}')
+
+
+async def run_games(args: argparse.Namespace) -> None:
+    engine_pool = None
+    search_pool = None
+    # Open every serial port while the engines start
+    opening = asyncio.gather(*(run_blocking(comms.get_socket, port, args.baud) for port in args.ports))
+    if args.engine == 'stockfish':
+        param = {'Hash': args.hash}
+        if args.syzygy is not None:
+            param['SyzygyPath'] = args.syzygy
+            if args.syzygy_limit is not None:
+                param['SyzygyProbeLimit'] = args.syzygy_limit
+        engine_pool = EnginePool(args.engines, args.path, args.depth, param)
+        await engine_pool.start()
+    else:
+        search_pool = ProcessPoolExecutor(max_workers=args.engines)
+    sockets = await opening
+
+    games = []
+    for socket, side in zip(sockets, args.sides):
+        board_side = 'black' if side == 'w' else 'white'
+        games.append(PooledGame(args, socket, board_side, engine_pool, search_pool))
+
+    try:
+        await asyncio.gather(*(run_game(game) for game in games))
+    finally:
+        if engine_pool is not None:
+            engine_pool.close()
+        if search_pool is not None:
+            search_pool.shutdown(cancel_futures=True)
+
+
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='charm-orchestrator', description='Play games on several arms at once')
+    parser.add_argument(
+        '-c',
+        '--ports',
+        nargs='+',
+        required=True,
+        help='The port names of the microcontrollers of all arms',
+        dest='ports'
+    )
+    parser.add_argument(
+        '-s',
+        '--sides',
+        nargs='+',
+        choices=['w', 'b'],
+        help='The side the opponent plays on each board, in the same order as --ports. Defaults to "w" for every board.',
+        dest='sides'
+    )
+    parser.add_argument(
+        '-e',
+        '--engine',
+        choices=['default', 'stockfish'],
+        default='default',
+        help='The chess engine to use. Can be "default" for using chessengine or "stockfish" for stockfish.',
+        dest='engine'
+    )
+    parser.add_argument(
+        '-n',
+        '--engines',
+        default=os.cpu_count() or 1,
+        type=int,
+        help='The number of engine processes shared by all games. Defaults to the number of CPU cores.',
+        dest='engines'
+    )
+    parser.add_argument(
+        '-d',
+        '--depth',
+        choices=range(1, 16),
+        default=4,
+        type=int,
+        help='Set the search depth. Can be between 1 and 15 (inclusive). Recommended depth for default engine is 4 or 5.',
+        dest='depth'
+    )
+    parser.add_argument(
+        '-t',
+        '--movetime',
+        type=float,
+        help='Search for this many seconds per move instead of to a fixed depth.',
+        dest='movetime'
+    )
+    parser.add_argument(
+        '-p',
+        '--path',
+        default='stockfish/stockfish.exe',
+        help='Set the path to the stockfish executable',
+        dest='path'
+    )
+    parser.add_argument(
+        '--early-stop',
+        default=0,
+        type=int,
+        help='Stop stockfish\'s search once its best move and score stayed the same for this many depths in a row, or it found a mate. 0 always searches to the full depth or time. Only applies when using stockfish.',
+        dest='early_stop'
+    )
+    parser.add_argument(
+        '--hash',
+        default=16,
+        type=int,
+        help='The hash table size of each stockfish process in MB',
+        dest='hash'
+    )
+    parser.add_argument(
+        '--book',
+        help='The path to an opening book built with engine/book.py, shared by all games.',
+        dest='book'
+    )
+    parser.add_argument(
+        '--cache',
+        help='The path to a file to cache the best moves found in each position in, shared by all games.',
+        dest='cache'
+    )
+    parser.add_argument(
+        '--cache-size',
+        default=100000,
+        type=int,
+        help='The number of positions to keep in the cache.',
+        dest='cache_size'
+    )
+    parser.add_argument(
+        '--syzygy',
+        help=f'The directories with Syzygy endgame tablebases, separated by "{os.pathsep}", probed by all games and by stockfish.',
+        dest='syzygy'
+    )
+    parser.add_argument(
+        '--syzygy-limit',
+        type=int,
+        help='The most pieces a position can have to be played from the tablebases.',
+        dest='syzygy_limit'
+    )
+    parser.add_argument(
+        '--timing',
+        help='The path to a file to log how long each phase of each ply takes in, shared by all games.',
+        dest='timing'
+    )
+    parser.add_argument(
+        '-b',
+        '--baud-rate',
+        default=115200,
+        type=int,
+        help='Set the baud rate for communication with Arduino',
+        dest='baud'
+    )
+    parser.add_argument(
+        '--arm-timeout',
+        default=120,
+        type=float,
+        help='The number of seconds to wait for the arm to finish a move before giving up.',
+        dest='arm_timeout'
+    )
+    parser.add_argument(
+        '-f',
+        '--feedback',
+        default='auto',
+        choices=['auto', 'board'],
+        help='If "auto", every arm reports its opponent\'s moves, if "board", the moves are found from the occupied squares every arm reports.',
+        dest='feedback'
+    )
+    args = parser.parse_args(argv)
+    if args.sides is None:
+        args.sides = ['w'] * len(args.ports)
+    if len(args.sides) != len(args.ports):
+        parser.error('--sides needs one side for every port')
+    # There is no single engine process per game to ponder or speculate with
+    args.ponder = False
+    args.speculate = 0
+    # Games already search in parallel with each other on the shared process pool
+    args.workers = 1
+    args.verbose = True
+    args.clock = None
+    args.increment = 0
+    # Every arm has its own calibration, so the arms plan their own moves
+    args.trajectories = None
+    args.places = None
+    # Games are not journaled, so they can't be resumed
+    args.journal = None
+    return args
+
+
+@handle_exit
+def main():
+    args = parse_args()
+    asyncio.run(run_games(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,64 @@
 import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
 from functools import wraps
 from math import log2
+import os
 import sys
+import threading
+import time
+import traceback
 
 from chessengine import Board
 from chessengine.lookup_tables import coords_to_pos, pos_to_coords
-from chessengine.utils import clear_lines
+from chessengine.utils import clear_lines, get_bit_positions
 import comms
-from utils import square_names, get_moves_made
+import occupancy
+from search import budget_from_clock, parallel_search_root, timed_search
+from book import OpeningBook
+from cache import MoveCache
+from speculate import Speculator
+from tablebase import RESULTS, Tablebase
+from timing import TimingLog
+import journal
+import recording
+import sequencer
+import trajectory
+from utils import square_names, MoveHistory, board_fen, board_from_fen, positions_from_uci, uci_move, zobrist_hash
 import stockfishpy
 
 
 def handle_exit(f):
     """
-    Catch exit and inform arm before terminating.
+    Catch exit and terminate. The game loop informs the arm
+    when it is cancelled.
     """
     @wraps(f)
     def wrapper():
+        code = 0
         try:
             f()
         except KeyboardInterrupt as e:
             print(f'\nDetected {e.__class__.__name__} {e}.')
-            # TODO: Inform arm
             print('Exiting')
-            sys.exit(1)
+            code = 1
+        except SystemExit as e:
+            if isinstance(e.code, str):
+                print(e.code, file=sys.stderr)
+            code = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # The game loop has already cleaned up. Exit without waiting on reads
+        # (e.g. input()) that are still blocked in daemon threads.
+        os._exit(code)
     return wrapper
 
 
-@handle_exit
-def main():
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(prog='charm', description='A chess-playing robotic arm')
     parser.add_argument(
         '-e', 
@@ -57,8 +87,7 @@ def main():
     parser.add_argument(
         '-c',
         '--port',
-        required=True,
-        help='Set the port name that the arm\'s microcontroller is connected to',
+        help='Set the port name that the arm\'s microcontroller is connected to. Required unless replaying a game.',
         dest='port'
     )
     parser.add_argument(
@@ -69,6 +98,23 @@ def main():
         help='Set the baud rate for communication with Arduino',
         dest='baud'
     )
+    parser.add_argument(
+        '--arm-timeout',
+        default=120,
+        type=float,
+        help='The number of seconds to wait for the arm to finish a move before giving up.',
+        dest='arm_timeout'
+    )
+    parser.add_argument(
+        '--trajectories',
+        help='The path to the calibration store of the arm (see engine/calibration_store.py). If given, moves are planned on the computer and streamed to the arm as setpoints.',
+        dest='trajectories'
+    )
+    parser.add_argument(
+        '--places',
+        help='The path to a JSON file with the slots of the capture bin, and the reserve of pieces for promotions (see engine/sequencer.py). Only used with --trajectories.',
+        dest='places'
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -82,102 +128,781 @@ def main():
         '-f',
         '--feedback',
         default='manual',
-        help='The feedback type. If "auto", the move made by the opponent is communicated by the arm, if "manual", the move made by the opponent needs to be entered into the terminal.',
+        help='The feedback type. If "auto", the move made by the opponent is communicated by the arm, if "board", it is found from the occupied squares reported by the arm, if "manual", the move made by the opponent needs to be entered into the terminal.',
         dest='feedback',
-        choices=['auto', 'manual']
+        choices=['auto', 'board', 'manual']
+    )
+    parser.add_argument(
+        '--ponder',
+        action='store_true',
+        help='Let stockfish think on the opponent\'s time, searching the reply it expects the opponent to make. Only applies when using stockfish.',
+        dest='ponder'
+    )
+    parser.add_argument(
+        '--early-stop',
+        default=0,
+        type=int,
+        help='Stop stockfish\'s search once its best move and score stayed the same for this many depths in a row, or it found a mate. 0 always searches to the full depth or time. Only applies when using stockfish.',
+        dest='early_stop'
+    )
+    parser.add_argument(
+        '-s',
+        '--speculate',
+        default=0,
+        type=int,
+        help='Search this many of the opponent\'s most likely replies in parallel while the opponent is thinking. Only applies when using the default engine. 0 disables speculative search.',
+        dest='speculate'
+    )
+    parser.add_argument(
+        '-t',
+        '--movetime',
+        type=float,
+        help='Search for this many seconds per move instead of to a fixed depth.',
+        dest='movetime'
     )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        default=1,
+        type=int,
+        help='The number of processes to search with. Root moves are split between the processes. Only applies when using the default engine.',
+        dest='workers'
+    )
+    parser.add_argument(
+        '--clock',
+        type=float,
+        help='Play with a clock of this many minutes per side. The time for each move is budgeted from the time left on the engine\'s clock.',
+        dest='clock'
+    )
+    parser.add_argument(
+        '--increment',
+        default=0,
+        type=float,
+        help='The increment in seconds added to a side\'s clock after each of its moves. Only applies with --clock.',
+        dest='increment'
+    )
+    parser.add_argument(
+        '--book',
+        help='The path to an opening book built with engine/book.py. Positions in the book are played from the book without searching.',
+        dest='book'
+    )
+    parser.add_argument(
+        '--cache',
+        help='The path to a file to cache the best moves found in each position in. Positions found in the cache are not searched again. The file is created if it doesn\'t exist, and can be shared by several games.',
+        dest='cache'
+    )
+    parser.add_argument(
+        '--cache-size',
+        default=100000,
+        type=int,
+        help='The number of positions to keep in the cache. The least recently used positions are removed first.',
+        dest='cache_size'
+    )
+    parser.add_argument(
+        '--syzygy',
+        help=f'The directories with Syzygy endgame tablebases, separated by "{os.pathsep}". Positions with few enough pieces are played from the tablebases without searching, and stockfish probes them too (see engine/tablebase.py).',
+        dest='syzygy'
+    )
+    parser.add_argument(
+        '--syzygy-limit',
+        type=int,
+        help='The most pieces a position can have to be played from the tablebases. The most pieces of any table found if not given.',
+        dest='syzygy_limit'
+    )
+    parser.add_argument(
+        '--timing',
+        help='The path to a file to log how long each phase of each ply takes in, as JSON lines. Summarize it with engine/timing.py.',
+        dest='timing'
+    )
+    parser.add_argument(
+        '--record',
+        help='The path to a file to record everything exchanged with the arm and stockfish in, to replay the game with --replay (see engine/recording.py)',
+        dest='record'
+    )
+    parser.add_argument(
+        '--replay',
+        help='Replay a game recorded with --record, with the recording in place of the arm, stockfish and the side prompt',
+        dest='replay'
+    )
+    parser.add_argument(
+        '--realtime',
+        action='store_true',
+        help='With --replay, let the arm and stockfish reply after their recorded delays instead of at once',
+        dest='realtime'
+    )
+    parser.add_argument(
+        '--journal',
+        help='The path to a file to append the position after every ply to, to resume the game with --resume if play.py stops (see engine/journal.py)',
+        dest='journal'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume the last game in the --journal file from its last position, instead of starting a new game',
+        dest='resume'
+    )
+
+    args = parser.parse_args(argv)
+    if args.resume and args.journal is None:
+        parser.error('--resume needs a --journal to resume the game from')
+    if args.replay is not None:
+        # Replay with the options the game was recorded with, unless they are given again
+        args = parser.parse_args(recording.arguments(args.replay) + (sys.argv[1:] if argv is None else argv))
+        if args.resume:
+            parser.error('a game resumed from a journal can\'t be replayed')
+        # The replayed game is not journaled again
+        args.journal = None
+    if args.port is None and args.replay is None:
+        parser.error('the following arguments are required: -c/--port')
+    return args
+
+
+def run_blocking(func, *args, **kwargs) -> asyncio.Future:
+    """
+    Runs a blocking function in a daemon thread and returns a future for its result.
+
+    Unlike asyncio.to_thread, a call that never returns (e.g. an input() prompt
+    or a serial read with a long timeout) does not keep the process alive when
+    the game loop shuts down.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result):
+        if not future.done():
+            future.set_result(result)
+
+    def set_exception(exception):
+        if not future.done():
+            future.set_exception(exception)
+
+    def target():
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            callback, value = set_exception, e
+        else:
+            callback, value = set_result, result
+        try:
+            loop.call_soon_threadsafe(callback, value)
+        except RuntimeError:
+            # The event loop was closed while func was running
+            pass
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+def read_move_from_stdin() -> tuple[str, str, int]:
+    """
+    Asks for the move made by the opponent until a valid move is entered.
+    Returns the start square, end square, and the number of lines printed.
+    """
+    prompt = 'Enter the move made by the opponent in the format <start_square>,<end_square> - '
+    move = input(prompt).split(',')
+    lines_printed = 1
+    while (
+        len(move) != 2
+        or move[0].lower() not in square_names
+        or move[1].lower() not in square_names
+    ):
+        print(f'Couldn\'t identify the move {",".join(move)}. Enter the move in the format <start_square>,<end_square>. For example: a4,a5')
+        move = input(prompt).split(',')
+        lines_printed += 2
+    return move[0].upper(), move[1].upper(), lines_printed
+
+
+class Game:
+    """
+    A game played by the arm. The serial port, the engine, and the opponent's
+    input are treated as concurrent event sources, so that e.g. the engine's
+    bookkeeping for the next move runs while the arm is still making its move.
+
+    engine is the stockfish process to search with, and can be None when
+    stockfish is not used.
+    """
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        socket,
+        engine: stockfishpy.Engine | None,
+        board_side: str,
+        recorder: recording.Recorder | None = None,
+        resumed: dict | None = None
+    ):
+        self.args = args
+        self.socket = socket
+        self.engine = engine
+        self.board_side = board_side
+        self.board = Board(board_side)
+        self.history = MoveHistory()
+        self.side_to_move = 'white'
+        # The number of the current ply, counted from 1
+        self.ply = 0
+        # The last record of the journal the game was resumed from, if it was
+        self.resumed = resumed
+        if resumed is not None:
+            # Stockfish is given the position as a FEN, so the moves before it don't have to be replayed
+            self.board, self.side_to_move = board_from_fen(resumed['fen'], board_side)
+            self.history = MoveHistory(resumed['fen'])
+            self.ply = resumed['ply']
 
-    args = parser.parse_args()
+        # Worker processes that search the root moves of chessengine's searches in parallel
+        self.search_pool = None
+        # Only a pool the game created is shut down when the game ends, not one shared with other games
+        self.owns_search_pool = False
+        if args.engine == 'default' and args.workers > 1:
+            self.search_pool = ProcessPoolExecutor(max_workers=args.workers)
+            self.owns_search_pool = True
 
-    socket = comms.get_socket(args.port, args.baud)
+        self.speculator = None
+        if args.engine == 'default' and args.speculate > 0:
+            self.speculator = Speculator(args.speculate)
+        # The result of a speculative search for the opponent's actual reply
+        self.speculated_result = None
+        # The reply stockfish expects from the opponent while it is pondering,
+        # and the result of a ponder search that the opponent's move confirmed
+        self.predicted_move = None
+        self.pondered_result = None
 
+        self.book = None
+        if args.book is not None:
+            self.book = OpeningBook(args.book)
+        self.cache = None
+        if args.cache is not None:
+            self.cache = MoveCache(args.cache, args.cache_size)
+        self.tablebase = None
+        if args.syzygy is not None:
+            self.tablebase = Tablebase(args.syzygy, args.syzygy_limit)
+
+        # The time left on each side's clock in seconds, if playing with a clock
+        self.clock = None
+        if args.clock is not None:
+            self.clock = {'white': args.clock * 60, 'black': args.clock * 60}
+            if resumed is not None and 'clock' in resumed:
+                self.clock = dict(resumed['clock'])
+
+        # Plans and orders the arm's moves to stream them to the arm, if not left to the arm
+        self.places = sequencer.DEFAULT_PLACES
+        self.sequencer = None
+        if args.trajectories is not None:
+            if args.places is not None:
+                self.places = sequencer.load_places(args.places)
+            planner = trajectory.Planner.from_store(args.trajectories, places=self.places.poses())
+            planner.build()
+            self.sequencer = sequencer.Sequencer(planner, self.places)
+
+        # Resolves when the arm acknowledges the last move it was sent
+        self.arm_done = None
+        self.lines_printed = 0
+
+        self.timing = None
+        if args.timing is not None:
+            self.timing = TimingLog(args.timing, port=socket.port)
+        # Records the game to replay it, see recording.py
+        self.recorder = recorder
+        self.journal = None
+        if args.journal is not None:
+            self.journal = journal.Journal(args.journal)
+
+    def log(self, message: str) -> None:
+        if self.args.verbose:
+            print(message)
+            self.lines_printed += 1
+
+    def timer(self, phase: str, ply: int = None, **fields):
+        """
+        Returns a context manager that times a phase of the current ply (or
+        of ply) and yields a dict for more fields, see TimingLog.timer.
+        Does nothing if timing is not enabled.
+        """
+        if self.timing is None:
+            return nullcontext({})
+        return self.timing.timer(self.ply if ply is None else ply, phase, **fields)
+
+    def show_board(self) -> None:
+        if not self.args.verbose:
+            clear_lines(self.lines_printed)
+        print(self.board)
+        self.lines_printed = 11
+
+    async def run(self) -> None:
+        """
+        Runs the game loop until it is cancelled.
+        """
+        try:
+            if self.resumed is not None:
+                await self.resync_arm()
+            elif self.args.verbose:
+                print(f'Starting game. Engine is playing {self.board_side}.')
+            if self.ply == 0:
+                self.write_journal()
+            while True:
+                self.show_board()
+                self.ply += 1
+                side = self.side_to_move
+                pieces = self.board.all_pieces.bit_count()
+                started = time.monotonic()
+                if side == self.board_side:
+                    with self.timer('engine_turn'):
+                        await self.engine_turn()
+                else:
+                    with self.timer('opponent_turn'):
+                        await self.opponent_turn()
+                self.side_to_move = 'white' if side == 'black' else 'black'
+                self.write_journal(
+                    side=side,
+                    move=self.history.moves[-1],
+                    capture=self.board.all_pieces.bit_count() < pieces,
+                    duration=round(time.monotonic() - started, 6)
+                )
+        finally:
+            self.close()
+
+    def write_journal(self, **fields) -> None:
+        """
+        Appends the position after the current ply to the journal, with
+        fields describing the ply (see journal.py). Does nothing if the game
+        is not journaled.
+        """
+        if self.journal is None:
+            return
+        with self.timer('journal'):
+            self.journal.append(
+                self.ply,
+                engine_side=self.board_side,
+                **fields,
+                fen=board_fen(self.board, self.side_to_move, self.ply // 2 + 1),
+                hash=f'{zobrist_hash(self.board, self.side_to_move):016x}',
+                clock={side: round(left, 3) for side, left in self.clock.items()} if self.clock is not None else None
+            )
+
+    async def resync_arm(self) -> None:
+        """
+        Brings the arm back in line with the position the game was resumed
+        from. The arm abandons the move it was making when the game stopped,
+        and with board feedback, the game waits until the board's occupied
+        squares match the position.
+        """
+        comms.reset_arm(self.socket)
+        print(f'Resuming the game at ply {self.ply}. Engine is playing {self.board_side}, {self.side_to_move} to move.')
+        self.lines_printed += 1
+        if self.resumed.get('side') == self.board_side:
+            print(f'The arm may not have finished its last move, {self.resumed["move"]}. Set the pieces up as shown.')
+            self.lines_printed += 1
+        if self.args.feedback != 'board':
+            return
+
+        self.socket.send(comms.BOARD, done=False)
+        expected = self.board.all_pieces
+        while True:
+            event = await run_blocking(self.socket.next_event, comms.Occupancy, comms.Error)
+            if isinstance(event, comms.Error):
+                raise comms.ProtocolError(event.message)
+            wrong = occupancy.to_bitboard(event.bits) ^ expected
+            if not wrong:
+                return
+            squares = ', '.join(pos_to_coords[int(log2(position))].lower() for position in get_bit_positions(wrong))
+            print(f'The board doesn\'t match the position on {squares}. Waiting for the pieces to be set up.')
+            self.lines_printed += 1
+
+    def time_budget(self) -> float | None:
+        """
+        Returns the time in seconds chessengine should spend on the next move,
+        or None to search to a fixed depth.
+        """
+        if self.args.movetime is not None:
+            return self.args.movetime
+        if self.clock is not None:
+            return budget_from_clock(self.clock[self.board_side], self.args.increment)
+        return None
+
+    def search_limits(self) -> dict:
+        """
+        Returns the time limits for stockfish's next search as arguments
+        to Engine.go. Empty when searching to a fixed depth.
+        """
+        if self.args.movetime is not None:
+            return {'movetime': self.args.movetime * 1000}
+        if self.clock is not None:
+            increment = self.args.increment * 1000
+            return {
+                'wtime': self.clock['white'] * 1000,
+                'btime': self.clock['black'] * 1000,
+                'winc': increment,
+                'binc': increment,
+            }
+        return {}
+
+    def update_clock(self, side: str, started: float) -> None:
+        """
+        Charges the time since started (a value of time.monotonic()) to side's clock.
+        """
+        if self.clock is None:
+            return
+        self.clock[side] -= time.monotonic() - started
+        self.clock[side] += self.args.increment
+
+    async def search_chessengine(self) -> tuple[int, tuple[int, int, int], int]:
+        """
+        Searches the current position with chessengine.
+        Returns the best score found, the best move, and the depth searched to.
+        """
+        budget = self.time_budget()
+        if budget is None:
+            if self.search_pool is not None:
+                score, move = await run_blocking(parallel_search_root, self.board, self.args.depth, self.search_pool)
+            else:
+                score, move = await run_blocking(self.board.search_forward, self.args.depth)
+            return score, move, self.args.depth
+        score, move, depth = await run_blocking(timed_search, self.board, budget, pool=self.search_pool)
+        self.log(f'Searched to depth {depth} in {budget:.2f}s')
+        return score, move, depth
+
+    async def search_stockfish(self) -> dict:
+        """
+        Searches the current position with stockfish.
+        Returns the result of Engine.bestmove.
+        """
+        with self.timer('setposition') as fields:
+            bytes_sent = self.engine.bytessent
+            self.engine.setposition(self.history.command)
+            fields['bytes'] = self.engine.bytessent - bytes_sent
+        return await run_blocking(self.engine.bestmove, self.stop_policy(), **self.search_limits())
+
+    def stop_policy(self) -> stockfishpy.StopPolicy | None:
+        """
+        Returns a new policy for stopping stockfish's next search early, or
+        None to always search to the full depth or time.
+        """
+        if self.args.early_stop > 0:
+            return stockfishpy.StopPolicy(self.args.early_stop)
+        return None
+
+    def is_legal(self, start: int, end: int) -> bool:
+        """
+        Returns True if the engine's side can move from start to end.
+        """
+        return any((start, end) == (move[0], move[1]) for move in self.board.get_moves(self.board_side))
+
+    def search_depth(self) -> int:
+        """
+        Returns the depth the selected engine searches to.
+        """
+        if self.args.engine == 'stockfish' and self.engine is not None:
+            return int(self.engine.depth)
+        return self.args.depth
+
+    async def find_move(self) -> tuple[int, int, str, str | None]:
+        """
+        Finds the move to make using the selected engine. Returns the start
+        and end positions of the move, the move in UCI format with the piece
+        a pawn is promoted to, if any, and the reply stockfish expects, if any.
+        """
+        key = zobrist_hash(self.board, self.board_side)
+        if self.book is not None:
+            with self.timer('book'):
+                move = self.book.choose(key)
+            if move is not None and self.is_legal(*positions_from_uci(move)):
+                self.log(f'Found move in the opening book - {move}')
+                self.speculated_result = None
+                self.pondered_result = None
+                return *positions_from_uci(move), move, None
+
+        if self.tablebase is not None:
+            with self.timer('tablebase'):
+                probed = self.tablebase.probe(self.board, self.board_side)
+            if probed is not None and self.is_legal(*positions_from_uci(probed[0])):
+                move, wdl = probed
+                self.log(f'Found move in the tablebases - {move} ({RESULTS[wdl]})')
+                self.speculated_result = None
+                self.pondered_result = None
+                return *positions_from_uci(move), move, None
+
+        if self.speculated_result is None and self.pondered_result is None and self.cache is not None:
+            with self.timer('cache'):
+                # Waiting for another process's lock mustn't stop the event loop
+                cached = await run_blocking(self.cache.get, key, self.args.engine, self.search_depth())
+            if cached is not None:
+                move, depth = cached
+                self.log(f'Found best move in the cache - {move} (depth {depth})')
+                return *positions_from_uci(move), move, None
+
+        if self.args.engine == 'default':
+            if self.speculated_result is not None:
+                _, best_move, depth = self.speculated_result
+                self.speculated_result = None
+            else:
+                with self.timer('search', engine='default') as fields:
+                    _, best_move, depth = await self.search_chessengine()
+                    fields['depth'] = depth
+            self.log(f'Calculated best move using chessengine - {pos_to_coords[int(log2(best_move[0]))]} to {pos_to_coords[int(log2(best_move[1]))]}')
+            start, end, ponder_move = best_move[0], best_move[1], None
+            move = uci_move(start, end)
+        else:
+            # Stockfish always makes the best moves
+            if self.pondered_result is not None:
+                result = self.pondered_result
+                self.pondered_result = None
+            else:
+                with self.timer('search', engine='stockfish') as fields:
+                    result = await self.search_stockfish()
+                    fields.update(depth=result['depth'], nodes=result['nodes'], nps=result['nps'], stopped=result['stopped'])
+                if result['stopped']:
+                    self.log(f'Stopped the search early at depth {result["depth"]}')
+            best_move = result['bestmove']
+            depth = result['depth'] or self.search_depth()
+            self.log(f'Calculated best move using stockfish - {best_move}')
+            # Keeps the piece a pawn is promoted to, e.g. e7e8q, for stockfish's history
+            move = best_move
+            start, end = positions_from_uci(move)
+            ponder_move = result['ponder']
+
+        if self.cache is not None:
+            await run_blocking(self.cache.put, key, self.args.engine, depth, move)
+        return start, end, move, ponder_move
+
+    async def engine_turn(self) -> None:
+        started = time.monotonic()
+        start, end, move, ponder_move = await self.find_move()
+        self.update_clock(self.board_side, started)
+
+        # The pieces the arm has to carry depend on the position before the move
+        transfers, order = sequencer.expand(self.board, start, end, promotion=self.places.reserve is not None)
+        self.board.move(start, end)
+        self.history.append(move)
+
+        if self.args.ponder and ponder_move is not None:
+            # Think about the expected reply while the arm moves and the opponent thinks
+            self.predicted_move = ponder_move
+            self.engine.ponder(self.history.command_with(ponder_move), **self.search_limits())
+
+        if self.arm_done is not None:
+            await self.arm_done
+        if self.sequencer is not None:
+            self.log('Streaming move to arm')
+            self.arm_done = run_blocking(self.stream_move, transfers, order, self.ply)
+            return
+        self.log('Sending move to arm')
+        with self.timer('send') as fields:
+            bytes_sent = self.socket.bytes_sent
+            sequence = await run_blocking(self.send_commands, sequencer.commands(transfers))
+            fields['bytes'] = self.socket.bytes_sent - bytes_sent
+        self.arm_done = run_blocking(self.wait_for_arm, sequence, self.ply)
+
+    def send_commands(self, commands: list[tuple[bool, int, int]]) -> int:
+        """
+        Sends the MOVE and CAPTURE commands of a move to the arm, which makes
+        them in order. Returns the sequence number of the last one.
+        """
+        for capture, start, end in commands:
+            sequence = comms.send_move_to_arm(
+                self.socket, (comms.index_square(start), comms.index_square(end)), capture, wait=False
+            )
+        return sequence
+
+    def wait_for_arm(self, sequence: int, ply: int) -> None:
+        """
+        Blocks until the arm made the move with the given sequence number.
+        Runs in a thread while the game goes on, so it is timed as part of ply.
+        """
+        with self.timer('arm', ply=ply):
+            comms.wait_for_arm(self.socket, sequence, self.args.arm_timeout)
+
+    def stream_move(self, transfers: list[sequencer.Transfer], order: list[tuple[int, int]], ply: int) -> None:
+        """
+        Orders the transfers of a move, streams their planned trajectory to
+        the arm, and blocks until the arm reaches its end. Runs in a thread
+        like wait_for_arm.
+        """
+        with self.timer('arm', ply=ply) as fields:
+            transfers, fields['planned'] = self.sequencer.plan(transfers, order)
+            self.sequencer.commit(transfers)
+            planner = self.sequencer.planner
+            angles, gripper = planner.sample(planner.visit(self.sequencer.locations(transfers)))
+            fields['setpoints'] = len(angles)
+            sequence = trajectory.stream(self.socket, angles, gripper)
+            comms.wait_for_arm(self.socket, sequence, self.args.arm_timeout)
+
+    async def opponent_turn(self) -> None:
+        if self.speculator is not None:
+            # Search the likely replies while the arm moves and the opponent thinks
+            # With the limits of the engine's next turn, so the result is as good as that turn's search
+            self.speculator.start(self.board, self.args.depth, self.time_budget())
+        self.log('Waiting to detect opponent\'s move')
+
+        with self.timer('opponent'):
+            if self.args.feedback == 'auto':
+                # The opponent's move arrives as its own event, so it is listened for while the arm still moves
+                move = run_blocking(comms.get_move_from_arm, self.socket)
+            elif self.args.feedback == 'manual':
+                move = run_blocking(read_move_from_stdin)
+            if self.arm_done is not None:
+                # The opponent's clock only starts once the arm has made the engine's move
+                await self.arm_done
+            started = time.monotonic()
+            if self.args.feedback == 'board':
+                # The snapshots taken while the arm made its own move would
+                # show its squares as lifted by the opponent
+                self.socket.discard_events(comms.Occupancy)
+                move = run_blocking(occupancy.get_move_from_board, self.socket, self.board, self.board.opponent_side)
+            start, end, *lines_printed = await move
+        self.lines_printed += sum(lines_printed)
+        self.update_clock(self.board.opponent_side, started)
+        self.log(f'Received move from arm - {start} to {end}')
+
+        self.board.move_raw(2 ** coords_to_pos[start.upper()], 2 ** coords_to_pos[end.upper()])
+        self.history.append(start + end)
+
+        if self.speculator is not None:
+            with self.timer('speculate') as fields:
+                self.speculated_result = await run_blocking(self.speculator.result, self.board)
+                fields['hit'] = self.speculated_result is not None
+        if self.engine is not None and self.engine.pondering:
+            if (start + end).lower() == self.predicted_move:
+                with self.timer('ponderhit') as fields:
+                    self.pondered_result = await run_blocking(self.engine.ponderhit)
+                    fields.update(depth=self.pondered_result['depth'], nodes=self.pondered_result['nodes'], nps=self.pondered_result['nps'])
+            else:
+                with self.timer('ponder_stop'):
+                    await run_blocking(self.engine.stop)
+            self.predicted_move = None
+
+    def close(self) -> None:
+        """
+        Stops all background work and informs the arm that the game is over.
+        """
+        if self.speculator is not None:
+            self.speculator.shutdown()
+        if self.search_pool is not None and self.owns_search_pool:
+            self.search_pool.shutdown(wait=False, cancel_futures=True)
+        if self.cache is not None:
+            self.cache.close()
+        if self.book is not None:
+            self.book.close()
+        if self.tablebase is not None:
+            self.tablebase.close()
+        if self.timing is not None:
+            self.timing.close()
+        if self.journal is not None:
+            self.journal.close()
+        try:
+            comms.reset_arm(self.socket)
+        except OSError:
+            print('Could not inform the arm that the game ended')
+        try:
+            if self.engine is not None:
+                self.engine.quit()
+        except OSError:
+            # The engine already exited, e.g. it received the same interrupt
+            pass
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+def ask_player_side() -> str:
+    """
+    Asks which side the player wants to play until "w" or "b" is entered.
+    Returns "white" or "black".
+    """
     player_side = input('Do you want to play white or black (w/b)? - ')
     while player_side not in ['w', 'b']:
         print('Enter "w" for white and "b" for black.')
         player_side = input('Do you want to play white or black (w/b)? - ')
+    return 'white' if player_side == 'w' else 'black'
 
-    player_side = 'white' if player_side == 'w' else 'black'
-    board_side = 'black' if player_side == 'white' else 'white'
 
-    board = Board(board_side)
-    engine = stockfishpy.Engine(args.path)
-    engine.ucinewgame()
-    engine.uci()
-    print('Stockfish:', engine.isready())
-    
-    side_to_move = 'white'
+async def start(args: argparse.Namespace) -> Game:
+    """
+    Opens the serial port, starts stockfish (if it is used), and asks the
+    player for their side, all at the same time. Reports how long each step
+    took when verbose.
+    """
+    timings = {}
+
+    async def timed(name, func, *func_args, **func_kwargs):
+        step_started = time.monotonic()
+        result = await run_blocking(func, *func_args, **func_kwargs)
+        timings[name] = time.monotonic() - step_started
+        return result
+
+    recorder = None
+    path = args.path
+    started = time.monotonic()
+    resumed = None
+    if args.resume:
+        # Only the last record is read, however long the game was
+        resumed = journal.recover(args.journal)
+        if resumed is None:
+            print(f'There is no game to resume in {args.journal}. Starting a new game.')
+
+    def resumed_side() -> str:
+        return 'black' if resumed['engine_side'] == 'white' else 'white'
+
+    if args.replay is not None:
+        replay = recording.Replay(args.replay, args.realtime)
+        path = replay.engine_command()
+        steps = [
+            timed('serial port', comms.ArmLink, replay.serial()),
+            timed('side prompt', replay.side),
+        ]
+    else:
+        if args.record is not None:
+            recorder = recording.Recorder(args.record)
+        steps = [
+            timed('serial port', comms.get_socket, args.port, args.baud, recorder),
+            timed('side prompt', ask_player_side if resumed is None else resumed_side),
+        ]
+    if args.engine == 'stockfish':
+        param = {'Ponder': 'true'} if args.ponder else {}
+        if args.syzygy is not None:
+            param['SyzygyPath'] = args.syzygy
+            if args.syzygy_limit is not None:
+                param['SyzygyProbeLimit'] = args.syzygy_limit
+        steps.append(timed('stockfish', stockfishpy.Engine, path, param=param, recorder=recorder))
+    socket, player_side, *engine = await asyncio.gather(*steps)
+    engine = engine[0] if engine else None
+    if recorder is not None:
+        recorder.record('prompt', 'read', player_side)
 
     if args.verbose:
-        print(f'Starting game. Engine is playing {board_side}.')
-
-    print(board)
-    lines_printed = 11
-    while True:
-        if not args.verbose:
-            clear_lines(lines_printed)
-        print(board)
-        lines_printed = 11
-        if side_to_move == board_side:
-            # Find move and make it (send it to arm)
-            if args.engine == 'default':
-                _, best_move = board.search_forward(args.depth)
-                end_side, end_piece, end_board = board.identify_piece_at(best_move[1])
-                board.move(best_move[0], best_move[1])
-                capture = end_side is not None
-
-                if args.verbose:
-                    print(f'Calculated best move using chessengine - {pos_to_coords[int(log2(best_move[0]))]} to {pos_to_coords[int(log2(best_move[1]))]}')
-                    print('Sending move to arm')
-                    lines_printed += 2
-
-                comms.send_move_to_arm(socket, (best_move[0], best_move[1]), capture)
-            else:
-                # Stockfish always makes the best moves
-                best_move = engine.bestmove()['bestmove']
-                engine.setposition(get_moves_made(board) + [best_move])
-                if args.verbose:
-                    print(f'Calculated best move using stockfish - {best_move}')
-                    lines_printed += 1
-                
-                # Also track moves on chessengine's board to detect captures
-                start = 2 ** coords_to_pos[best_move[0:2].upper()]
-                end = 2 ** coords_to_pos[best_move[2:].upper()]
-                end_side, end_piece, end_board = board.identify_piece_at(end)
-                board.move(start, end)
-                capture = end_side is not None
-
-                if args.verbose:
-                    print(f'Sending {best_move} to arm')
-                    lines_printed += 1
-                comms.send_move_to_arm(socket, (best_move[0:2], best_move[2:]), capture)
-        else:
-            if args.verbose:
-                print('Waiting to detect opponent\'s move')
-                lines_printed += 1
-            if args.feedback == 'auto':
-                # Read move to make from serial port
-                start, end = comms.get_move_from_arm(socket)
-            else:
-                # Read move from stdin
-                move = input('Enter the move made by the opponent in the format <start_square>,<end_square> - ').split(',')
-                lines_printed += 1
-                while (
-                    move[0].lower() not in square_names 
-                    or move[1].lower() not in square_names
-                    or len(move) != 2
-                ):
-                    print(f'Couldn\'t identify the move {",".join(move)}. Enter the move in the format <start_square>,<end_square>. For example: a4,a5')
-                    move = input('Enter the move made by the opponent in the format <start_square>,<end_square> - ').split(',')
-                    lines_printed += 2
-                start = move[0].upper()
-                end = move[1].upper()
-            if args.verbose:
-                print(f'Received move from arm - {start} to {end}')
-                lines_printed += 1
-            board.move_raw(2 ** coords_to_pos[start.upper()], 2 ** coords_to_pos[end.upper()])
-            engine.setposition(get_moves_made(board) + [start+end])
-            
-        side_to_move = 'white' if side_to_move == 'black' else 'black'
+        steps_taken = ', '.join(f'{name} {duration:.3f}s' for name, duration in timings.items())
+        print(f'Started in {time.monotonic() - started:.3f}s ({steps_taken})')
+
+    board_side = 'black' if player_side == 'white' else 'white'
+    return Game(args, socket, engine, board_side, recorder, resumed)
+
+
+async def replay(game: Game) -> None:
+    """
+    Runs a replayed game until its recording ends, even if the game is
+    waiting on stockfish rather than on the arm at that point.
+    """
+    running = asyncio.ensure_future(game.run())
+    failed = run_blocking(game.socket.wait_error)
+    await asyncio.wait([running, failed], return_when=asyncio.FIRST_COMPLETED)
+    if not running.done():
+        running.cancel()
+    try:
+        await running
+    except (asyncio.CancelledError, recording.ReplayFinished):
+        pass
+    if failed.done() and not isinstance(failed.result(), recording.ReplayFinished):
+        raise failed.result()
+
+
+async def play(args: argparse.Namespace) -> None:
+    game = await start(args)
+    if args.replay is not None:
+        await replay(game)
+    else:
+        await game.run()
+
+
+@handle_exit
+def main():
+    args = parse_args()
+    asyncio.run(play(args))
 
 
 if __name__ == '__main__':
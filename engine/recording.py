@@ -0,0 +1,489 @@
+"""
+Records everything a game exchanges with the arm and with stockfish, and
+replays recorded games without either, to measure how long the computer's
+own side of a game takes.
+
+Record a game with play.py --record game.trace. Every read and write on the
+serial port and on stockfish's pipes, and the side chosen at the prompt,
+is written to the trace as one line of JSON, e.g. -
+
+    {"time": 0.512, "channel": "arm", "direction": "write", "data": "a5010200010c1c..."}
+
+Replay it with play.py --replay game.trace, which takes the options the
+game was recorded with. The arm and stockfish are replaced by the trace, and each of their replies is sent once the computer
+has sent what it sent before that reply in the recording - at once, or
+after the recorded delay with --realtime. A replay at full speed leaves out
+the time the arm and stockfish took, so it measures the time spent in
+comms.py, stockfishpy.py, play.py and chessengine's search.
+
+Compare the time replays of a corpus of traces take against a baseline -
+
+    python engine/recording.py bench traces/*.trace --baseline baseline.json
+
+Replays are exact for games searched to a fixed depth. Games searched for
+a time (--movetime, --clock) or with --ponder can make other moves when
+replayed, which stops the replay with a ReplayError.
+"""
+import argparse
+from collections import deque
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import serial
+
+from comms import RESET, ArmLink, Frame, FrameDecoder
+
+
+class ReplayError(serial.SerialException):
+    """
+    Raised when the computer sends something other than what it sent in the recording.
+    """
+
+
+class ReplayFinished(serial.SerialException):
+    """
+    Raised by a replayed serial port once the recording has nothing more to send.
+    """
+
+
+class Recorder:
+    """
+    Writes everything a game reads and writes to a trace file.
+
+    :param path: The path of the trace file. It is overwritten.
+    """
+    def __init__(self, path: str):
+        self.file = open(path, 'w', buffering=1)
+        self.started = time.monotonic()
+        # The serial port, the engine's pipes and the prompt are recorded from different threads
+        self.lock = threading.Lock()
+        self.file.write(json.dumps({'argv': sys.argv[1:]}) + '\n')
+
+    def record(self, channel: str, direction: str, data: bytes | str) -> None:
+        """
+        Writes one read or write to the trace.
+
+        :param channel: "arm", "engine" or "prompt"
+        :param direction: "read" or "write", as seen from the computer
+        :param data: Bytes of the serial port, or text of the engine and the prompt
+        """
+        line = {
+            'time': round(time.monotonic() - self.started, 6),
+            'channel': channel,
+            'direction': direction,
+            'data': data.hex() if isinstance(data, bytes) else data,
+        }
+        with self.lock:
+            # The serial port's reader thread can still read after the game closed the trace
+            if not self.file.closed:
+                self.file.write(json.dumps(line) + '\n')
+
+    def tap_serial(self, socket: serial.Serial) -> 'TracedSerial':
+        return TracedSerial(socket, self)
+
+    def tap_pipes(self, stdin, stdout) -> tuple['TracedPipe', 'TracedPipe']:
+        return TracedPipe(stdin, self), TracedPipe(stdout, self)
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+class TracedSerial:
+    """
+    A serial port that records everything read from and written to it.
+    """
+    def __init__(self, socket: serial.Serial, recorder: Recorder):
+        self.socket = socket
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self.socket.read(size)
+        if data:
+            self.recorder.record('arm', 'read', data)
+        return data
+
+    def write(self, data: bytes) -> int:
+        self.recorder.record('arm', 'write', data)
+        return self.socket.write(data)
+
+
+class TracedPipe:
+    """
+    One of stockfish's pipes, recording every line read from or written to it.
+    """
+    def __init__(self, pipe, recorder: Recorder):
+        self.pipe = pipe
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def readline(self) -> str:
+        line = self.pipe.readline()
+        if line:
+            self.recorder.record('engine', 'read', line)
+        return line
+
+    def write(self, text: str) -> int:
+        self.recorder.record('engine', 'write', text)
+        return self.pipe.write(text)
+
+
+def arguments(path: str) -> list[str]:
+    """
+    Returns the arguments play.py was started with to record a trace.
+    """
+    with open(path) as f:
+        return json.loads(f.readline())['argv']
+
+
+def load(path: str) -> tuple[list[str], list[dict]]:
+    """
+    Reads a trace. Returns the arguments play.py was started with, and the
+    recorded reads and writes in order. A last line cut off by a crash is skipped.
+    """
+    with open(path) as f:
+        header = json.loads(f.readline())
+        events = []
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return header['argv'], events
+
+
+class FrameSplitter:
+    """
+    Splits the bytes written to the arm into frames, leaving out frames that
+    were sent again because their acknowledgement was late, so a replay
+    does not depend on when the computer sent a frame again.
+    """
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.recent = deque(maxlen=64)
+
+    def feed(self, data: bytes) -> list[Frame]:
+        frames = []
+        for item in self.decoder.feed(data):
+            if isinstance(item, Frame) and item not in self.recent:
+                self.recent.append(item)
+                frames.append(item)
+        return frames
+
+
+class LineSplitter:
+    """
+    Splits the text written to stockfish into commands.
+    """
+    def __init__(self):
+        self.partial = ''
+
+    def feed(self, text: str) -> list[str]:
+        *lines, self.partial = (self.partial + text).split('\n')
+        return lines
+
+
+class Schedule:
+    """
+    The replies of the arm or stockfish in a recording, each of which is due
+    once the computer sent what it sent before the reply in the recording.
+
+    :param events: The reads and writes of the recording
+    :param channel: "arm" or "engine"
+    :param splitter: FrameSplitter or LineSplitter, to split what the computer sends
+    :param realtime: If True, replies are due after their recorded delay instead of at once
+    """
+    def __init__(self, events: list[dict], channel: str, splitter: type, realtime: bool = False):
+        # What the computer sent, as (recorded time, frame or command)
+        self.expected = []
+        # The replies, as (number of frames or commands sent before, recorded delay, data)
+        self.replies = []
+        recorded = splitter()
+        for event in events:
+            if event['channel'] != channel:
+                continue
+            data = bytes.fromhex(event['data']) if channel == 'arm' else event['data']
+            if event['direction'] == 'write':
+                self.expected.extend((event['time'], unit) for unit in recorded.feed(data))
+            else:
+                since = self.expected[-1][0] if self.expected else 0.0
+                self.replies.append((len(self.expected), event['time'] - since, data))
+
+        self.splitter = splitter()
+        self.realtime = realtime
+        self.started = time.monotonic()
+        # The time the computer sent each of the expected frames or commands
+        self.sent_at = []
+        self.next_reply = 0
+
+    def sent(self, data: bytes | str) -> None:
+        """
+        Checks what the computer sent against the recording. Whatever was
+        sent is counted, so a replay can go on after a mismatch.
+
+        :raises ReplayError: If it differs from the recording
+        """
+        mismatches = []
+        for unit in self.splitter.feed(data):
+            number = len(self.sent_at)
+            self.sent_at.append(time.monotonic())
+            expected = self.expected[number][1] if number < len(self.expected) else None
+            if unit != expected:
+                mismatches.append(f'The computer sent {unit!r} where the recording has {expected!r}')
+        if mismatches:
+            raise ReplayError('\n'.join(mismatches))
+
+    def due(self) -> float | None:
+        """
+        Returns the time.monotonic() at which the next reply is due, or None
+        if there are no replies left or the computer has yet to send what comes before it.
+        """
+        if self.next_reply >= len(self.replies):
+            return None
+        after, delay, _ = self.replies[self.next_reply]
+        if after > len(self.sent_at):
+            return None
+        sent = self.sent_at[after - 1] if after > 0 else self.started
+        return sent + delay if self.realtime else sent
+
+    def pop(self) -> bytes | str:
+        self.next_reply += 1
+        return self.replies[self.next_reply - 1][2]
+
+    def finished(self, end: int) -> bool:
+        """
+        Returns True if the computer sent the first end frames or commands,
+        and every reply to them was sent.
+        """
+        return len(self.sent_at) >= end and all(after > end for after, _, _ in self.replies[self.next_reply:])
+
+
+class ReplaySerial:
+    """
+    Stands in for the arm's serial port, playing the arm's side of a recording.
+
+    Once the computer sent everything it sent before the recorded game
+    ended, i.e. before its last RESET, and every reply to it was read, the
+    next read raises ReplayFinished, and whatever the computer sends is dropped.
+    """
+    def __init__(self, path: str, events: list[dict], realtime: bool = False):
+        self.port = f'replay:{os.path.basename(path)}'
+        self.timeout = ArmLink.READ_TIMEOUT
+        self.schedule = Schedule(events, 'arm', FrameSplitter, realtime)
+        resets = [number for number, (_, frame) in enumerate(self.schedule.expected) if frame.type == RESET]
+        self.end = resets[-1] if resets else len(self.schedule.expected)
+        self.received = bytearray()
+        self.changed = threading.Condition()
+
+    def _release(self) -> None:
+        now = time.monotonic()
+        due = self.schedule.due()
+        while due is not None and due <= now:
+            self.received += self.schedule.pop()
+            due = self.schedule.due()
+
+    @property
+    def in_waiting(self) -> int:
+        with self.changed:
+            self._release()
+            return len(self.received)
+
+    def read(self, size: int = 1) -> bytes:
+        deadline = time.monotonic() + self.timeout
+        with self.changed:
+            while True:
+                self._release()
+                if self.received:
+                    data = bytes(self.received[:size])
+                    del self.received[:size]
+                    return data
+                if self.schedule.finished(self.end):
+                    raise ReplayFinished(f'The recording on {self.port} ended')
+                now = time.monotonic()
+                if now >= deadline:
+                    return b''
+                due = self.schedule.due()
+                self.changed.wait(min(deadline, due if due is not None else deadline) - now)
+
+    def write(self, data: bytes) -> int:
+        with self.changed:
+            # What is sent after the recorded game ended, e.g. the next move, is dropped
+            if not self.schedule.finished(self.end):
+                self.changed.notify_all()
+                self.schedule.sent(data)
+        return len(data)
+
+    def close(self) -> None:
+        pass
+
+
+class Replay:
+    """
+    A recorded game, to play again in place of the arm, stockfish and the player.
+
+    :param path: The path of the trace
+    :param realtime: If True, the arm and stockfish reply after their
+        recorded delays instead of at once
+    """
+    def __init__(self, path: str, realtime: bool = False):
+        self.path = path
+        self.realtime = realtime
+        self.argv, self.events = load(path)
+
+    def serial(self) -> ReplaySerial:
+        return ReplaySerial(self.path, self.events, self.realtime)
+
+    def side(self) -> str:
+        """
+        Returns the side the player chose at the prompt.
+        """
+        return next(event['data'] for event in self.events if event['channel'] == 'prompt')
+
+    def engine_command(self) -> list[str]:
+        """
+        Returns the command that starts a process playing stockfish's side of
+        the recording, to be started by stockfishpy.Engine in place of stockfish.
+        """
+        command = [sys.executable, os.path.abspath(__file__), 'engine', self.path]
+        return command + ['--realtime'] if self.realtime else command
+
+
+def serve_engine(path: str, realtime: bool = False) -> None:
+    """
+    Plays stockfish's side of a recording on stdin and stdout. Commands that
+    differ from the recording are reported on stderr and answered as recorded.
+    """
+    _, events = load(path)
+    schedule = Schedule(events, 'engine', LineSplitter, realtime)
+    while True:
+        due = schedule.due()
+        if due is not None:
+            time.sleep(max(due - time.monotonic(), 0))
+            sys.stdout.write(schedule.pop())
+            sys.stdout.flush()
+            continue
+        line = sys.stdin.readline()
+        if not line or line.strip() == 'quit':
+            # The game can quit at any point, e.g. when the arm's recording ended first
+            break
+        try:
+            schedule.sent(line)
+        except ReplayError as e:
+            print(e, file=sys.stderr)
+
+
+def replay_game(path: str, realtime: bool = False) -> tuple[float, list[float]]:
+    """
+    Replays a recorded game with play.py. Returns the seconds the replay took,
+    and the seconds each of its plies took.
+
+    :raises RuntimeError: If the replay failed, e.g. because play.py made another move
+    """
+    play = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'play.py')
+    with tempfile.TemporaryDirectory() as directory:
+        timing = os.path.join(directory, 'timing.jsonl')
+        command = [sys.executable, play, '--replay', path, '--timing', timing]
+        if realtime:
+            command.append('--realtime')
+        started = time.monotonic()
+        result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        total = time.monotonic() - started
+        if result.returncode != 0:
+            raise RuntimeError(f'Replaying {path} failed -\n{result.stderr}')
+
+        plies = {}
+        with open(timing) as f:
+            for line in f:
+                event = json.loads(line)
+                if event['phase'] in ('engine_turn', 'opponent_turn'):
+                    plies[event['ply']] = event['duration']
+    # The last ply was cut off where the recording ended
+    return total, [plies[ply] for ply in sorted(plies)][:-1]
+
+
+def bench(paths: list[str], runs: int = 1, realtime: bool = False) -> dict[str, dict]:
+    """
+    Replays every trace runs times. Returns the fastest total time of each
+    trace, and the fastest time of each of its plies, by the trace's file name.
+    """
+    results = {}
+    for path in paths:
+        replays = [replay_game(path, realtime) for _ in range(runs)]
+        results[os.path.basename(path)] = {
+            'total': min(total for total, _ in replays),
+            'plies': [min(times) for times in zip(*(plies for _, plies in replays))],
+        }
+    return results
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """
+    Returns a line for every trace or ply that got slower than its baseline
+    by more than the fraction tolerance. Plies faster than 10 ms are left out,
+    as their times are mostly noise.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        if result['total'] > before['total'] * (1 + tolerance):
+            regressions.append(f'{name} took {result["total"]:.3f}s, {before["total"]:.3f}s before')
+        for ply, (now, then) in enumerate(zip(result['plies'], before['plies']), start=1):
+            if now > 0.01 and now > then * (1 + tolerance):
+                regressions.append(f'{name} ply {ply} took {now:.3f}s, {then:.3f}s before')
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded games, and compare how long they take against a baseline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    engine_parser = subparsers.add_parser('engine', help='Play stockfish\'s side of a trace on stdin and stdout. Started by play.py --replay.')
+    engine_parser.add_argument('trace', help='The trace to replay')
+    engine_parser.add_argument('--realtime', action='store_true', help='Reply after the recorded delays', dest='realtime')
+
+    bench_parser = subparsers.add_parser('bench', help='Replay traces and compare the time they take against a baseline')
+    bench_parser.add_argument('traces', nargs='+', help='The traces to replay')
+    bench_parser.add_argument('--baseline', required=True, help='The JSON file with the times of an earlier run', dest='baseline')
+    bench_parser.add_argument('--update', action='store_true', help='Write the times of this run to the baseline', dest='update')
+    bench_parser.add_argument('--runs', default=1, type=int, help='Replay every trace this many times, and keep the fastest times', dest='runs')
+    bench_parser.add_argument('--tolerance', default=0.1, type=float, help='The fraction a time may grow by before it counts as slower', dest='tolerance')
+    bench_parser.add_argument('--realtime', action='store_true', help='Replay with the arm and stockfish replying after their recorded delays', dest='realtime')
+    args = parser.parse_args()
+
+    if args.command == 'engine':
+        serve_engine(args.trace, args.realtime)
+        sys.exit()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = bench(args.traces, args.runs, args.realtime)
+
+    print(f'{"trace":<30}{"plies":>8}{"total (s)":>12}{"baseline (s)":>14}{"change":>10}')
+    for name, result in results.items():
+        before = baseline.get(name, {}).get('total')
+        change = f'{(result["total"] / before - 1) * 100:+.1f}%' if before else '-'
+        before = f'{before:.3f}' if before else '-'
+        print(f'{name:<30}{len(result["plies"]):>8}{result["total"]:>12.3f}{before:>14}{change:>10}')
+
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(regression)
+    if args.update:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2)
+    sys.exit(1 if regressions and not args.update else 0)
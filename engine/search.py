@@ -0,0 +1,221 @@
+"""
+Time-budgeted and parallel search for the default engine (chessengine).
+
+Board.search_forward always searches to a fixed depth, so the time it takes
+varies a lot between quiet and tactical positions. timed_search deepens one
+ply at a time until the time budget runs out, and returns the best move of
+the deepest search that completed. A depth that is still being searched at
+the deadline is stopped at its next node, so the budget is never overrun by
+more than one node.
+
+Board.search_forward also only uses one CPU core. parallel_search_root
+searches each root move in its own task on a process pool, and merges the
+scores in the same way search_forward does, so it finds the same move.
+A task that is already running can't be cancelled, so the tasks check the
+deadline themselves at every node, and stop once it has passed.
+"""
+from concurrent.futures import Executor, wait, FIRST_EXCEPTION
+import time
+from typing import Callable
+
+from chessengine import Board
+
+
+class SearchTimeout(Exception):
+    """
+    Raised when a search runs past its deadline, or is stopped.
+    """
+
+
+def stop_when(board: Board, should_stop: Callable[[], bool], message: str = 'The search was stopped') -> None:
+    """
+    Makes the searches on board raise SearchTimeout as soon as should_stop()
+    returns True. chessengine makes every move of a search with Board.move,
+    so it is checked at every node. The board is left in the middle of the
+    search when it stops, so only use this on a copy of the game's board.
+
+    A copy of the board keeps its conditions, but only checks them once
+    stop_when is called on the copy, e.g. with a deadline.
+    """
+    # Board.copy is shallow, so the copy's move would still move the pieces of the board it was copied from
+    conditions = getattr(board, 'stop_conditions', []) + [(should_stop, message)]
+    board.stop_conditions = conditions
+
+    def checked_move(*args, **kwargs):
+        for condition, reason in conditions:
+            if condition():
+                raise SearchTimeout(reason)
+        return type(board).move(board, *args, **kwargs)
+
+    # An instance attribute is found before the method, also by chessengine's own calls
+    board.move = checked_move
+
+
+def search_root(
+    board: Board,
+    depth: int,
+    deadline: float = None,
+    first_move: tuple[int, int, int] = None
+) -> tuple[int, tuple[int, int, int]]:
+    """
+    The same search as Board.search_forward, but checks the deadline (a value
+    of time.monotonic()) at every node and searches first_move first.
+
+    :raises SearchTimeout: If the deadline passed before the search finished.
+        The board is left in its original state.
+    """
+    maximize = board.side == 'white'
+    best_score = -100000 if maximize else 100000
+
+    moves = board.get_moves(board.side)
+    if first_move in moves:
+        moves.remove(first_move)
+        moves.insert(0, first_move)
+    best_move = moves[0]
+
+    if deadline is not None:
+        # The search stops in the middle of a move, so it is made on a copy
+        board = board.copy()
+        board.moves = []
+        stop_when(board, lambda: time.monotonic() >= deadline, f'Search to depth {depth} ran out of time')
+
+    for move in moves:
+        board.move(start=move[0], end=move[1], score=move[2])
+        value = board.alpha_beta_search(depth=depth - 1, maximizing_player=not maximize)
+        board.undo_move()
+
+        if maximize and value >= best_score:
+            best_score = value
+            best_move = move
+        elif not maximize and value <= best_score:
+            best_score = value
+            best_move = move
+    return best_score, best_move
+
+
+def _search_move(board: Board, depth: int, move: tuple[int, int, int], deadline: float = None) -> int:
+    """
+    Returns the score of the position after move, searched to depth plies
+    in total. Runs in a worker process.
+
+    :param deadline: A value of time.monotonic(), which is the same in every process on the machine
+    :raises SearchTimeout: If the deadline passed before the search finished
+    """
+    if deadline is not None:
+        stop_when(board, lambda: time.monotonic() >= deadline, f'Search to depth {depth} ran out of time')
+    board.move(start=move[0], end=move[1], score=move[2])
+    return board.alpha_beta_search(depth=depth - 1, maximizing_player=board.side != 'white')
+
+
+def parallel_search_root(
+    board: Board,
+    depth: int,
+    pool: Executor,
+    deadline: float = None,
+    first_move: tuple[int, int, int] = None
+) -> tuple[int, tuple[int, int, int]]:
+    """
+    The same search as search_root, with every root move searched in its own
+    task on pool, which should be a ProcessPoolExecutor.
+
+    :raises SearchTimeout: If the deadline passed before all root moves were searched
+    """
+    maximize = board.side == 'white'
+    best_score = -100000 if maximize else 100000
+
+    moves = board.get_moves(board.side)
+    if first_move in moves:
+        moves.remove(first_move)
+        moves.insert(0, first_move)
+    best_move = moves[0]
+
+    root = board.copy()
+    # The workers only need the current position, not the game's moves
+    root.moves = []
+    futures = [pool.submit(_search_move, root, depth, move, deadline) for move in moves]
+    timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+    done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+    if not_done:
+        # The tasks that already started stop by themselves at the deadline
+        for future in not_done:
+            future.cancel()
+        # Re-raise an error from a worker rather than reporting a timeout
+        for future in done:
+            future.result()
+        raise SearchTimeout(f'Search to depth {depth} ran out of time')
+
+    # Merge in move order so that ties are broken the same way as search_forward
+    for move, future in zip(moves, futures):
+        value = future.result()
+        if maximize and value >= best_score:
+            best_score = value
+            best_move = move
+        elif not maximize and value <= best_score:
+            best_score = value
+            best_move = move
+    return best_score, best_move
+
+
+def timed_search(
+    board: Board,
+    movetime: float,
+    max_depth: int = 15,
+    pool: Executor = None
+) -> tuple[int, tuple[int, int, int], int]:
+    """
+    Searches with iterative deepening until movetime seconds have passed.
+    The search to depth 1 always completes, so a move is always found.
+    If a process pool is passed, each depth is searched with parallel_search_root.
+
+    :return: A 3-tuple of the best score, the best move, and the depth it was found at
+    """
+    start = time.monotonic()
+    deadline = start + movetime
+    result = None
+    last_duration = None
+
+    for depth in range(1, max_depth + 1):
+        depth_start = time.monotonic()
+        try:
+            if pool is not None:
+                score, move = parallel_search_root(
+                    board,
+                    depth,
+                    pool,
+                    deadline=deadline if result is not None else None,
+                    first_move=result[1] if result is not None else None
+                )
+            else:
+                score, move = search_root(
+                    board,
+                    depth,
+                    deadline=deadline if result is not None else None,
+                    first_move=result[1] if result is not None else None
+                )
+        except SearchTimeout:
+            break
+        result = (score, move, depth)
+
+        now = time.monotonic()
+        duration = now - depth_start
+        # Don't start a depth that is not expected to finish in time. Each
+        # depth takes about as many times longer as the last one did. Very
+        # short searches are too noisy to measure, so assume 10x for those.
+        if last_duration is not None and last_duration > 0.01:
+            growth = max(duration / last_duration, 2)
+        else:
+            growth = 10
+        if now + duration * growth > deadline:
+            break
+        last_duration = duration
+    return result
+
+
+def budget_from_clock(remaining: float, increment: float = 0, moves_to_go: int = 30) -> float:
+    """
+    Returns the time in seconds to spend on the next move, given the time
+    remaining on the clock and the increment per move.
+    """
+    budget = remaining / moves_to_go + increment * 0.8
+    # Always keep a reserve for the rest of the game
+    return max(min(budget, remaining * 0.5), 0.05)
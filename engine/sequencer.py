@@ -0,0 +1,214 @@
+"""
+Turns a chess move into the pieces the arm has to carry, and orders them
+so the arm travels as little as possible.
+
+A move is expanded into transfers, each picking up one piece and putting it
+down somewhere else - the moved piece, a captured piece carried to the
+capture bin, the rook of a castle, the pawn taken en passant, or a promoted
+pawn swapped for a piece from the reserve. The transfers are ordered, and
+captured pieces are given a slot of the capture bin, so that the time the
+arm takes is as short as possible, with the times planned by trajectory.py
+from the calibration tables as the cost of each path.
+
+The capture bin slots and the reserve are read from a JSON file, e.g. -
+
+    {
+        "bins": [
+            {"hover": [60, 74, 70, 105], "lower": [60, 61, 65, 126], "capacity": 8},
+            {"hover": [52, 80, 76, 108], "lower": [52, 66, 70, 128], "capacity": 8}
+        ],
+        "reserve": {"hover": [120, 74, 70, 105], "lower": [120, 61, 65, 126]}
+    }
+
+where every slot holds up to "capacity" pieces, and "reserve" is where the
+pieces that pawns are promoted to are picked up from.
+"""
+from itertools import permutations, product
+import json
+from typing import NamedTuple
+
+from chessengine import Board
+
+import comms
+from trajectory import CAPTURE_BIN, CAPTURE_HOVER_ANGLES, CAPTURE_LOWER_ANGLES, Planner
+
+
+# Stand-ins for the places of a transfer that are chosen when it is ordered
+BIN = -1
+RESERVE = -2
+
+# The rook's move of each castle, by the king's move, as square indices
+CASTLES = {
+    (comms.square_index('e1'), comms.square_index('g1')): (comms.square_index('h1'), comms.square_index('f1')),
+    (comms.square_index('e1'), comms.square_index('c1')): (comms.square_index('a1'), comms.square_index('d1')),
+    (comms.square_index('e8'), comms.square_index('g8')): (comms.square_index('h8'), comms.square_index('f8')),
+    (comms.square_index('e8'), comms.square_index('c8')): (comms.square_index('a8'), comms.square_index('d8')),
+}
+
+
+class Transfer(NamedTuple):
+    # Square indices, or a place off the board numbered from CAPTURE_BIN on
+    source: int
+    target: int
+
+
+class Places(NamedTuple):
+    # The (hover angles, grabbing angles) of every slot of the capture bin, and how many pieces each holds
+    bins: list[tuple[tuple, tuple]]
+    capacities: list[int]
+    # The (hover angles, grabbing angles) of the reserve of pieces for promotions, if there is one
+    reserve: tuple[tuple, tuple] | None = None
+
+    def poses(self) -> list[tuple[tuple, tuple]]:
+        """
+        Returns the poses of the bin slots and the reserve, in the order Planner numbers them from CAPTURE_BIN.
+        """
+        return self.bins + ([self.reserve] if self.reserve is not None else [])
+
+
+# The single capture bin of controller.ino, and no reserve
+DEFAULT_PLACES = Places([(CAPTURE_HOVER_ANGLES, CAPTURE_LOWER_ANGLES)], [64])
+
+
+def load_places(path: str) -> Places:
+    with open(path) as f:
+        fields = json.load(f)
+    bins = [(tuple(slot['hover']), tuple(slot['lower'])) for slot in fields['bins']]
+    capacities = [slot.get('capacity', 64) for slot in fields['bins']]
+    reserve = fields.get('reserve')
+    if reserve is not None:
+        reserve = (tuple(reserve['hover']), tuple(reserve['lower']))
+    return Places(bins, capacities, reserve)
+
+
+def expand(board: Board, start: int, end: int, promotion: bool = False) -> tuple[list[Transfer], list[tuple[int, int]]]:
+    """
+    Expands a move into the transfers that make it on the physical board.
+    Must be called before the move is made on board.
+
+    :param board: The position before the move
+    :param start: The start position of the move, as a chessengine position
+    :param end: The end position of the move, as a chessengine position
+    :param promotion: True to swap a promoted pawn for a piece from the reserve
+    :return: A 2-tuple of the transfers, in the order controller.ino would
+        make them, and the pairs (i, j) of transfers where transfer i has to
+        be made before transfer j
+    """
+    start_index, end_index = comms.move_indices((start, end))
+    start_side, start_piece, _ = board.identify_piece_at(start)
+    end_side, _, _ = board.identify_piece_at(end)
+
+    transfers, order = [], []
+    if end_side is not None:
+        # The captured piece has to leave the square before the moving piece arrives
+        transfers.append(Transfer(end_index, BIN))
+    elif start_piece == 'pawns' and start_index // 8 != end_index // 8:
+        # A pawn that changes file without capturing on its end square takes en passant
+        transfers.append(Transfer(end_index - 1 if start_side == 'white' else end_index + 1, BIN))
+
+    if start_piece == 'pawns' and promotion and end_index % 8 in (0, 7):
+        transfers.append(Transfer(start_index, BIN))
+        transfers.append(Transfer(RESERVE, end_index))
+    else:
+        transfers.append(Transfer(start_index, end_index))
+    if end_side is not None:
+        order.append((0, len(transfers) - 1))
+
+    if start_piece == 'kings' and (start_index, end_index) in CASTLES:
+        transfers.append(Transfer(*CASTLES[(start_index, end_index)]))
+    return transfers, order
+
+
+def commands(transfers: list[Transfer]) -> list[tuple[bool, int, int]]:
+    """
+    Converts the transfers of a move expanded without promotion into the
+    MOVE and CAPTURE commands of controller.ino, as (capture, start, end) in
+    the order they have to be sent, for arms that don't take streamed
+    trajectories. A captured piece is carried to the bin by a CAPTURE
+    command, which moves a piece onto the captured piece's square, so a
+    piece taken en passant is captured by moving the pawn onto it first.
+    """
+    result = []
+    pending = None
+    for transfer in transfers:
+        if transfer.target == BIN:
+            pending = transfer.source
+            continue
+        if pending is not None:
+            result.append((True, transfer.source, pending))
+            if pending != transfer.target:
+                # En passant - the pawn captured on the square next to its end square
+                result.append((False, pending, transfer.target))
+            pending = None
+        else:
+            result.append((False, transfer.source, transfer.target))
+    return result
+
+
+class Sequencer:
+    """
+    Orders the transfers of moves and chooses their bin slots, and keeps
+    track of how full each slot of the capture bin is over a game.
+
+    :param planner: A planner built with places.poses() as its places
+    :param places: The capture bin slots and the reserve
+    """
+    def __init__(self, planner: Planner, places: Places = DEFAULT_PLACES):
+        self.planner = planner
+        self.places = places
+        self.filled = [0] * len(places.bins)
+
+    def locations(self, transfers: list[Transfer]) -> list[int]:
+        """
+        Returns the places the arm picks up or puts down a piece at, in order.
+        """
+        return [place for transfer in transfers for place in transfer]
+
+    def cost(self, transfers: list[Transfer]) -> float:
+        """
+        Returns the number of seconds the arm takes to make transfers.
+        """
+        return self.planner.duration(self.planner.visit(self.locations(transfers)))
+
+    def plan(self, transfers: list[Transfer], order: list[tuple[int, int]] = ()) -> tuple[list[Transfer], float]:
+        """
+        Tries every order of transfers that keeps to order, and every free
+        bin slot for the pieces carried to the bin, and returns the fastest.
+
+        :return: A 2-tuple of the transfers in the order to make them, with
+            their bin slots and reserve filled in, and the seconds they take
+        :raises ValueError: If the bin is full, or a promotion needs a reserve that was not set
+        """
+        reserve = CAPTURE_BIN + len(self.places.bins)
+        if any(transfer.source == RESERVE for transfer in transfers) and self.places.reserve is None:
+            raise ValueError('A promotion needs a reserve to pick the new piece up from')
+        to_bin = [number for number, transfer in enumerate(transfers) if transfer.target == BIN]
+
+        best, best_cost = None, float('inf')
+        for slots in product(range(len(self.places.bins)), repeat=len(to_bin)):
+            if any(slots.count(slot) + self.filled[slot] > self.places.capacities[slot] for slot in set(slots)):
+                continue
+            concrete = list(transfers)
+            for number, slot in zip(to_bin, slots):
+                concrete[number] = concrete[number]._replace(target=CAPTURE_BIN + slot)
+            concrete = [transfer._replace(source=reserve) if transfer.source == RESERVE else transfer for transfer in concrete]
+
+            for permutation in permutations(range(len(concrete))):
+                position = {number: place for place, number in enumerate(permutation)}
+                if any(position[before] > position[after] for before, after in order):
+                    continue
+                ordered = [concrete[number] for number in permutation]
+                cost = self.cost(ordered)
+                if cost < best_cost:
+                    best, best_cost = ordered, cost
+        if best is None:
+            raise ValueError('The capture bin is full')
+        return best, best_cost
+
+    def commit(self, transfers: list[Transfer]) -> None:
+        """
+        Records the pieces that transfers put into the bin.
+        """
+        for transfer in transfers:
+            if CAPTURE_BIN <= transfer.target < CAPTURE_BIN + len(self.places.bins):
+                self.filled[transfer.target - CAPTURE_BIN] += 1
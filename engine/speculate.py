@@ -0,0 +1,115 @@
+"""
+Speculative search for the default engine (chessengine).
+
+While the opponent is thinking, the replies they are most likely to make
+are searched in parallel in a pool of worker processes. When the opponent's
+actual move matches one of them, the engine's answer is already available.
+The searches for the replies that weren't made are stopped through a flag
+that they check at every node, so they don't compete with the engine's
+search for the actual reply.
+"""
+from concurrent.futures import ProcessPoolExecutor, Future
+import multiprocessing
+
+from chessengine import Board
+
+from search import stop_when, timed_search
+from utils import position_key
+
+
+# The number of stop flags. The flag of a search is used again once this
+# many more searches were started, long after the search ended.
+STOP_SLOTS = 1024
+
+# The stop flags shared with the worker processes, set in each worker
+_stop_flags = None
+
+
+def likely_replies(board: Board, count: int) -> list[tuple[int, int, int]]:
+    """
+    Returns the ``count`` moves the opponent is most likely to make, ranked
+    by the board evaluation after each move from the opponent's point of view.
+    """
+    moves = board.get_moves(board.opponent_side)
+    # A more positive score favors white. chessengine doesn't score castles,
+    # so they are ranked as if they didn't change the evaluation.
+    moves.sort(key=lambda move: board.score if move[2] is None else move[2], reverse=board.opponent_side == 'white')
+    return moves[:count]
+
+
+def _init_worker(stop_flags) -> None:
+    global _stop_flags
+    _stop_flags = stop_flags
+
+
+def _search(board: Board, depth: int, movetime: float | None, slot: int) -> tuple[int, tuple[int, int, int], int]:
+    stop_when(board, lambda: _stop_flags[slot], 'The speculative search was discarded')
+    if movetime is not None:
+        return timed_search(board, movetime)
+    score, move = board.search_forward(depth)
+    return score, move, depth
+
+
+class Speculator:
+    """
+    Runs ``Board.search_forward``, or ``timed_search`` when the engine's moves
+    are timed, for the opponent's most likely replies in a process pool, and
+    keeps the pending results keyed by the resulting position.
+
+    :param replies: The number of opponent replies to search
+    :param workers: The number of worker processes. Defaults to ``replies``.
+    """
+    def __init__(self, replies: int, workers: int = None):
+        self.replies = replies
+        # One flag per search, set to stop it
+        self.stop_flags = multiprocessing.RawArray('b', STOP_SLOTS)
+        self.pool = ProcessPoolExecutor(max_workers=workers or replies, initializer=_init_worker, initargs=(self.stop_flags,))
+        # The pending searches and their stop flags, by the position searched
+        self.searches: dict[tuple, tuple[Future, int]] = {}
+        self.started = 0
+
+    def start(self, board: Board, depth: int, movetime: float = None) -> None:
+        """
+        Starts searching the positions after the opponent's likely replies.
+        Must be called when it is the opponent's turn to move on ``board``.
+
+        :param depth: The depth to search to, if movetime is None
+        :param movetime: The seconds to search each reply for, as the engine would on its turn
+        """
+        self.cancel()
+        for start, end, score in likely_replies(board, self.replies):
+            speculative_board = board.copy()
+            # The searches only need the current position, not the game's moves
+            speculative_board.moves = []
+            speculative_board.move(start, end, score=score)
+            key = position_key(speculative_board)
+            slot = self.started % STOP_SLOTS
+            self.started += 1
+            self.stop_flags[slot] = 0
+            self.searches[key] = (self.pool.submit(_search, speculative_board, depth, movetime, slot), slot)
+
+    def result(self, board: Board) -> tuple[int, tuple[int, int, int], int] | None:
+        """
+        Returns the best score, the best move and the depth searched to for
+        the position on ``board`` if it was searched speculatively, waiting
+        for the search to finish if needed.
+        Returns None on a miss. All other speculative searches are discarded.
+        """
+        search = self.searches.pop(position_key(board), None)
+        self.cancel()
+        if search is None:
+            return None
+        return search[0].result()
+
+    def cancel(self) -> None:
+        """
+        Discards all pending speculative searches, and stops the ones that are running.
+        """
+        for future, slot in self.searches.values():
+            future.cancel()
+            self.stop_flags[slot] = 1
+        self.searches.clear()
+
+    def shutdown(self) -> None:
+        self.cancel()
+        self.pool.shutdown(cancel_futures=True)
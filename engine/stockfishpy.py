@@ -13,6 +13,7 @@
 import subprocess
 import sys
 import re
+import time
 
 
 class Engine(subprocess.Popen):
@@ -47,13 +48,16 @@ class Engine(subprocess.Popen):
 
     """
 
-    def __init__(self, stockfish_path='', depth=12, param={}):
+    def __init__(self, stockfish_path='', depth=12, param={}, recorder=None):
         try:
             subprocess.Popen.__init__(self, stockfish_path, universal_newlines=True,
                                       stdin=subprocess.PIPE,
                                       stdout=subprocess.PIPE)
         except Exception:
             sys.exit('Install correct Stockfish PATH ')
+        if recorder is not None:
+            # Record everything exchanged with stockfish, see recording.py
+            self.stdin, self.stdout = recorder.tap_pipes(self.stdin, self.stdout)
 
         default_param = {
             "Write Debug Log": "false",
@@ -77,46 +81,81 @@ class Engine(subprocess.Popen):
 
         default_param.update(param)
         self.param = default_param
+        self.options = {}
+        # Counters for timing the game, see timing.py
+        self.bytessent = 0
+        self.searchstart = None
+        self.uci()
+
+        # Only send the options that differ from the engine's defaults, all at
+        # once, and wait for the engine to apply them with a single isready
+        commands = []
         for name, value in list(default_param.items()):
-            self.setoption(name, value)
+            if name not in self.options:
+                # Options of other stockfish versions in default_param are skipped quietly
+                if name in param:
+                    print("stockfish was unable to set option %s" % name)
+                continue
+            if str(value).lower() != self.options[name].lower():
+                commands.append('setoption name %s value %s' % (name, str(value)))
+        self.send('\n'.join(commands + ['isready']))
+        self.__waitready()
 
-        self.uci()
         self.depth = str(depth)
+        self.pondering = False
 
     def send(self, command):
         self.stdin.write(command + '\n')
         self.stdin.flush()
+        self.bytessent += len(command) + 1
 
     def flush(self):
         self.stdout.flush()
 
     def uci(self):
+        """ Handshake with the engine and store the default value of each option in self.options """
         self.send('uci')
         while True:
             line = self.stdout.readline().strip()
             if line == 'uciok':
                 return line
+            match = re.match(r'option name (.+?) type \S+(?: default ?(.*?))?(?: min | max | var |$)', line)
+            if match:
+                default = match.group(2) or ''
+                self.options[match.group(1)] = '' if default == '<empty>' else default
 
     def setoption(self, optionname, value):
         """ Update default_param dict """
-        self.send('setoption name %s value %s' % (optionname, str(value)))
-        stdout = self.isready()
-        if stdout.find('No such') >= 0:
+        if optionname not in self.options:
             print("stockfish was unable to set option %s" % optionname)
+            return
+        self.param[optionname] = value
+        self.send('setoption name %s value %s' % (optionname, str(value)))
 
-    def setposition(self, position):
+    def setposition(self, position, sync=False):
         """
         The move format is in long algebraic notation.
 
         Takes list of stirngs = ['e2e4', 'd7d5']
         OR
         FEN = 'rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq e3 0 1'
+        OR
+        an already encoded command = 'position startpos moves e2e4 d7d5'
+
+        UCI commands are processed in order, so a following 'go' always sees
+        the new position. Pass sync=True to also block on an 'isready'
+        round-trip until the engine has processed the position.
         """
         try:
             if isinstance(position, list):
                 self.send('position startpos moves {}'.format(
                     self.__listtostring(position)))
-                self.isready()
+                if sync:
+                    self.isready()
+            elif position.startswith('position '):
+                self.send(position)
+                if sync:
+                    self.isready()
             elif re.match('\s*^(((?:[rnbqkpRNBQKP1-8]+\/){7})[rnbqkpRNBQKP1-8]+)\s([b|w])\s([K|Q|k|q|-]{1,4})\s(-|[a-h][1-8])\s(\d+\s\d+)$', position):
                 regexList = re.match('\s*^(((?:[rnbqkpRNBQKP1-8]+\/){7})[rnbqkpRNBQKP1-8]+)\s([b|w])\s([K|Q|k|q|-]{1,4})\s(-|[a-h][1-8])\s(\d+\s\d+)$', position).groups()
                 fen = regexList[0].split("/")
@@ -148,7 +187,8 @@ class Engine(subprocess.Popen):
                     if field_sum != 8:
                         raise ValueError("expected 8 columns per row in position part of fen: {0}".format(repr(fen)))  
                 self.send('position fen {}'.format(position))
-                self.isready()
+                if sync:
+                    self.isready()
             else: raise ValueError("fen doesn`t match follow this example: rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 ")  
 
         except ValueError as e:
@@ -159,11 +199,25 @@ class Engine(subprocess.Popen):
     def __listtostring(move):
         return ' '.join(move).strip()
 
-    def go(self):
-        self.send('go depth {}'.format(self.depth))
+    def go(self, **limits):
+        """
+        Start searching to self.depth. Time limits in milliseconds
+        (movetime, wtime, btime, winc, binc) replace the depth limit.
+        """
+        self.send('go {}'.format(self.__limitstostring(limits)))
+        self.searchstart = time.monotonic()
+
+    def __limitstostring(self, limits):
+        limits = {name: value for name, value in limits.items() if value is not None}
+        if not limits:
+            return 'depth {}'.format(self.depth)
+        return ' '.join('{} {}'.format(name, int(value)) for name, value in limits.items())
 
     def isready(self):
         self.send('isready')
+        return self.__waitready()
+
+    def __waitready(self):
         while True:
             line = self.stdout.readline().strip()
             if line == 'readyok':
@@ -173,15 +227,179 @@ class Engine(subprocess.Popen):
         self.send('ucinewgame')
         self.isready()
 
-    def bestmove(self):
-        info = ""
-        self.go()
+    def bestmove(self, policy=None, **limits):
+        """
+        Search the current position and return the result of readbestmove.
+        If a StopPolicy is passed, the search is stopped as soon as the
+        policy decides it has found its move.
+        """
+        self.go(**limits)
+        return self.readbestmove(policy)
+
+    @staticmethod
+    def parseinfo(line):
+        """
+        Parse an 'info' line into a dict. Numbers are converted to int,
+        'score' becomes {'cp': n} or {'mate': n} with 'bound' set to
+        'lowerbound' or 'upperbound' if the score is only a bound, 'wdl'
+        becomes a list of 3 ints, and 'pv' a list of moves.
+        """
+        tokens = line.split()[1:]
+        info = {}
+        i = 0
+        while i < len(tokens):
+            name = tokens[i]
+            if name == 'string':
+                info['string'] = ' '.join(tokens[i + 1:])
+                break
+            if name in ('pv', 'refutation', 'currline'):
+                # These run to the end of the line
+                info[name] = tokens[i + 1:]
+                break
+            if name == 'score':
+                info['score'] = {tokens[i + 1]: int(tokens[i + 2])}
+                i += 3
+                while i < len(tokens) and tokens[i] in ('lowerbound', 'upperbound'):
+                    info['score']['bound'] = tokens[i]
+                    i += 1
+                continue
+            if name == 'wdl':
+                info['wdl'] = [int(value) for value in tokens[i + 1:i + 4]]
+                i += 4
+                continue
+            if i + 1 < len(tokens):
+                value = tokens[i + 1]
+                info[name] = int(value) if value.lstrip('-').isdigit() else value
+            i += 2
+        return info
+
+    def readinfo(self):
+        """
+        Read the engine output until the search ends, yielding each 'info'
+        line as a dict (see parseinfo) as soon as the engine prints it.
+        The 'bestmove' line, split into words, is the generator's return value.
+        """
         while True:
-            line = self.stdout.readline().strip().split(' ')
-            if line[0] == 'bestmove':
-                if self.param['Ponder'] == 'true':
-                    ponder = line[3]
-                else:
-                    ponder = None
-                return {'bestmove': line[1], 'ponder': ponder, 'info': ' '.join(info)}
-            info = line
\ No newline at end of file
+            line = self.stdout.readline().strip()
+            if line.startswith('bestmove'):
+                return line.split(' ')
+            if line.startswith('info'):
+                yield self.parseinfo(line)
+
+    def readbestmove(self, policy=None):
+        """
+        Read the engine output until the search ends. 'depth', 'nodes',
+        'nps' and 'score' are taken from the last info lines that reported
+        them, or None if there were none, and 'info' is the last info line
+        as a dict. 'time' is the number of seconds since the search was
+        started, and 'stopped' is True if policy stopped the search early.
+        """
+        info = {}
+        depth = None
+        nodes = None
+        nps = None
+        score = None
+        stopped = False
+        lines = self.readinfo()
+        while True:
+            try:
+                info = next(lines)
+            except StopIteration as end:
+                line = end.value
+                break
+            depth = info.get('depth', depth)
+            nodes = info.get('nodes', nodes)
+            nps = info.get('nps', nps)
+            score = info.get('score', score)
+            if policy is not None and not stopped and policy.update(info):
+                self.send('stop')
+                stopped = True
+
+        if len(line) > 3 and line[2] == 'ponder':
+            ponder = line[3]
+        else:
+            ponder = None
+        elapsed = None if self.searchstart is None else time.monotonic() - self.searchstart
+        return {
+            'bestmove': line[1],
+            'ponder': ponder,
+            'info': info,
+            'depth': depth,
+            'nodes': nodes,
+            'nps': nps,
+            'score': score,
+            'time': elapsed,
+            'stopped': stopped,
+        }
+
+    def quit(self):
+        """ Ask the engine to exit and wait for the process to end """
+        self.send('quit')
+        self.wait()
+
+    def ponder(self, position, **limits):
+        """
+        Start searching on the opponent's time. 'position' should already
+        include the predicted reply of the opponent, i.e. the 'ponder' move
+        returned by bestmove(). Takes the same limits as go().
+        """
+        self.setposition(position)
+        self.send('go ponder {}'.format(self.__limitstostring(limits)))
+        self.searchstart = time.monotonic()
+        self.pondering = True
+
+    def ponderhit(self):
+        """
+        The opponent played the predicted move. The ponder search turns
+        into a normal search and its result is returned.
+        """
+        self.send('ponderhit')
+        self.pondering = False
+        return self.readbestmove()
+
+    def stop(self):
+        """ Stop the current search and return its result """
+        self.send('stop')
+        self.pondering = False
+        return self.readbestmove()
+
+
+class StopPolicy:
+    """
+    Decides when a search has found its move, so that it can be stopped
+    before it reaches its depth or time limit. The search is stopped once
+    the best move and its score stayed the same for 'stable' depths in a
+    row, or as soon as a mate is found.
+
+    'margin' is the largest change of the score in centipawns that still
+    counts as the same score. Create a new policy for every search.
+    """
+
+    def __init__(self, stable=3, margin=15):
+        self.stable = stable
+        self.margin = margin
+        self.depth = 0
+        self.move = None
+        self.score = None
+        self.count = 0
+
+    def update(self, info):
+        """ Take in the next info line (see Engine.parseinfo) and return True to stop the search """
+        score = info.get('score')
+        if not info.get('pv') or score is None or 'bound' in score or info.get('multipv', 1) != 1:
+            return False
+        if 'mate' in score:
+            return True
+        if info.get('depth', 0) <= self.depth:
+            # Another line for a depth that was already counted
+            return False
+
+        self.depth = info['depth']
+        move = info['pv'][0]
+        if move == self.move and abs(score['cp'] - self.score) <= self.margin:
+            self.count += 1
+        else:
+            self.move = move
+            self.count = 1
+        self.score = score['cp']
+        return self.count >= self.stable
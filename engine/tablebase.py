@@ -0,0 +1,95 @@
+"""
+Probes Syzygy endgame tablebases, so that positions with few pieces left
+are played perfectly and at once, instead of being searched.
+
+The tables are read with python-chess (pip install chess), which memory-maps
+the table files and only opens the ones that are probed. Download the WDL
+(.rtbw) and DTZ (.rtbz) files of the tables into a directory, e.g. from
+https://tablebase.lichess.ovh/tables/standard/, and pass the directory to
+play.py --syzygy. Stockfish is given the same directories as its SyzygyPath.
+
+The move to play is found by probing the position after every legal move,
+and playing the move that leaves the opponent with the worst result, and
+of the moves that win, the one that gets closest to the next capture or
+pawn move (and so to the mate). The move found for each position is kept
+in an LRU cache. chessengine cannot promote pawns, so promotions are never
+chosen.
+"""
+from functools import lru_cache
+import os
+
+try:
+    import chess
+    import chess.syzygy
+except ImportError:
+    chess = None
+
+from chessengine import Board
+
+from utils import board_fen, castling_rights
+
+
+# The results of a position for the side to move, by its WDL value
+RESULTS = {2: 'win', 1: 'win, but drawn by the fifty-move rule', 0: 'draw', -1: 'loss, but drawn by the fifty-move rule', -2: 'loss'}
+
+
+class Tablebase:
+    """
+    :param paths: The directories with the tables, separated by os.pathsep like stockfish's SyzygyPath
+    :param limit: Positions with more pieces than this are not probed. The most pieces of any table found if None.
+    :param cache_size: The number of positions to keep the moves of in the cache
+    :raises ImportError: If python-chess is not installed
+    :raises ValueError: If there are no WDL tables in the directories
+    """
+    def __init__(self, paths: str, limit: int = None, cache_size: int = 10000):
+        if chess is None:
+            raise ImportError('Probing Syzygy tablebases needs python-chess. Install it with "pip install chess".')
+        self.tables = chess.syzygy.Tablebase()
+        for path in paths.split(os.pathsep):
+            if path:
+                self.tables.add_directory(path)
+        if not self.tables.wdl:
+            raise ValueError(f'There are no Syzygy WDL tables (.rtbw) in {paths}')
+        # Tables are named by their pieces, e.g. KRPvKR
+        largest = max(len(name) - 1 for name in self.tables.wdl)
+        self.limit = largest if limit is None else min(limit, largest)
+        self.probe_fen = lru_cache(maxsize=cache_size)(self._probe_fen)
+
+    def probe(self, board: Board, side_to_move: str) -> tuple[str, int] | None:
+        """
+        Returns the best move of side_to_move in UCI format, and the result
+        it leads to as a WDL value (see RESULTS). Returns None if the position
+        has too many pieces, or its tables are missing.
+        """
+        if board.all_pieces.bit_count() > self.limit:
+            return None
+        if castling_rights(board):
+            # The tables have no positions that can still castle
+            return None
+        return self.probe_fen(board_fen(board, side_to_move))
+
+    def _probe_fen(self, fen: str) -> tuple[str, int] | None:
+        position = chess.Board(fen)
+        best, best_key = None, None
+        for move in position.legal_moves:
+            if move.promotion is not None:
+                continue
+            position.push(move)
+            try:
+                # Both from the opponent's side. The DTZ of a won position is
+                # negative for the opponent, and closest to 0 when it is fastest.
+                wdl = -self.tables.probe_wdl(position)
+                dtz = self.tables.probe_dtz(position)
+            except KeyError:
+                # Includes chess.syzygy.MissingTableError
+                return None
+            finally:
+                position.pop()
+            if best_key is None or (wdl, dtz) > best_key:
+                best, best_key = move.uci(), (wdl, dtz)
+        if best is None:
+            return None
+        return best, best_key[0]
+
+    def close(self) -> None:
+        self.tables.close()
@@ -0,0 +1,105 @@
+"""
+Timing of every phase of every ply of a game, such as the search, the
+serial write, and waiting for the arm to finish its move.
+
+Each timed phase is written to a log file as one line of JSON, e.g. -
+
+    {"time": 1715340000.1, "port": "COM3", "ply": 3, "phase": "search", "duration": 1.52, "depth": 4}
+
+Print the 50th, 95th and 99th percentile duration of each phase in one or
+more logs by running -
+
+    python engine/timing.py game.jsonl
+"""
+import argparse
+from contextlib import contextmanager
+import json
+import math
+import threading
+import time
+
+
+class TimingLog:
+    """
+    Writes timed phases to a JSON lines file. The file is appended to, so
+    several games can share one log.
+
+    :param path: The path of the log file
+    :param fields: Fields to add to every line, e.g. the port of the arm
+    """
+    def __init__(self, path: str, **fields):
+        self.file = open(path, 'a', buffering=1)
+        self.fields = fields
+        # Phases are recorded from the game loop and from the threads it waits on
+        self.lock = threading.Lock()
+
+    def record(self, ply: int, phase: str, duration: float, **fields) -> None:
+        """
+        Writes one phase to the log. Fields that are None are left out.
+        """
+        line = {'time': round(time.time(), 3), **self.fields, 'ply': ply, 'phase': phase, 'duration': round(duration, 6)}
+        line.update((name, value) for name, value in fields.items() if value is not None)
+        with self.lock:
+            self.file.write(json.dumps(line) + '\n')
+
+    @contextmanager
+    def timer(self, ply: int, phase: str, **fields):
+        """
+        Times the body of a with statement and records it as phase. Yields a
+        dict that more fields can be added to, e.g. the depth a search reached.
+        """
+        fields = dict(fields)
+        started = time.monotonic()
+        try:
+            yield fields
+        finally:
+            self.record(ply, phase, time.monotonic() - started, **fields)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Returns the nearest-rank percentile of values, e.g. the median for a fraction of 0.5.
+    """
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def summarize(paths: list[str]) -> dict[str, dict[str, float]]:
+    """
+    Returns the number of times each phase was recorded in the logs, and the
+    50th, 95th and 99th percentile of its duration in seconds.
+    Lines that are not valid JSON are skipped.
+    """
+    durations = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                durations.setdefault(event['phase'], []).append(event['duration'])
+
+    return {
+        phase: {
+            'count': len(values),
+            'p50': percentile(values, 0.5),
+            'p95': percentile(values, 0.95),
+            'p99': percentile(values, 0.99),
+        }
+        for phase, values in durations.items()
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the timing logs written by play.py --timing')
+    parser.add_argument('logs', nargs='+', help='The timing logs to summarize')
+    args = parser.parse_args()
+
+    summary = summarize(args.logs)
+    print(f'{"phase":<14}{"count":>8}{"p50 (s)":>12}{"p95 (s)":>12}{"p99 (s)":>12}')
+    for phase, stats in sorted(summary.items(), key=lambda item: -item[1]['p50']):
+        print(f'{phase:<14}{stats["count"]:>8}{stats["p50"]:>12.4f}{stats["p95"]:>12.4f}{stats["p99"]:>12.4f}')
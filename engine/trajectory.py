@@ -0,0 +1,323 @@
+"""
+Plans the motion of the arm between the poses in its angle tables, as
+trajectories that are as fast as the servos allow, and streams them to the
+arm as setpoints.
+
+Every segment between two poses is a straight line in joint space, with a
+trapezoidal velocity profile that is shared by all 4 joints - every joint
+accelerates, cruises and decelerates at the same time, so they all start
+and stop together and the arm can't overshoot the pose it moves to. The
+profile is the shortest one that keeps every joint within its velocity and
+acceleration limits.
+
+The segments between every pair of hover poses, and between the hover and
+grab poses of every square, are planned at once and can be saved to a file,
+so planning a move is only a lookup. Print the time every move takes with -
+
+    python engine/trajectory.py calibration.cal e2 e4
+"""
+import argparse
+import hashlib
+import itertools
+import struct
+import sys
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+import comms
+from calibration_store import CalibrationStore
+
+
+# The poses of the capture bin and the reset position, as in controller.ino
+CAPTURE_HOVER_ANGLES = (60.0, 74.0, 70.0, 105.0)
+CAPTURE_LOWER_ANGLES = (60.0, 61.0, 65.0, 126.0)
+RESET_ANGLES = (108.0, 132.0, 159.0, 178.0)
+# The index of the first place off the board, e.g. the capture bin, in the pose tables
+CAPTURE_BIN = 64
+
+# Seconds to wait for the gripper to open or close
+GRIPPER_TIME = 0.3
+# Seconds between the setpoints streamed to the arm, as in controller.ino
+SETPOINT_PERIOD = 0.02
+# The number of setpoints streamed ahead of the arm, at most the size of its setpoint buffer
+STREAM_AHEAD = 8
+# Setpoint payload - 4 angles in hundredths of a degree, the SETPOINT flags,
+# the number of the trajectory (modulo 256) and the setpoint's index in it
+SETPOINT_PAYLOAD = struct.Struct('>HHHHBBH')
+
+# Numbers the trajectories streamed, so the arm can tell a setpoint sent
+# again late from the setpoints of the trajectory it is playing
+_trajectory_numbers = itertools.count()
+
+
+class Limits(NamedTuple):
+    # The largest speed of the base, base-arm, arm-arm and gripper pitch servos, in degrees per second
+    velocity: tuple[float, float, float, float] = (90.0, 60.0, 90.0, 120.0)
+    # The largest acceleration of each servo, in degrees per second squared
+    acceleration: tuple[float, float, float, float] = (240.0, 160.0, 240.0, 320.0)
+
+
+def plan(start: np.ndarray, end: np.ndarray, limits: Limits) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Plans the fastest synchronized trapezoidal profiles from start to end.
+    The last axis of start and end holds the 4 servo angles, the other axes
+    are planned at once.
+
+    :return: A 2-tuple of the duration of every segment, and the time every
+        segment spends accelerating (and decelerating), in seconds
+    """
+    distance = np.abs(np.asarray(end, dtype=float) - np.asarray(start, dtype=float))
+    with np.errstate(divide='ignore'):
+        # The largest speed and acceleration along the path from 0 to 1 that no joint exceeds
+        velocity = np.min(np.asarray(limits.velocity) / distance, axis=-1)
+        acceleration = np.min(np.asarray(limits.acceleration) / distance, axis=-1)
+    moving = np.isfinite(velocity)
+    velocity, acceleration = np.where(moving, velocity, 1), np.where(moving, acceleration, 1)
+
+    # Profiles too short to reach the top speed accelerate for half the segment
+    accel_time = np.minimum(velocity / acceleration, np.sqrt(1 / acceleration))
+    duration = 1 / (acceleration * accel_time) + accel_time
+    return np.where(moving, duration, 0.0), np.where(moving, accel_time, 0.0)
+
+
+def progress(times: np.ndarray, duration: float, accel_time: float) -> np.ndarray:
+    """
+    Returns how far along a planned segment the arm is at times, from 0 at the start to 1 at the end.
+    """
+    if duration == 0:
+        return np.ones_like(times)
+    times = np.clip(times, 0, duration)
+    cruise_speed = 1 / (duration - accel_time)
+    acceleration = cruise_speed / accel_time
+    return np.where(
+        times < accel_time,
+        acceleration * times ** 2 / 2,
+        np.where(
+            times <= duration - accel_time,
+            cruise_speed * (times - accel_time / 2),
+            1 - acceleration * (duration - times) ** 2 / 2
+        )
+    )
+
+
+class Planner:
+    """
+    Plans the moves of the arm from its angle tables.
+
+    :param hover: The (64, 4) hover angles of every square
+    :param grab: The (64, 4) grabbing angles of every square
+    :param limits: The speed and acceleration limits of the servos
+    :param places: The (hover angles, grabbing angles) of the places off the
+        board pieces are put down at, numbered from CAPTURE_BIN on. The capture
+        bin of controller.ino if not given.
+    """
+    def __init__(
+        self,
+        hover: np.ndarray,
+        grab: np.ndarray,
+        limits: Limits = Limits(),
+        places: list[tuple[tuple, tuple]] = None
+    ):
+        if places is None:
+            places = [(CAPTURE_HOVER_ANGLES, CAPTURE_LOWER_ANGLES)]
+        self.limits = limits
+        self.hover = np.vstack([hover, [place[0] for place in places], RESET_ANGLES])
+        self.grab = np.vstack([grab, [place[1] for place in places]])
+        # The index of the reset position, after the places
+        self.reset = len(self.hover) - 1
+        self.key = hashlib.sha1(
+            self.hover.tobytes() + self.grab.tobytes() + np.asarray(limits, dtype=float).tobytes()
+        ).hexdigest()
+        self.travel = None
+        self.lower = None
+
+    @classmethod
+    def from_store(cls, path: str, limits: Limits = Limits(), places: list[tuple[tuple, tuple]] = None) -> 'Planner':
+        """
+        Creates a planner from the angles in a calibration store.
+
+        :raises ValueError: If the store doesn't have the angles of every square
+        """
+        store = CalibrationStore(path)
+        table = store.table().astype(float)
+        store.close()
+        if np.isnan(table).any():
+            raise ValueError(f'{path} doesn\'t have the angles of every square')
+        return cls(table[0], table[1], limits, places)
+
+    def build(self) -> None:
+        """
+        Plans the segments between every pair of hover poses (the squares, the
+        places off the board and the reset position), and between the hover and
+        grab poses of every square and place, as (duration, acceleration time) arrays.
+        """
+        self.travel = np.stack(plan(self.hover[:, None], self.hover[None, :], self.limits))
+        self.lower = np.stack(plan(self.hover[:len(self.grab)], self.grab, self.limits))
+
+    def load(self, path: str) -> bool:
+        """
+        Loads the planned segments from a file written by save. Returns False,
+        and plans the segments, if the file is missing or was planned from
+        different angles or limits.
+        """
+        try:
+            with np.load(path) as cached:
+                if str(cached['key']) == self.key:
+                    self.travel, self.lower = cached['travel'], cached['lower']
+                    return True
+        except (OSError, KeyError, ValueError):
+            pass
+        self.build()
+        return False
+
+    def save(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            np.savez(f, key=self.key, travel=self.travel, lower=self.lower)
+
+    def segment(self, start: tuple[str, int], end: tuple[str, int]) -> tuple[np.ndarray, np.ndarray, float, float]:
+        """
+        Returns the start angles, end angles, duration and acceleration time of
+        the segment between two poses, each given as ("hover" or "grab", index).
+        """
+        if self.travel is None:
+            self.build()
+        poses = {'hover': self.hover, 'grab': self.grab}
+        if start[0] == 'hover' and end[0] == 'hover':
+            duration, accel_time = self.travel[:, start[1], end[1]]
+        elif start[1] == end[1]:
+            duration, accel_time = self.lower[:, start[1]]
+        else:
+            duration, accel_time = plan(poses[start[0]][start[1]], poses[end[0]][end[1]], self.limits)
+        return poses[start[0]][start[1]], poses[end[0]][end[1]], float(duration), float(accel_time)
+
+    def visit(self, destinations: list[int]) -> list[tuple[str, int] | str]:
+        """
+        Returns the poses the arm moves through to pick up or put down a piece
+        at each of destinations in turn, starting and ending at the reset
+        position. "grip" marks where the gripper opens or closes.
+        """
+        poses = [('hover', self.reset)]
+        for index in destinations:
+            poses += [('hover', index), ('grab', index), 'grip', ('hover', index)]
+        return poses + [('hover', self.reset)]
+
+    def waypoints(self, start: int, end: int, capture: bool) -> list[tuple[str, int] | str]:
+        """
+        Returns the poses the arm moves through to make a move, in the order controller.ino visits them.
+        """
+        return self.visit([end, CAPTURE_BIN, start, end] if capture else [start, end])
+
+    def setpoints(self, start: int, end: int, capture: bool, period: float = SETPOINT_PERIOD) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Samples the trajectory of a move every period seconds, see sample.
+        """
+        return self.sample(self.waypoints(start, end, capture), period)
+
+    def sample(self, poses: list[tuple[str, int] | str], period: float = SETPOINT_PERIOD) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Samples the trajectory through poses every period seconds.
+
+        :return: A 2-tuple of the (n, 4) servo angles, and an (n,) boolean
+            array that is True where the gripper is closed
+        """
+        angles, gripper = [], []
+        closed = False
+        previous = poses[0]
+        for pose in poses[1:]:
+            if pose == 'grip':
+                closed = not closed
+                count = int(np.ceil(GRIPPER_TIME / period))
+                angles.append(np.repeat(angles[-1][-1:], count, axis=0))
+                gripper.append(np.full(count, closed))
+                continue
+            start_angles, end_angles, duration, accel_time = self.segment(previous, pose)
+            times = np.arange(1, int(np.ceil(duration / period)) + 1) * period
+            angles.append(start_angles + np.outer(progress(times, duration, accel_time), end_angles - start_angles))
+            gripper.append(np.full(len(times), closed))
+            previous = pose
+        return np.vstack(angles), np.concatenate(gripper)
+
+    def move_time(self, start: int, end: int, capture: bool) -> float:
+        """
+        Returns the number of seconds the arm takes to make a move.
+        """
+        return self.duration(self.waypoints(start, end, capture))
+
+    def duration(self, poses: list[tuple[str, int] | str]) -> float:
+        """
+        Returns the number of seconds the arm takes to move through poses.
+        """
+        total = 0.0
+        previous = poses[0]
+        for pose in poses[1:]:
+            if pose == 'grip':
+                total += GRIPPER_TIME
+                continue
+            total += self.segment(previous, pose)[2]
+            previous = pose
+        return total
+
+
+def stream(socket: comms.ArmLink, angles: np.ndarray, gripper: np.ndarray, period: float = SETPOINT_PERIOD) -> int:
+    """
+    Sends setpoints to the arm as SETPOINT frames, paced to stay STREAM_AHEAD
+    setpoints ahead of the arm, which moves to one every period seconds.
+    Returns the sequence number of the last setpoint, which the arm reports
+    as done once it reaches it.
+
+    Every setpoint carries the trajectory's number and its index in the
+    trajectory. A setpoint that is sent again after later ones were played
+    is dropped by the arm, and the arm only starts a trajectory from its
+    first setpoint.
+    """
+    trajectory = next(_trajectory_numbers) % 256
+    started = time.monotonic()
+    sequence = None
+    for number, (setpoint, closed) in enumerate(zip(angles, gripper)):
+        delay = started + (number - STREAM_AHEAD) * period - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        last = number == len(angles) - 1
+        flags = (comms.SETPOINT_GRIPPER_CLOSED if closed else 0) | (comms.SETPOINT_LAST if last else 0)
+        centidegrees = np.clip(np.rint(setpoint * 100), 0, 18000).astype(int)
+        sequence = socket.send(comms.SETPOINT, SETPOINT_PAYLOAD.pack(*centidegrees, flags, trajectory, number), done=last)
+    return sequence
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan the moves of the arm from its angle tables')
+    parser.add_argument('calibration', help='The calibration store with the angles of every square, see calibration_store.py')
+    parser.add_argument('start', nargs='?', help='The start square of a move to plan, e.g. e2')
+    parser.add_argument('end', nargs='?', help='The end square of a move to plan, e.g. e4')
+    parser.add_argument('--capture', action='store_true', help='Plan the move as a capture', dest='capture')
+    parser.add_argument('--cache', help='A file to load the planned segments from, and save them to', dest='cache')
+    parser.add_argument('-c', '--port', help='Stream the move to the arm at this port', dest='port')
+    parser.add_argument('-b', '--baud-rate', default=115200, type=int, help='The baud rate of the port', dest='baud')
+    args = parser.parse_args()
+
+    try:
+        planner = Planner.from_store(args.calibration)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    started = time.perf_counter()
+    if args.cache is None:
+        planner.build()
+    elif not planner.load(args.cache):
+        planner.save(args.cache)
+    print(f'Planned {planner.travel[0].size + planner.lower[0].size} segments in {(time.perf_counter() - started) * 1000:.1f} ms')
+
+    if args.start is None or args.end is None:
+        times = np.array([[planner.move_time(start, end, False) for end in range(64)] for start in range(64)])
+        print(f'Move time - mean {times.mean():.2f} s, max {times.max():.2f} s')
+        sys.exit(0)
+
+    start, end = comms.square_index(args.start), comms.square_index(args.end)
+    angles, gripper = planner.setpoints(start, end, args.capture)
+    print(f'{args.start}{args.end} takes {planner.move_time(start, end, args.capture):.2f} s, {len(angles)} setpoints')
+    if args.port is not None:
+        socket = comms.get_socket(args.port, args.baud)
+        comms.wait_for_arm(socket, stream(socket, angles, gripper))
+        socket.close()
@@ -1,6 +1,9 @@
 from math import log2
+import random
 
-from chessengine.lookup_tables import pos_to_coords
+from chessengine import Board
+from chessengine.lookup_tables import coords_to_pos, pos_to_coords
+from chessengine.utils import get_bit_positions
 
 
 square_names = set([
@@ -15,12 +18,216 @@ square_names = set([
 ])
 
 
+def uci_move(start: int, end: int) -> str:
+    """
+    Converts a move given as two positions (powers of 2) into
+    a UCI compliant move string, e.g. "e2e4".
+    """
+    return pos_to_coords[int(log2(start))].lower() + pos_to_coords[int(log2(end))].lower()
+
+
+def positions_from_uci(move: str) -> tuple[int, int]:
+    """
+    Converts a UCI compliant move string, e.g. "e2e4", into its start
+    and end positions (powers of 2).
+    """
+    return 2 ** coords_to_pos[move[0:2].upper()], 2 ** coords_to_pos[move[2:4].upper()]
+
+
 def get_moves_made(board):
     """
     Returns a list of all moves made on the board so far in UCI compliant format
     to set Stockfish's position.
     """
-    moves = []
-    for move in board.moves:
-        moves.append(pos_to_coords[int(log2(move[0]))].lower() + pos_to_coords[int(log2(move[1]))].lower())
-    return moves
+    return [uci_move(move[0], move[1]) for move in board.moves]
+
+
+class MoveHistory:
+    """
+    Keeps track of the moves made in a game in UCI compliant format.
+
+    Moves are appended one ply at a time, and the "position startpos moves ..."
+    command used to set Stockfish's position is built incrementally and cached,
+    so the cost of updating the engine's position does not grow with the
+    number of string conversions made over the whole game.
+
+    A game resumed from a position other than the start position passes the
+    position's FEN, and its moves are appended to "position fen <fen>".
+    """
+    def __init__(self, fen: str = None):
+        self.moves = []
+        self.command = 'position startpos' if fen is None else f'position fen {fen}'
+
+    def __len__(self):
+        return len(self.moves)
+
+    def __iter__(self):
+        return iter(self.moves)
+
+    def append(self, move: str) -> None:
+        """
+        Appends a move given in UCI format (e.g. "e2e4") to the history.
+        """
+        move = move.lower()
+        if not self.moves:
+            self.command += ' moves'
+        self.moves.append(move)
+        self.command += ' ' + move
+
+    def command_with(self, *moves: str) -> str:
+        """
+        Returns the position command for the current history followed by
+        the given moves, without modifying the history.
+        """
+        if not moves:
+            return self.command
+        prefix = self.command if self.moves else self.command + ' moves'
+        return prefix + ' ' + ' '.join(move.lower() for move in moves)
+
+
+# The letter of every piece in FEN
+fen_letters = {
+    (side, piece): letter.upper() if side == 'white' else letter
+    for side in ['white', 'black']
+    for piece, letter in [('kings', 'k'), ('queens', 'q'), ('rooks', 'r'), ('bishops', 'b'), ('knights', 'n'), ('pawns', 'p')]
+}
+
+
+# The castling rights in FEN, with the flag of each on a chessengine Board,
+# and the squares its king and rook have to be on
+castles = [
+    ('K', 'white_king_side_castle', 'white', 'E1', 'H1'),
+    ('Q', 'white_queen_side_castle', 'white', 'E1', 'A1'),
+    ('k', 'black_king_side_castle', 'black', 'E8', 'H8'),
+    ('q', 'black_queen_side_castle', 'black', 'E8', 'A8'),
+]
+
+
+def castling_rights(board) -> str:
+    """
+    Returns the castling rights of a chessengine Board in FEN, e.g. "KQk",
+    or "" if neither side can castle. chessengine keeps the right to castle
+    after the rook is captured on its square, so a right is only kept if
+    the king and the rook are still on their squares.
+    """
+    return ''.join(
+        letter for letter, flag, side, king, rook in castles
+        if getattr(board, flag)
+        and board.get_bitboard(side, 'kings') & 2 ** coords_to_pos[king]
+        and board.get_bitboard(side, 'rooks') & 2 ** coords_to_pos[rook]
+    )
+
+
+def board_fen(board, side_to_move: str, fullmove: int = 1) -> str:
+    """
+    Returns the FEN of the position on a chessengine Board with side_to_move
+    to move. chessengine doesn't count moves towards the fifty-move rule, so
+    the halfmove clock is always 0.
+    """
+    letters = {}
+    for (side, piece), letter in fen_letters.items():
+        for position in get_bit_positions(board.get_bitboard(side, piece)):
+            letters[int(log2(position))] = letter
+    ranks = []
+    for rank in range(7, -1, -1):
+        row, empty = '', 0
+        for file in range(8):
+            letter = letters.get(rank * 8 + file)
+            if letter is None:
+                empty += 1
+                continue
+            row += (str(empty) if empty else '') + letter
+            empty = 0
+        ranks.append(row + (str(empty) if empty else ''))
+    castling = castling_rights(board)
+    en_passant = pos_to_coords[int(log2(board.en_passant_position))].lower() if board.en_passant_position else '-'
+    return f'{"/".join(ranks)} {side_to_move[0]} {castling or "-"} {en_passant} 0 {fullmove}'
+
+
+def board_from_fen(fen: str, board_side: str) -> tuple[Board, str]:
+    """
+    Sets up a chessengine Board for board_side with the position of a FEN.
+    Returns the board and the side to move.
+
+    :raises ValueError: If fen is not a valid FEN
+    """
+    fields = fen.split()
+    ranks = fields[0].split('/') if fields else []
+    if len(fields) != 6 or len(ranks) != 8 or fields[1] not in ('w', 'b'):
+        raise ValueError(f'{fen} is not a valid FEN')
+    pieces = {letter: key for key, letter in fen_letters.items()}
+    bitboards = dict.fromkeys(fen_letters, 0)
+    for rank, row in zip(range(7, -1, -1), ranks):
+        file = 0
+        for letter in row:
+            if letter.isdigit():
+                file += int(letter)
+            elif letter in pieces and file < 8:
+                bitboards[pieces[letter]] |= 2 ** (rank * 8 + file)
+                file += 1
+            else:
+                raise ValueError(f'{fen} is not a valid FEN')
+        if file != 8:
+            raise ValueError(f'{fen} is not a valid FEN')
+
+    board = Board(board_side)
+    for (side, piece), bitboard in bitboards.items():
+        board.set_bitboard(side, piece, bitboard)
+    for letter, flag, _, _, _ in castles:
+        setattr(board, flag, letter in fields[2])
+    board.en_passant_position = 0 if fields[3] == '-' else 2 ** coords_to_pos[fields[3].upper()]
+    # chessengine's search updates the score with every move, starting from the score of the position
+    board.score = board.evaluate_score()
+    return board, 'white' if fields[1] == 'w' else 'black'
+
+
+def position_key(board) -> tuple:
+    """
+    Returns a hashable key that uniquely identifies the position on a
+    chessengine Board, including castling rights and the en passant square.
+    """
+    return (
+        board.white_kings, board.white_queens, board.white_rooks,
+        board.white_bishops, board.white_knights, board.white_pawns,
+        board.black_kings, board.black_queens, board.black_rooks,
+        board.black_bishops, board.black_knights, board.black_pawns,
+        board.white_king_side_castle, board.white_queen_side_castle,
+        board.black_king_side_castle, board.black_queen_side_castle,
+        board.en_passant_position,
+    )
+
+
+# Random keys for Zobrist hashing. They are generated from a fixed seed so that
+# hashes are the same in every process and can be stored on disk.
+_zobrist_random = random.Random(20240510)
+_zobrist_pieces = {
+    (side, piece): [_zobrist_random.getrandbits(64) for _ in range(64)]
+    for side in ['white', 'black']
+    for piece in ['kings', 'queens', 'rooks', 'bishops', 'knights', 'pawns']
+}
+_zobrist_castling = [_zobrist_random.getrandbits(64) for _ in range(4)]
+_zobrist_en_passant = [_zobrist_random.getrandbits(64) for _ in range(8)]
+_zobrist_black_to_move = _zobrist_random.getrandbits(64)
+
+
+def zobrist_hash(board, side_to_move: str) -> int:
+    """
+    Returns a 64-bit hash of the position on a chessengine Board with
+    side_to_move to move. Equal positions have equal hashes in every process.
+    """
+    key = 0
+    for (side, piece), keys in _zobrist_pieces.items():
+        for position in get_bit_positions(board.get_bitboard(side, piece)):
+            key ^= keys[int(log2(position))]
+    castling = [
+        board.white_king_side_castle, board.white_queen_side_castle,
+        board.black_king_side_castle, board.black_queen_side_castle,
+    ]
+    for allowed, castling_key in zip(castling, _zobrist_castling):
+        if allowed:
+            key ^= castling_key
+    if board.en_passant_position:
+        key ^= _zobrist_en_passant[int(log2(board.en_passant_position)) % 8]
+    if side_to_move == 'black':
+        key ^= _zobrist_black_to_move
+    return key
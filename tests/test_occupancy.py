@@ -0,0 +1,54 @@
+"""
+Tests finding the opponent's move from snapshots of the board in engine/occupancy.py.
+Run with python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'engine'))
+
+from chessengine import Board
+from chessengine.lookup_tables import coords_to_pos
+
+from occupancy import MoveDetector, from_bitboard
+
+
+def position(square: str) -> int:
+    return 2 ** coords_to_pos[square.upper()]
+
+
+def play(board: Board, *moves: str) -> None:
+    for move in moves:
+        board.move(position(move[:2]), position(move[2:]))
+
+
+class MoveDetectorTest(unittest.TestCase):
+    def setUp(self):
+        # 1. e4 d5, white to move
+        self.board = Board('black')
+        play(self.board, 'e2e4', 'd7d5')
+        self.detector = MoveDetector(self.board, 'white')
+
+    def feed(self, occupied: int) -> list[tuple[int, int]]:
+        return [(move.start, move.end) for move in self.detector.feed(from_bitboard(occupied))]
+
+    def test_mover_lifted_first(self):
+        # With only the e4 pawn in the hand, the board looks like exd5 was made
+        occupied = self.board.all_pieces & ~position('e4')
+        self.assertEqual(self.feed(occupied), [])
+        self.assertEqual(self.feed(occupied | position('e5')), [(position('e4'), position('e5'))])
+
+    def test_capture_lifts_captured_piece(self):
+        occupied = self.board.all_pieces & ~position('e4')
+        self.assertEqual(self.feed(occupied), [])
+        self.assertEqual(self.feed(occupied & ~position('d5')), [])
+        self.assertEqual(self.feed(occupied), [(position('e4'), position('d5'))])
+
+    def test_captured_piece_lifted_first(self):
+        self.assertEqual(self.feed(self.board.all_pieces & ~position('d5')), [])
+        self.assertEqual(self.feed(self.board.all_pieces & ~position('e4')), [(position('e4'), position('d5'))])
+
+
+if __name__ == '__main__':
+    unittest.main()